@@ -1,13 +1,23 @@
 from django.contrib import admin
-from .models import File, Comment
+from .models import File, Comment, FileShare, UserStorage
 
 class FileAdmin(admin.ModelAdmin):
-    list_display = ('id', 'user', 'file_name', 'created_at')
+    list_display = ('id', 'user', 'file_name', 'size_bytes', 'created_at')
     search_fields = ('file_name',)
 
 class CommentAdmin(admin.ModelAdmin):
     list_display = ('id', 'file', 'user', 'content', 'created_at')
     search_fields = ('content',)
 
+class FileShareAdmin(admin.ModelAdmin):
+    list_display = ('id', 'file', 'grantee', 'permission', 'created_at')
+    search_fields = ('file__file_name', 'grantee__username')
+
+class UserStorageAdmin(admin.ModelAdmin):
+    list_display = ('user', 'used_bytes', 'quota_bytes', 'updated_at')
+    search_fields = ('user__username',)
+
 admin.site.register(File, FileAdmin)
-admin.site.register(Comment, CommentAdmin)
\ No newline at end of file
+admin.site.register(Comment, CommentAdmin)
+admin.site.register(FileShare, FileShareAdmin)
+admin.site.register(UserStorage, UserStorageAdmin)
\ No newline at end of file
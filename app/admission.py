@@ -0,0 +1,296 @@
+"""
+Admission control for byte-heavy requests
+
+Uploads and downloads encrypt or decrypt whole files inline, so a few large
+transfers can occupy every worker. Views marked with byte_heavy (sync or
+async) go through AdmissionControlMiddleware, which:
+
+- caps the number of byte-heavy requests in flight in this process, letting
+  new ones wait briefly for a slot;
+- caps how many of them a single user may have in flight;
+- meters each user's bytes with a token bucket, so a user who has just
+  moved a lot of data is asked to come back later.
+
+Rejected requests get a 429 with Retry-After. Limits are per process.
+"""
+
+import math
+import threading
+import time
+from collections import defaultdict
+from functools import wraps
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+
+DEFAULT_MAX_INFLIGHT = 8
+DEFAULT_MAX_PER_USER = 2
+DEFAULT_QUEUE_TIMEOUT = 2
+DEFAULT_USER_BYTES_PER_SECOND = 20 * 1024 * 1024
+DEFAULT_USER_BURST_BYTES = 200 * 1024 * 1024
+MAX_BUCKETS = 10000
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def byte_heavy(applies=None):
+    """
+    Mark a view as byte-heavy, optionally only for requests where applies(request) is true
+    """
+    def decorator(view_func):
+        if iscoroutinefunction(view_func):
+            @wraps(view_func)
+            async def wrapper(*args, **kwargs):
+                return await view_func(*args, **kwargs)
+        else:
+            @wraps(view_func)
+            def wrapper(*args, **kwargs):
+                return view_func(*args, **kwargs)
+
+        wrapper.byte_heavy = applies or (lambda request: True)
+        return wrapper
+    return decorator
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    Refills at rate tokens per second up to capacity; consuming may run the
+    balance negative, and the bucket admits nothing until it is paid back
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, amount):
+        self._refill()
+        self.tokens -= amount
+
+    def wait_time(self):
+        """
+        Seconds until the bucket admits again; 0 when it admits now
+        """
+        self._refill()
+        if self.tokens > 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class AdmissionController:
+    def __init__(self, max_inflight=None, max_per_user=None, queue_timeout=None,
+                 user_bytes_per_second=None, user_burst_bytes=None):
+        self._max_inflight = max_inflight
+        self._max_per_user = max_per_user
+        self._queue_timeout = queue_timeout
+        self._user_bytes_per_second = user_bytes_per_second
+        self._user_burst_bytes = user_burst_bytes
+        self._cond = threading.Condition()
+        self._inflight = 0
+        self._waiting = 0
+        self._per_user = defaultdict(int)
+        self._buckets = {}
+        self._admitted = 0
+        self._rejected = defaultdict(int)
+
+    @property
+    def max_inflight(self):
+        return self._max_inflight or _setting('ADMISSION_MAX_INFLIGHT', DEFAULT_MAX_INFLIGHT)
+
+    @property
+    def max_per_user(self):
+        return self._max_per_user or _setting('ADMISSION_MAX_PER_USER', DEFAULT_MAX_PER_USER)
+
+    @property
+    def queue_timeout(self):
+        if self._queue_timeout is not None:
+            return self._queue_timeout
+        return _setting('ADMISSION_QUEUE_TIMEOUT', DEFAULT_QUEUE_TIMEOUT)
+
+    def _bucket(self, user_key):
+        bucket = self._buckets.get(user_key)
+        if bucket is None:
+            if len(self._buckets) >= MAX_BUCKETS:
+                # Full buckets hold no state worth keeping
+                self._buckets = {key: value for key, value in self._buckets.items() if not value.is_full()}
+            bucket = self._buckets[user_key] = TokenBucket(
+                self._user_bytes_per_second or _setting('ADMISSION_USER_BYTES_PER_SECOND', DEFAULT_USER_BYTES_PER_SECOND),
+                self._user_burst_bytes or _setting('ADMISSION_USER_BURST_BYTES', DEFAULT_USER_BURST_BYTES),
+            )
+        return bucket
+
+    def _reject(self, reason, retry_after):
+        self._rejected[reason] += 1
+        raise AdmissionRejected(reason, max(1, math.ceil(retry_after)))
+
+    def admit(self, user_key, request_bytes=0):
+        """
+        Wait up to queue_timeout for a slot
+
+        Args:
+            request_bytes: Bytes the request is known to carry, charged up front
+
+        Raises:
+            AdmissionRejected: If the user is over their limits or no slot freed up in time
+        """
+        with self._cond:
+            bucket = self._bucket(user_key)
+            wait = bucket.wait_time()
+            if wait > 0:
+                self._reject('user_bytes', wait)
+            if self._per_user[user_key] >= self.max_per_user:
+                self._reject('user_concurrency', 1)
+
+            deadline = time.monotonic() + self.queue_timeout
+            self._waiting += 1
+            try:
+                while self._inflight >= self.max_inflight:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._reject('saturated', self.queue_timeout)
+                    self._cond.wait(remaining)
+            finally:
+                self._waiting -= 1
+
+            self._inflight += 1
+            self._per_user[user_key] += 1
+            self._admitted += 1
+            bucket.consume(request_bytes)
+
+    def release(self, user_key, response_bytes=0):
+        with self._cond:
+            self._inflight -= 1
+            self._per_user[user_key] -= 1
+            if not self._per_user[user_key]:
+                del self._per_user[user_key]
+            self._bucket(user_key).consume(response_bytes)
+            self._cond.notify()
+
+    def metrics(self):
+        with self._cond:
+            return {
+                'inflight': self._inflight,
+                'queue_depth': self._waiting,
+                'max_inflight': self.max_inflight,
+                'admitted': self._admitted,
+                'rejected': dict(self._rejected),
+                'active_users': len(self._per_user),
+            }
+
+
+def _content_length(value):
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _rejected_response(e):
+    response = JsonResponse({'status': 'error', 'message': 'Too many transfers in progress, please retry shortly',
+                             'reason': e.reason}, status=429)
+    response['Retry-After'] = str(e.retry_after)
+    return response
+
+
+class AdmissionControlMiddleware:
+    """
+    Admit byte-heavy views through the process-wide AdmissionController
+
+    The slot is taken in process_view and given back once the response is
+    done: at once for ordinary responses, and for streaming ones when the
+    server closes them after sending the body. Under ASGI the wait for a
+    slot happens in a worker thread, off the event loop.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+            self.process_view = self._aprocess_view
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        return self._release_when_done(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self._release_when_done(request, await self.get_response(request))
+
+    @staticmethod
+    def _applies(request, view_func):
+        applies = getattr(view_func, 'byte_heavy', None)
+        return applies is not None and applies(request)
+
+    @staticmethod
+    def _user_key(request, user):
+        return user.pk if user is not None and user.is_authenticated else request.META.get('REMOTE_ADDR')
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not self._applies(request, view_func):
+            return None
+
+        user_key = self._user_key(request, getattr(request, 'user', None))
+        try:
+            admission_controller.admit(user_key, _content_length(request.META.get('CONTENT_LENGTH')))
+        except AdmissionRejected as e:
+            return _rejected_response(e)
+        request._admission_key = user_key
+        return None
+
+    async def _aprocess_view(self, request, view_func, view_args, view_kwargs):
+        if not self._applies(request, view_func):
+            return None
+
+        user = await request.auser() if hasattr(request, 'auser') else None
+        user_key = self._user_key(request, user)
+        try:
+            # Waiting for a slot blocks, so it must not happen on the event loop
+            await sync_to_async(admission_controller.admit, thread_sensitive=False)(
+                user_key, _content_length(request.META.get('CONTENT_LENGTH')))
+        except AdmissionRejected as e:
+            return _rejected_response(e)
+        request._admission_key = user_key
+        return None
+
+    def _release_when_done(self, request, response):
+        if not hasattr(request, '_admission_key'):
+            return response
+        user_key = request.__dict__.pop('_admission_key')
+        released = []
+
+        def release():
+            if not released:
+                released.append(True)
+                admission_controller.release(user_key, _content_length(response.get('Content-Length')))
+
+        if response.streaming:
+            # Hold the slot until the server has sent the body and closed the response
+            response._resource_closers.append(release)
+        else:
+            release()
+        return response
+
+
+admission_controller = AdmissionController()
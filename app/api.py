@@ -0,0 +1,158 @@
+"""
+REST API for sync clients, mounted at /api/v1/
+
+Lists use cursor pagination, newest first, and every endpoint accepts
+?fields=a,b to return (and load from the database) only those fields.
+Writes go through the same helpers as the HTML views, so storage, Firebase
+and cache invalidation behave identically.
+"""
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.http import Http404
+from rest_framework import mixins, status, viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import PermissionDenied, ValidationError
+from rest_framework.pagination import CursorPagination
+from rest_framework.response import Response
+from rest_framework.serializers import ListSerializer
+from rest_framework.views import APIView
+from firebase_integration.database import FirebaseDatabaseService
+from .caching import friends_scope, versioned_key
+from .comments import add_comment
+from .models import File
+from .permissions import can_view_file
+from .serializers import CommentSerializer, FileSerializer, FileShareSerializer, FriendSerializer, UsernameField
+from . import bulk
+from . import sharding
+
+
+class NewestFirstPagination(CursorPagination):
+    ordering = ('-created_at', '-id')
+    page_size = 50
+    page_size_query_param = 'limit'
+    max_page_size = 200
+
+
+class FileViewSet(mixins.ListModelMixin, mixins.RetrieveModelMixin, mixins.DestroyModelMixin,
+                  viewsets.GenericViewSet):
+    """
+    The user's files; /shared/ lists the files shared with them, and each
+    file has /comments/ and, for its owner, /shares/
+    """
+    serializer_class = FileSerializer
+    pagination_class = NewestFirstPagination
+
+    def _only(self, serializer_class=None):
+        serializer_class = serializer_class or self.get_serializer_class()
+        return serializer_class(context=self.get_serializer_context()).model_fields()
+
+    def get_queryset(self):
+        return sharding.owned_files(self.request.user).only(*self._only())
+
+    def get_object(self):
+        try:
+            file_obj = sharding.get_file(self.kwargs['pk'])
+        except (File.DoesNotExist, ValueError):
+            raise Http404
+        if not can_view_file(self.request, file_obj):
+            raise Http404
+        return file_obj
+
+    def _with_usernames(self, serializer, rows, user_field):
+        # One query for all the usernames shown; users may be on another database
+        fields = serializer.child.fields if isinstance(serializer, ListSerializer) else serializer.fields
+        if rows and any(isinstance(field, UsernameField) for field in fields.values()):
+            user_ids = {getattr(row, f'{user_field}_id') for row in rows}
+            serializer.context['usernames'] = dict(User.objects.filter(pk__in=user_ids).values_list('pk', 'username'))
+        return serializer.data
+
+    def _page_response(self, queryset, serializer_class, user_field):
+        page = self.paginate_queryset(queryset)
+        serializer = serializer_class(page, many=True, context=self.get_serializer_context())
+        return self.get_paginated_response(self._with_usernames(serializer, page, user_field))
+
+    def _object_response(self, instance, serializer_class, user_field, status_code=status.HTTP_200_OK):
+        serializer = serializer_class(instance, context=self.get_serializer_context())
+        return Response(self._with_usernames(serializer, [instance], user_field), status=status_code)
+
+    def list(self, request, *args, **kwargs):
+        return self._page_response(self.get_queryset(), FileSerializer, 'user')
+
+    def retrieve(self, request, *args, **kwargs):
+        return self._object_response(self.get_object(), FileSerializer, 'user')
+
+    def destroy(self, request, *args, **kwargs):
+        file_obj = self.get_object()
+        if file_obj.user_id != request.user.pk:
+            raise PermissionDenied('Only the owner can delete a file')
+        [result] = bulk.delete_files(request.user, [file_obj.pk], firebase_uid=request.session.get('firebase_uid'))
+        if result['status'] != 'success':
+            return Response(result, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @action(detail=False)
+    def shared(self, request, *args, **kwargs):
+        fields = self._only()
+        querysets = [queryset.only(*fields) for queryset in sharding.shared_file_querysets(request.user)]
+        queryset = querysets[0] if len(querysets) == 1 else sharding.MergedQuerySet(querysets)
+        return self._page_response(queryset, FileSerializer, 'user')
+
+    @action(detail=True, methods=['get', 'post'], serializer_class=CommentSerializer)
+    def comments(self, request, *args, **kwargs):
+        file_obj = self.get_object()
+
+        if request.method == 'POST':
+            serializer = CommentSerializer(data=request.data, context=self.get_serializer_context())
+            serializer.is_valid(raise_exception=True)
+            comment = add_comment(file_obj, request.user, serializer.validated_data['content'])
+            return self._object_response(comment, CommentSerializer, 'user', status.HTTP_201_CREATED)
+
+        queryset = file_obj.comments.only(*self._only(CommentSerializer))
+        return self._page_response(queryset, CommentSerializer, 'user')
+
+    @action(detail=True, methods=['get', 'post'], serializer_class=FileShareSerializer)
+    def shares(self, request, *args, **kwargs):
+        file_obj = self.get_object()
+        if file_obj.user_id != request.user.pk:
+            raise PermissionDenied('Only the owner can see and change who a file is shared with')
+
+        if request.method == 'POST':
+            serializer = FileShareSerializer(data=request.data, context=self.get_serializer_context())
+            serializer.is_valid(raise_exception=True)
+            try:
+                friend = User.objects.get(username=serializer.validated_data['username'])
+            except User.DoesNotExist:
+                raise ValidationError({'username': 'Friend not found'})
+
+            friend_firebase_uid = FirebaseDatabaseService.get_uid_for_username(friend.username)
+            if not friend_firebase_uid:
+                raise ValidationError({'username': "Friend's Firebase account not found"})
+
+            bulk.share_files(request.user, [file_obj.pk], friend, friend_firebase_uid,
+                             owner_firebase_uid=request.session.get('firebase_uid'))
+            share = file_obj.shares.get(grantee=friend)
+            return self._object_response(share, FileShareSerializer, 'grantee', status.HTTP_201_CREATED)
+
+        queryset = file_obj.shares.only(*self._only(FileShareSerializer))
+        return self._page_response(queryset, FileShareSerializer, 'grantee')
+
+
+class FriendListView(APIView):
+    """
+    The user's friends, from Firebase, cached until their friend list changes
+    """
+
+    def get(self, request, *args, **kwargs):
+        firebase_uid = request.session.get('firebase_uid')
+        if not firebase_uid:
+            return Response({'results': []})
+
+        key = versioned_key(friends_scope(firebase_uid), 'api')
+        friends = cache.get(key)
+        if friends is None:
+            friends = FirebaseDatabaseService.get_friends(firebase_uid)
+            cache.set(key, friends, getattr(settings, 'FRAGMENT_CACHE_TIMEOUT', 600))
+
+        return Response({'results': FriendSerializer(friends, many=True).data})
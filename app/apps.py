@@ -3,4 +3,8 @@ from django.apps import AppConfig
 class AppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'app'
-    verbose_name = "Secure File Sharing App"
\ No newline at end of file
+    verbose_name = "Secure File Sharing App"
+
+    def ready(self):
+        # Connects the receivers that keep the search index current and send notifications
+        from . import search, signals
\ No newline at end of file
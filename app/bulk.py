@@ -0,0 +1,189 @@
+"""
+Bulk file operations
+
+Each operation checks ownership of all the requested files with one query,
+changes the database in one transaction, and queues every Firebase change
+as a single multi-path (fan-out) update through the outbox. Results are
+reported per file, in the order the ids were given.
+"""
+
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from .caching import bump_on_commit, user_scope
+from .models import FileShare
+from .notifications import notify
+from . import sharding
+from . import storage
+from firebase_integration import outbox
+
+MAX_BULK_FILES = 1000
+DEFAULT_DELETE_WORKERS = 8
+
+NOT_FOUND_MESSAGE = "File not found or you don't have permission"
+
+_delete_pool = None
+
+
+def _pool():
+    global _delete_pool
+    if _delete_pool is None:
+        _delete_pool = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'BULK_DELETE_WORKERS', DEFAULT_DELETE_WORKERS),
+            thread_name_prefix='bulk-delete',
+        )
+    return _delete_pool
+
+
+def parse_file_ids(values):
+    """
+    Parse requested file ids, dropping duplicates but keeping their order
+
+    Raises:
+        ValueError: If an id is not an integer or there are too many
+    """
+    file_ids = []
+    for value in values:
+        try:
+            file_id = int(value)
+        except (TypeError, ValueError):
+            raise ValueError(f'Invalid file ID: {value}')
+        if file_id not in file_ids:
+            file_ids.append(file_id)
+
+    if len(file_ids) > MAX_BULK_FILES:
+        raise ValueError(f'At most {MAX_BULK_FILES} files can be changed at once')
+    return file_ids
+
+
+def _results(file_ids, done, failures=None):
+    failures = failures or {}
+    results = []
+    for file_id in file_ids:
+        if file_id in failures:
+            results.append({'file_id': file_id, 'status': 'error', 'message': failures[file_id]})
+        elif file_id in done:
+            results.append({'file_id': file_id, 'status': 'success'})
+        else:
+            results.append({'file_id': file_id, 'status': 'error', 'message': NOT_FOUND_MESSAGE})
+    return results
+
+
+def _remove_from_disk(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def delete_files(user, file_ids, firebase_uid=None):
+    """
+    Delete those of file_ids the user owns
+
+    The rows go first, in one transaction; the stored files are then removed
+    from disk in a worker pool. A file that could not be removed from disk
+    is still deleted, and reported with its error.
+
+    Returns:
+        list: One result dict per requested id
+    """
+    owned = sharding.owned_files(user)
+    files = list(owned.filter(pk__in=file_ids).only('id', 'file_path', 'size_bytes', 'user_id'))
+    found_ids = [file_obj.pk for file_obj in files]
+    if not files:
+        return _results(file_ids, set())
+
+    shares = list(FileShare.objects.using(owned.db).filter(file_id__in=found_ids)
+                  .values_list('file_id', 'grantee_id', 'grantee_firebase_uid'))
+
+    paths = {}
+    for file_id in found_ids:
+        paths[f'files/{file_id}'] = None
+        if firebase_uid:
+            paths[f'users/{firebase_uid}/files/{file_id}'] = None
+    for file_id, _, grantee_uid in shares:
+        if grantee_uid:
+            paths[f'users/{grantee_uid}/shared_with_me/{file_id}'] = None
+
+    with sharding.atomic_for_user(user):
+        sharding.delete_files(user, found_ids)
+        storage.release(user, sum(file_obj.size_bytes for file_obj in files))
+        outbox.enqueue_update(paths)
+        grantee_ids = {grantee_id for _, grantee_id, _ in shares}
+        bump_on_commit(*[user_scope(user_id) for user_id in {user.pk} | grantee_ids])
+
+    futures = {file_obj.pk: _pool().submit(_remove_from_disk, file_obj.file_path.path) for file_obj in files}
+    failures = {}
+    for file_id, future in futures.items():
+        try:
+            future.result()
+        except OSError as e:
+            print(f"Error removing file {file_id} from disk: {e}")
+            failures[file_id] = f'Deleted, but the stored file could not be removed: {e}'
+
+    return _results(file_ids, set(found_ids), failures)
+
+
+def share_files(user, file_ids, friend, friend_firebase_uid, owner_firebase_uid=None):
+    """
+    Share those of file_ids the user owns with friend
+
+    Sharing a file again refreshes the friend's Firebase UID on the existing
+    share, without notifying the friend a second time. Each file's
+    shared_with list in Firebase is rewritten from the local shares, so no
+    file has to be read from Firebase first.
+
+    Returns:
+        list: One result dict per requested id
+    """
+    owned = sharding.owned_files(user)
+    names = dict(owned.filter(pk__in=file_ids).values_list('id', 'file_name'))
+    if not names:
+        return _results(file_ids, set())
+
+    with sharding.atomic_for_user(user):
+        already_shared = set(FileShare.objects.using(owned.db).filter(file_id__in=names, grantee=friend)
+                             .values_list('file_id', flat=True))
+        new_names = {file_id: file_name for file_id, file_name in names.items() if file_id not in already_shared}
+        FileShare.objects.using(owned.db).bulk_create(
+            [FileShare(file_id=file_id, grantee=friend, grantee_firebase_uid=friend_firebase_uid) for file_id in names],
+            update_conflicts=True,
+            unique_fields=['file', 'grantee'],
+            update_fields=['grantee_firebase_uid'],
+        )
+
+        shared_with = {file_id: [] for file_id in names}
+        grantees = (FileShare.objects.using(owned.db).filter(file_id__in=names)
+                    .exclude(grantee_firebase_uid='').order_by('created_at', 'id')
+                    .values_list('file_id', 'grantee_firebase_uid'))
+        for file_id, grantee_uid in grantees:
+            shared_with[file_id].append(grantee_uid)
+
+        paths = {}
+        for file_id in names:
+            paths[f'files/{file_id}/shared_with'] = shared_with[file_id]
+            paths[f'users/{friend_firebase_uid}/shared_with_me/{file_id}'] = True
+        for file_id, file_name in new_names.items():
+            # Keyed up front, so a retried update does not notify twice
+            paths[f'users/{friend_firebase_uid}/notifications/{uuid.uuid4().hex}'] = {
+                'type': 'file_shared',
+                'file_id': str(file_id),
+                'file_name': file_name,
+                'shared_by': owner_firebase_uid,
+                'timestamp': {'.sv': 'timestamp'},
+            }
+        outbox.enqueue_update(paths)
+
+        # bulk_create sends no post_save, so notify here; the dispatcher coalesces them
+        for file_id, file_name in new_names.items():
+            notify([friend.pk], {
+                'type': 'file_shared',
+                'title': 'File shared',
+                'message': f"File '{file_name}' has been shared with you.",
+                'file_id': file_id,
+            }, using=owned.db)
+
+        bump_on_commit(user_scope(user.pk), user_scope(friend.pk))
+
+    return _results(file_ids, set(names))
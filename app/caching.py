@@ -0,0 +1,62 @@
+"""
+Generation-keyed caching
+
+Every cache key for a scope, such as one file's comment thread, includes
+that scope's version counter. Bumping the counter makes all existing
+entries for the scope unreachable, so they are never served again and
+simply expire.
+"""
+
+import time
+from django.core.cache import cache
+from django.db import transaction
+
+
+def _version_key(scope):
+    return f'version:{scope}'
+
+
+def get_version(scope):
+    key = _version_key(scope)
+    version = cache.get(key)
+    if version is None:
+        # Start from the clock rather than 1, so a counter that was evicted
+        # never comes back with a number whose entries are still cached
+        cache.add(key, time.time_ns(), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(scope):
+    key = _version_key(scope)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        cache.add(key, time.time_ns(), None)
+        return cache.get(key)
+
+
+def bump_on_commit(*scopes, using=None):
+    """
+    Bump the versions of scopes once the current transaction commits, so no
+    reader can cache data from before the change under the new version
+    """
+    transaction.on_commit(lambda: [bump_version(scope) for scope in scopes], using=using)
+
+
+def user_scope(user_id):
+    """
+    Scope of a user's dashboard: the files they own and the files shared with them
+    """
+    return f'user:{user_id}'
+
+
+def friends_scope(firebase_uid):
+    return f'friends:{firebase_uid}'
+
+
+def versioned_key(scope, *parts):
+    """
+    A cache key for scope that changes whenever the scope's version is bumped
+    """
+    return ':'.join([scope, str(get_version(scope))] + [str(part) for part in parts])
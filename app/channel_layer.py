@@ -0,0 +1,425 @@
+"""
+Channel layer shared by the worker processes on one host, without Redis
+
+A hub process (python manage.py run_channel_hub) listens on a Unix socket
+and every worker connects to it, once per event loop. The hub keeps group
+membership and the queues of general channels. Messages for a worker's own
+channels are not queued at the hub: each connection registers a prefix, and
+the hub pushes messages for "specific.<prefix>!..." channels straight down
+that connection, so a consumer's receive() never waits on a round trip.
+
+Semantics follow InMemoryChannelLayer:
+
+- messages expire after `expiry` seconds, and group memberships after
+  `group_expiry` seconds;
+- channels hold at most `capacity` messages (or their `channel_capacity`),
+  and further messages are dropped; send() raises ChannelFull for general
+  channels, whose queues are at the hub, while sends to specific channels
+  and group sends do not wait for the hub to answer;
+- when a worker disconnects, its channels leave every group at once.
+
+Frames are msgpack, each preceded by its length as a 4-byte big-endian int.
+A connection that is lost is reopened on next use, under the same prefix
+and with its group memberships restored.
+"""
+
+import asyncio
+import itertools
+import os
+import random
+import string
+import struct
+import time
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer, InMemoryChannelLayer
+
+DEFAULT_SOCKET_PATH = '/tmp/filesharing-channels.sock'
+# Bytes a worker may fall behind on before the hub drops messages pushed to it
+DEFAULT_MAX_BUFFER = 4 * 1024 * 1024
+
+_HEADER = struct.Struct('>I')
+
+
+def _msgpack():
+    # channels_redis depends on msgpack, so it is installed with the project
+    import msgpack
+    return msgpack
+
+
+def _random_name(length=12):
+    return ''.join(random.choice(string.ascii_letters) for _ in range(length))
+
+
+def _prefix(channel):
+    """
+    The connection prefix of a specific channel, or None for a general channel
+    """
+    if '!' not in channel:
+        return None
+    return channel[:channel.index('!')].rsplit('.', 1)[-1]
+
+
+async def _read_frame(reader):
+    header = await reader.readexactly(_HEADER.size)
+    return _msgpack().unpackb(await reader.readexactly(_HEADER.unpack(header)[0]), raw=False)
+
+
+def _write_frame(writer, frame):
+    payload = _msgpack().packb(frame, use_bin_type=True)
+    writer.write(_HEADER.pack(len(payload)) + payload)
+
+
+class ChannelHub:
+    """
+    The hub: routes messages between the workers connected to its socket
+    """
+
+    def __init__(self, path=DEFAULT_SOCKET_PATH, expiry=60, group_expiry=86400, capacity=100,
+                 channel_capacity=None, max_buffer=DEFAULT_MAX_BUFFER):
+        self.path = path
+        self.max_buffer = max_buffer
+        # Holds the general channels' queues and every group, with their expiry
+        self.store = InMemoryChannelLayer(expiry=expiry, group_expiry=group_expiry, capacity=capacity)
+        self.store.channel_capacity = self.store.compile_capacities(channel_capacity or {})
+        self.connections = {}
+        self.dropped = 0
+        self._server = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._server = await asyncio.start_unix_server(self._serve, path=self.path)
+        return self
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+        # Connections first: wait_closed() waits for them
+        for writer in list(self.connections.values()):
+            writer.close()
+        if self._server is not None:
+            await self._server.wait_closed()
+
+    def _push(self, prefix, channels, message):
+        writer = self.connections.get(prefix)
+        if writer is None or writer.is_closing():
+            # The worker is gone, and its channels with it
+            return False
+        if writer.transport.get_write_buffer_size() > self.max_buffer:
+            self.dropped += 1
+            return False
+        _write_frame(writer, ['msg', channels, message])
+        return True
+
+    async def _send(self, channel, message):
+        prefix = _prefix(channel)
+        if prefix is None:
+            await self.store.send(channel, message)
+        else:
+            self._push(prefix, [channel], message)
+
+    async def _group_send(self, group, message):
+        self.store._clean_expired()
+        by_prefix = {}
+        for channel in self.store.groups.get(group, {}):
+            prefix = _prefix(channel)
+            if prefix is None:
+                try:
+                    await self.store.send(channel, message)
+                except ChannelFull:
+                    pass
+            else:
+                by_prefix.setdefault(prefix, []).append(channel)
+        # One frame per worker, however many of its channels are in the group
+        for prefix, channels in by_prefix.items():
+            self._push(prefix, channels, message)
+
+    async def _handle(self, writer, tasks, frame):
+        op, request_id, args = frame[0], frame[1], frame[2:]
+        try:
+            if op == 'send':
+                result = await self._send(*args)
+            elif op == 'group_send':
+                result = await self._group_send(*args)
+            elif op == 'group_add':
+                result = await self.store.group_add(*args)
+            elif op == 'group_discard':
+                result = await self.store.group_discard(*args)
+            elif op == 'receive':
+                result = await self.store.receive(*args)
+            elif op == 'flush':
+                result = await self.store.flush()
+            else:
+                raise ValueError(f'Unknown operation {op!r}')
+            reply = ['ok', request_id, result]
+        except asyncio.CancelledError:
+            # Tells the worker the cancel won, so it can stop waiting for a late answer
+            reply = ['err', request_id, 'CancelledError', '']
+        except Exception as e:
+            reply = ['err', request_id, type(e).__name__, str(e)]
+        finally:
+            tasks.pop(request_id, None)
+        if request_id is not None and not writer.is_closing():
+            _write_frame(writer, reply)
+
+    async def _serve(self, reader, writer):
+        prefix = None
+        tasks = {}
+        try:
+            op, request_id, prefix = await _read_frame(reader)
+            if op != 'hello':
+                return
+            previous = self.connections.get(prefix)
+            if previous is not None and previous is not writer:
+                previous.close()
+            self.connections[prefix] = writer
+            _write_frame(writer, ['ok', request_id, None])
+
+            while True:
+                frame = await _read_frame(reader)
+                if frame[0] == 'cancel':
+                    task = tasks.pop(frame[1], None)
+                    if task is not None:
+                        task.cancel()
+                elif frame[0] == 'receive':
+                    # Waits for a message, so it must not hold up the frames behind it
+                    tasks[frame[1]] = asyncio.ensure_future(self._handle(writer, tasks, frame))
+                else:
+                    # Never waits, so it is handled in order without a task
+                    await self._handle(writer, tasks, frame)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, asyncio.CancelledError):
+            # The worker went away, sent garbage, or the hub is shutting down
+            pass
+        finally:
+            for task in tasks.values():
+                task.cancel()
+            if prefix is not None and self.connections.get(prefix) is writer:
+                del self.connections[prefix]
+                self._forget(prefix)
+            writer.close()
+
+    def _forget(self, prefix):
+        for group, channels in list(self.store.groups.items()):
+            for channel in [channel for channel in channels if _prefix(channel) == prefix]:
+                del channels[channel]
+            if not channels:
+                del self.store.groups[group]
+
+
+class _Connection:
+    """
+    One event loop's connection to the hub, and the queues of its specific channels
+    """
+
+    def __init__(self, layer, prefix):
+        self.layer = layer
+        self.prefix = prefix
+        self.queues = {}
+        self.groups = set()
+        self.pending = {}
+        # Receives cancelled here that the hub may already have answered
+        self.cancelled = {}
+        self.request_ids = itertools.count()
+        self.writer = None
+        self.reader_task = None
+        self.lock = asyncio.Lock()
+
+    async def ensure_open(self):
+        if self.writer is not None and not self.writer.is_closing():
+            return
+        async with self.lock:
+            if self.writer is not None and not self.writer.is_closing():
+                return
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_unix_connection(self.layer.path), self.layer.connect_timeout)
+            _write_frame(writer, ['hello', 0, self.prefix])
+            await _read_frame(reader)
+            # Rejoin the groups of a connection that was lost
+            for group, channel in self.groups:
+                _write_frame(writer, ['group_add', next(self.request_ids), group, channel])
+            await writer.drain()
+            self.writer = writer
+            self.reader_task = asyncio.ensure_future(self._read(reader, writer))
+
+    async def _read(self, reader, writer):
+        try:
+            while True:
+                frame = await _read_frame(reader)
+                if frame[0] == 'msg':
+                    self._deliver(frame[1], frame[2])
+                    continue
+                channel = self.cancelled.pop(frame[1], None)
+                if channel is not None and frame[0] == 'ok':
+                    # Too late to cancel: hand the message back instead of losing it
+                    _write_frame(writer, ['send', next(self.request_ids), channel, frame[2]])
+                    continue
+                future = self.pending.pop(frame[1], None)
+                if future is not None and not future.done():
+                    if frame[0] == 'ok':
+                        future.set_result(frame[2])
+                    else:
+                        future.set_exception(self.layer._error(frame[2], frame[3]))
+        except Exception as e:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f'Lost the channel hub connection: {e!r}'))
+            self.pending.clear()
+        finally:
+            writer.close()
+
+    def _queue(self, channel):
+        queue = self.queues.get(channel)
+        if queue is None:
+            queue = self.queues[channel] = asyncio.Queue(maxsize=self.layer.get_capacity(channel))
+        return queue
+
+    def _deliver(self, channels, message):
+        expires = time.time() + self.layer.expiry
+        for channel in channels:
+            try:
+                self._queue(channel).put_nowait((expires, message))
+            except asyncio.QueueFull:
+                self.layer.dropped += 1
+
+    async def call(self, op, *args):
+        await self.ensure_open()
+        request_id = next(self.request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        _write_frame(self.writer, [op, request_id, *args])
+        try:
+            await self.writer.drain()
+            return await future
+        except asyncio.CancelledError:
+            # Tell the hub, so a cancelled receive() does not take a message
+            self.pending.pop(request_id, None)
+            if op == 'receive' and not self.writer.is_closing():
+                self.cancelled[request_id] = args[0]
+                _write_frame(self.writer, ['cancel', request_id])
+            raise
+
+    async def cast(self, op, *args):
+        """
+        Send an operation that has no result, without waiting for the hub to answer
+        """
+        await self.ensure_open()
+        _write_frame(self.writer, [op, None, *args])
+        await self.writer.drain()
+
+    async def receive_local(self, channel):
+        queue = self._queue(channel)
+        try:
+            while True:
+                expires, message = await queue.get()
+                if expires >= time.time():
+                    return message
+        finally:
+            if queue.empty() and self.queues.get(channel) is queue:
+                del self.queues[channel]
+
+
+class UnixSocketChannelLayer(BaseChannelLayer):
+    """
+    Channel layer backed by a ChannelHub on a Unix socket; see the module docstring
+
+    CONFIG: path (the hub's socket), expiry, group_expiry, capacity,
+    channel_capacity and connect_timeout.
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, path=DEFAULT_SOCKET_PATH, expiry=60, group_expiry=86400, capacity=100,
+                 channel_capacity=None, connect_timeout=5, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, **kwargs)
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        self.path = path
+        self.group_expiry = group_expiry
+        self.connect_timeout = connect_timeout
+        self.process_prefix = _random_name()
+        self.dropped = 0
+        self._connections = {}
+
+    @staticmethod
+    def _error(name, text):
+        if name == 'ChannelFull':
+            return ChannelFull(text)
+        if name == 'TypeError':
+            return TypeError(text)
+        return RuntimeError(f'{name}: {text}')
+
+    def _connection(self):
+        loop = asyncio.get_running_loop()
+        connection = self._connections.get(loop)
+        if connection is None:
+            # async_to_sync runs calls on short-lived loops; forget theirs
+            for other in [other for other in self._connections if other.is_closed()]:
+                del self._connections[other]
+            connection = self._connections[loop] = _Connection(
+                self, f'{self.process_prefix}{len(self._connections)}{_random_name(4)}')
+        return connection
+
+    async def new_channel(self, prefix='specific.'):
+        connection = self._connection()
+        await connection.ensure_open()
+        return f'{prefix}{connection.prefix}!{_random_name()}'
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_channel_name(channel)
+        connection = self._connection()
+        prefix = _prefix(channel)
+        if prefix == connection.prefix:
+            connection._deliver([channel], message)
+        elif prefix is not None:
+            # Pushed to the worker without a queue at the hub, so there is nothing to wait for
+            await connection.cast('send', channel, message)
+        else:
+            await connection.call('send', channel, message)
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        connection = self._connection()
+        if _prefix(channel) is None:
+            return await connection.call('receive', channel)
+        if _prefix(channel) != connection.prefix:
+            raise RuntimeError(f'{channel} belongs to another connection and cannot be received here')
+        await connection.ensure_open()
+        return await connection.receive_local(channel)
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        connection = self._connection()
+        await connection.call('group_add', group, channel)
+        if _prefix(channel) == connection.prefix:
+            connection.groups.add((group, channel))
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        connection = self._connection()
+        connection.groups.discard((group, channel))
+        await connection.call('group_discard', group, channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'Message is not a dict'
+        self.require_valid_group_name(group)
+        # Full channels are skipped, as in the in-memory layer, so there is no answer to wait for
+        await self._connection().cast('group_send', group, message)
+
+    async def flush(self):
+        connection = self._connection()
+        connection.queues.clear()
+        connection.groups.clear()
+        await connection.call('flush')
+
+    async def close(self):
+        connection = self._connections.pop(asyncio.get_running_loop(), None)
+        if connection is not None and connection.writer is not None:
+            connection.writer.close()
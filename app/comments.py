@@ -0,0 +1,89 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import router, transaction
+from django.db.models import F, Q
+from django.template.loader import render_to_string
+from .caching import bump_version, versioned_key
+from .listing import decode_cursor, encode_cursor
+from .models import File
+from .sharding import lock_user_shard
+
+COMMENT_PAGE_SIZE = 20
+DEFAULT_THREAD_CACHE_TIMEOUT = 300
+
+
+def thread_scope(file_id):
+    return f'comments:{file_id}'
+
+
+def add_comment(file_obj, user, content):
+    """
+    Add a comment and keep the file's comment_count in step with it
+
+    Cached pages of the thread are invalidated once the comment is committed.
+    """
+    db = router.db_for_write(File, instance=file_obj)
+
+    with transaction.atomic(), transaction.atomic(using=db):
+        # Holds off a move of the file's owner to another shard until the comment is in
+        lock_user_shard(file_obj.user_id)
+        comment = file_obj.comments.create(user=user, content=content)
+        File.objects.using(db).filter(pk=file_obj.pk).update(comment_count=F('comment_count') + 1)
+        transaction.on_commit(lambda: bump_version(thread_scope(file_obj.pk)), using=db)
+
+    return comment
+
+
+def thread_page(file_obj, cursor=None, limit=COMMENT_PAGE_SIZE):
+    """
+    Return one page of a file's comments, newest first, using keyset pagination
+
+    Returns:
+        tuple: (list of dicts with id, username, content and created_at,
+            next cursor or None)
+    """
+    queryset = file_obj.comments.all()
+
+    if cursor:
+        try:
+            created_at, pk = decode_cursor(cursor, 'created_at')
+        except ValueError:
+            pass
+        else:
+            queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+
+    rows = list(queryset.order_by('-created_at', '-id').values('id', 'user_id', 'content', 'created_at')[:limit + 1])
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['created_at'], rows[-1]['id'])
+
+    # One query for all the authors; they live on the primary even when comments are sharded
+    usernames = dict(User.objects.filter(pk__in={row['user_id'] for row in rows}).values_list('pk', 'username'))
+    for row in rows:
+        row['username'] = usernames.get(row.pop('user_id'), '')
+
+    return rows, next_cursor
+
+
+def render_thread_page(file_obj, cursor=None, limit=COMMENT_PAGE_SIZE):
+    """
+    Render one page of a file's comments, served from the cache when unchanged
+
+    Returns:
+        tuple: (HTML of the page, next cursor or None)
+    """
+    key = versioned_key(thread_scope(file_obj.pk), cursor or '', limit)
+    page = cache.get(key)
+
+    if page is None:
+        comments, next_cursor = thread_page(file_obj, cursor=cursor, limit=limit)
+        page = {
+            'html': render_to_string('comment_thread.html', {'comments': comments}),
+            'next_cursor': next_cursor,
+        }
+        cache.set(key, page, getattr(settings, 'COMMENT_THREAD_CACHE_TIMEOUT', DEFAULT_THREAD_CACHE_TIMEOUT))
+
+    return page['html'], page['next_cursor']
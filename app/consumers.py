@@ -1,122 +1,318 @@
 from channels.generic.websocket import AsyncWebsocketConsumer
 from django.contrib.auth import get_user_model
 from channels.db import database_sync_to_async
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from .admission import TokenBucket
+from .models import File
+from .notifications import current_seq, dispatcher, replay, user_group
+from .permissions import can_view_file
+from . import sharding
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+import asyncio
 import json
+import logging
 
 User = get_user_model()
+logger = logging.getLogger(__name__)
+
+DEFAULT_FLUSH_SECONDS = 0.05
+DEFAULT_MAX_BATCH = 100
+DEFAULT_INBOUND_RATE = 20
+DEFAULT_INBOUND_BURST = 40
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+class EventBatcher:
+    """
+    Collects events and hands them on as one batch per flush window
+
+    Events are kept in lists by key; events added with a dedupe_key that is
+    already waiting are folded into the waiting one, whose count goes up.
+    A batch goes out WS_FLUSH_SECONDS after its first event, or as soon as
+    WS_MAX_BATCH events are waiting.
+    """
+
+    def __init__(self, deliver, window=None, max_batch=None):
+        self.deliver = deliver
+        self.window = _setting('WS_FLUSH_SECONDS', DEFAULT_FLUSH_SECONDS) if window is None else window
+        self.max_batch = max_batch or _setting('WS_MAX_BATCH', DEFAULT_MAX_BATCH)
+        self.batches = 0
+        self.closed = False
+        self._events = {}
+        self._waiting = {}
+        self._size = 0
+        self._timer = None
+
+    def add(self, key, event, dedupe_key=None):
+        if self.closed:
+            return
+        if dedupe_key is not None:
+            waiting = self._waiting.setdefault(key, {})
+            if dedupe_key in waiting:
+                waiting[dedupe_key]['count'] += event.get('count', 1)
+                return
+            event = waiting[dedupe_key] = dict(event, count=event.get('count', 1))
+
+        self._events.setdefault(key, []).append(event)
+        self._size += 1
+        if self._size >= self.max_batch:
+            self._schedule(0)
+        elif self._timer is None:
+            self._schedule(self.window)
+
+    def _schedule(self, delay):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(delay, lambda: asyncio.ensure_future(self.flush()))
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._events or self.closed:
+            return
+        batch = self._events
+        self._events, self._waiting, self._size = {}, {}, 0
+        self.batches += 1
+        await self.deliver(batch)
+
+    def close(self):
+        self.closed = True
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+
+def _activity_key(event):
+    return (event.get('file_id'), event.get('activity'), event.get('user_id'))
+
 
 class NotificationConsumer(AsyncWebsocketConsumer):
+    """
+    A user's notifications and file activity
+
+    Outgoing events are batched per connection: each frame carries the
+    notifications and activity of one flush window, as {"notifications":
+    [...], "activity": [...]}, with repeated activity on the same file
+    collapsed into one entry with a count. Activity from the client is
+    rate limited and broadcast to the group in batches too.
+
+    The first frame carries the seq of the user's latest notification. A
+    client that reconnects with ?last_seq=<the highest seq it saw> gets the
+    notifications it missed in that frame, or {"resync": true} when they
+    are no longer buffered.
+    """
+
     async def connect(self):
         # Get username from URL route
         self.username = self.scope['url_route']['kwargs']['username']
         
         try:
-            # Get the user from the username
-            self.user = await self.get_user_by_username(self.username)
-            if not self.user:
-                # Reject the connection if user doesn't exist
+            # Only the signed-in user may listen to their own notifications
+            self.user = self.scope.get('user')
+            if self.user is None or not self.user.is_authenticated or self.user.username != self.username:
                 await self.close()
                 return
-                
-            self.group_name = f"user_{self.user.id}"
+            
+            # Notifications for this process's sockets are dispatched on this loop
+            dispatcher.attach(asyncio.get_running_loop())
+            
+            self.outbox = EventBatcher(self.send_frame)
+            self.broadcasts = EventBatcher(self.broadcast_activity)
+            self.inbound = TokenBucket(_setting('WS_INBOUND_RATE', DEFAULT_INBOUND_RATE),
+                                       _setting('WS_INBOUND_BURST', DEFAULT_INBOUND_BURST))
+            self.throttled = 0
     
-            # Join room group
+            # Join room group; set last, since disconnect() cleans up once it is set
+            self.group_name = user_group(self.user.id)
             await self.channel_layer.group_add(
                 self.group_name,
                 self.channel_name
             )
     
             await self.accept()
-        except Exception as e:
-            print(f"Error in WebSocket connection: {str(e)}")
+            # After joining, so nothing sent meanwhile falls between the replay and the group
+            await self.resume(self.requested_seq())
+        except Exception:
+            logger.exception("Error in WebSocket connection for %s", self.username)
             await self.close()
 
+    def requested_seq(self):
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        try:
+            return int(query['last_seq'][0])
+        except (KeyError, ValueError):
+            return None
+
+    async def resume(self, last_seq):
+        """
+        Send the client the seq to resume from next time, and what it missed
+        since last_seq; if the buffer no longer goes back that far, tell it to resync
+        """
+        self.replayed_to = None
+        if last_seq is None:
+            frame = {'seq': await sync_to_async(current_seq)(self.user.id)}
+        else:
+            missed, self.replayed_to = await sync_to_async(replay)(self.user.id, last_seq)
+            if missed is None:
+                frame = {'seq': self.replayed_to, 'resync': True}
+            else:
+                frame = {'seq': self.replayed_to, 'notifications': missed}
+        await self.send(text_data=json.dumps(frame))
+
     async def disconnect(self, close_code):
         # Leave room group
         if hasattr(self, 'group_name'):
+            self.outbox.close()
+            # Activity the client sent before leaving still reaches the group
+            await self.broadcasts.flush()
+            self.broadcasts.close()
             await self.channel_layer.group_discard(
                 self.group_name,
                 self.channel_name
             )
 
     async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-        message = text_data_json.get('message', '')
+        # Over the rate, messages are dropped and the client told how many
+        if self.inbound.wait_time() > 0:
+            self.throttled += 1
+            self.outbox.add('errors', {'type': 'rate_limited'}, dedupe_key='rate_limited')
+            return
+        self.inbound.consume(1)
+
+        try:
+            text_data_json = json.loads(text_data)
+        except ValueError:
+            return
 
         # Handle incoming messages
-        if 'type' in text_data_json:
+        if isinstance(text_data_json, dict) and 'type' in text_data_json:
             message_type = text_data_json['type']
             
             if message_type == 'file_activity':
-                # Handle file activity tracking
-                await self.channel_layer.group_send(
-                    self.group_name,
-                    {
-                        'type': 'file_activity',
-                        'file_id': text_data_json.get('file_id', ''),
-                        'activity': text_data_json.get('activity', ''),
-                        'user_id': self.user.id
-                    }
-                )
+                # Handle file activity tracking; broadcast with the rest of this window's activity
+                activity = {
+                    'file_id': text_data_json.get('file_id', ''),
+                    'activity': text_data_json.get('activity', ''),
+                    'user_id': self.user.id
+                }
+                self.broadcasts.add('activity', activity, dedupe_key=_activity_key(activity))
 
-    async def send_notification(self, event):
-        notification = event['notification']
+    async def broadcast_activity(self, batch):
+        await self.channel_layer.group_send(
+            self.group_name,
+            {
+                'type': 'file_activity_batch',
+                'activities': batch['activity'],
+            }
+        )
 
-        # Send notification to WebSocket
-        await self.send(text_data=json.dumps({
-            'notification': notification
-        }))
+    async def send_frame(self, batch):
+        await self.send(text_data=json.dumps(batch))
+
+    def queue_notification(self, notification):
+        # Skip what the client already got in the replay
+        if self.replayed_to is None or notification.get('seq', self.replayed_to + 1) > self.replayed_to:
+            self.outbox.add('notifications', notification)
+
+    async def send_notification(self, event):
+        self.queue_notification(event['notification'])
+    
+    async def send_notifications(self, event):
+        # Notifications coalesced by the dispatcher
+        for notification in event['notifications']:
+            self.queue_notification(notification)
         
     async def file_activity(self, event):
         # Send file activity updates to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'file_activity',
+        activity = {
             'file_id': event['file_id'],
             'activity': event['activity'],
             'user_id': event['user_id']
-        }))
-        
-    @database_sync_to_async
-    def get_user_by_username(self, username):
-        try:
-            return User.objects.get(username=username)
-        except User.DoesNotExist:
-            return None
+        }
+        self.outbox.add('activity', activity, dedupe_key=_activity_key(activity))
+    
+    async def file_activity_batch(self, event):
+        for activity in event['activities']:
+            self.outbox.add('activity', activity, dedupe_key=_activity_key(activity))
+
+
+def secure_user_group(user_id):
+    return f'secure_user_{user_id}'
+
+
+def file_group(file_id):
+    return f'secure_file_{file_id}'
 
 
 class SecureFileConsumer(AsyncWebsocketConsumer):
+    """
+    Share events for the signed-in user and the files they watch
+
+    Each connection joins its user's group, and the group of each file the
+    client subscribes to and may view. A share is delivered to the grantee
+    and to the file's watchers only, so an event costs one send per
+    recipient however many clients are connected.
+    """
+
     async def connect(self):
-        # Accept all connections for now
+        self.user = self.scope.get('user')
+        if self.user is None or not self.user.is_authenticated:
+            # Reject anonymous connections
+            await self.close()
+            return
+
+        self.joined = {secure_user_group(self.user.pk)}
+        await self.channel_layer.group_add(secure_user_group(self.user.pk), self.channel_name)
         await self.accept()
-        
-        # Join the secure-file group
-        await self.channel_layer.group_add(
-            "secure_file",
-            self.channel_name
-        )
 
     async def disconnect(self, close_code):
-        # Leave secure-file group
-        await self.channel_layer.group_discard(
-            "secure_file",
-            self.channel_name
-        )
+        # Leave every group joined
+        for group in getattr(self, 'joined', ()):
+            await self.channel_layer.group_discard(group, self.channel_name)
 
     async def receive(self, text_data):
-        data = json.loads(text_data)
-        
-        # Handle incoming messages, e.g., file sharing events
-        if data.get('type') == 'file_shared':
-            # Broadcast to all connected clients
-            await self.channel_layer.group_send(
-                "secure_file",
-                {
-                    'type': 'file_shared_notification',
-                    'file_id': data.get('file_id'),
-                    'shared_by': data.get('shared_by'),
-                    'shared_with': data.get('shared_with')
-                }
-            )
+        try:
+            data = json.loads(text_data)
+        except ValueError:
+            return
+        if not isinstance(data, dict):
+            return
+        message_type = data.get('type')
+
+        if message_type == 'subscribe':
+            # Watch a file, if the user may see it
+            file_obj = await self.get_viewable_file(data.get('file_id'))
+            if file_obj is not None:
+                self.joined.add(file_group(file_obj.pk))
+                await self.channel_layer.group_add(file_group(file_obj.pk), self.channel_name)
+
+        elif message_type == 'unsubscribe':
+            group = file_group(data.get('file_id'))
+            if group in self.joined:
+                self.joined.discard(group)
+                await self.channel_layer.group_discard(group, self.channel_name)
+
+        elif message_type == 'file_shared':
+            # Only the owner announces a share, and only one that exists
+            share = await self.get_share(data.get('file_id'), data.get('shared_with'))
+            if share is None:
+                return
+            file_obj, grantee = share
+            event = {
+                'type': 'file_shared_notification',
+                'file_id': file_obj.pk,
+                'shared_by': self.user.username,
+                'shared_with': grantee.username,
+            }
+            # The grantee, and whoever is watching the file
+            for group in (secure_user_group(grantee.pk), file_group(file_obj.pk)):
+                await self.channel_layer.group_send(group, event)
 
     async def file_shared_notification(self, event):
         # Send file shared notification to WebSocket
@@ -125,4 +321,27 @@ class SecureFileConsumer(AsyncWebsocketConsumer):
             'file_id': event['file_id'],
             'shared_by': event['shared_by'],
             'shared_with': event['shared_with']
-        }))
\ No newline at end of file
+        }))
+
+    @database_sync_to_async
+    def get_viewable_file(self, file_id):
+        try:
+            file_obj = sharding.get_file(file_id)
+        except (File.DoesNotExist, ValueError, TypeError):
+            return None
+        # Checked afresh each time, so a revoked share stops new subscriptions
+        if not can_view_file(SimpleNamespace(user=self.user), file_obj):
+            return None
+        return file_obj
+
+    @database_sync_to_async
+    def get_share(self, file_id, username):
+        try:
+            file_obj = sharding.get_file(file_id, user_id=self.user.pk)
+            grantee = User.objects.get(username=username)
+        except (File.DoesNotExist, User.DoesNotExist, ValueError, TypeError):
+            return None
+        # Through the file, so the query runs on the file's shard
+        if not file_obj.shares.filter(grantee_id=grantee.pk).exists():
+            return None
+        return file_obj, grantee
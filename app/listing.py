@@ -0,0 +1,193 @@
+import base64
+import json
+from datetime import datetime, time
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.functional import cached_property
+
+# Sort keys accepted in ?sort=, mapped to File fields; prefix with '-' for descending
+SORT_FIELDS = {
+    'date': 'created_at',
+    'name': 'file_name',
+    'size': 'size_bytes',
+}
+DEFAULT_SORT = '-date'
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Only the columns the dashboard renders; owners are looked up separately, since
+# with sharding enabled the users table is on another database
+LISTING_COLUMNS = ('id', 'file_name', 'created_at', 'size_bytes', 'user_id')
+
+
+def encode_cursor(value, pk):
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    raw = json.dumps([value, pk]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor, field):
+    """
+    Decode a cursor produced by encode_cursor
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        value, pk = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+    # Valid JSON can still hold the wrong types; bool is an int to isinstance
+    value_type = int if field == 'size_bytes' else str
+    if not isinstance(value, value_type) or isinstance(value, bool) or not isinstance(pk, int) or isinstance(pk, bool):
+        raise ValueError('Invalid cursor')
+
+    if field == 'created_at':
+        value = parse_datetime(value)
+        if value is None:
+            raise ValueError('Invalid cursor')
+    return value, pk
+
+
+def _parse_day(value, end_of_day=False):
+    day = parse_date(value or '')
+    if day is None:
+        return None
+    return timezone.make_aware(datetime.combine(day, time.max if end_of_day else time.min))
+
+
+def listing_params(query):
+    """
+    Read the sort, filter and page size parameters shared by the listings
+
+    Args:
+        query: request.GET
+
+    Returns:
+        dict: Keyword arguments for list_files()
+    """
+    sort = query.get('sort', DEFAULT_SORT)
+    if sort.lstrip('-') not in SORT_FIELDS:
+        sort = DEFAULT_SORT
+
+    try:
+        limit = min(max(int(query.get('limit', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        limit = DEFAULT_PAGE_SIZE
+
+    return {
+        'sort': sort,
+        'limit': limit,
+        'name': query.get('q', '').strip() or None,
+        'created_after': _parse_day(query.get('after')),
+        'created_before': _parse_day(query.get('before'), end_of_day=True),
+    }
+
+
+def list_files(queryset, sort=DEFAULT_SORT, cursor=None, limit=DEFAULT_PAGE_SIZE,
+               name=None, created_after=None, created_before=None):
+    """
+    Return one page of files using keyset (seek) pagination
+
+    Rows are ordered by the sort field with the primary key as a tie
+    breaker, and the next page starts strictly after the last row, so each
+    page is an index range scan whatever the page number.
+
+    Args:
+        queryset: File queryset scoped to the files the user may list
+        sort (str): A key of SORT_FIELDS, optionally prefixed with '-'
+        cursor (str): The next_cursor of the previous page, if any
+
+    Returns:
+        tuple: (list of dicts with the LISTING_COLUMNS, next cursor or None)
+    """
+    descending = sort.startswith('-')
+    field = SORT_FIELDS[sort.lstrip('-')]
+
+    if name:
+        queryset = queryset.filter(file_name__icontains=name)
+    if created_after:
+        queryset = queryset.filter(created_at__gte=created_after)
+    if created_before:
+        queryset = queryset.filter(created_at__lte=created_before)
+
+    if cursor:
+        try:
+            value, pk = decode_cursor(cursor, field)
+        except ValueError:
+            # Start again from the first page rather than failing the dashboard
+            pass
+        else:
+            lookup = 'lt' if descending else 'gt'
+            queryset = queryset.filter(
+                Q(**{f'{field}__{lookup}': value}) | Q(**{field: value, f'id__{lookup}': pk})
+            )
+
+    prefix = '-' if descending else ''
+    rows = list(queryset.order_by(f'{prefix}{field}', f'{prefix}id').values(*LISTING_COLUMNS)[:limit + 1])
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][field], rows[-1]['id'])
+
+    return rows, next_cursor
+
+
+class LazyPage:
+    """
+    A listing page that is only queried when first used, so a template
+    fragment served from the cache costs no query at all
+
+    Args:
+        load: Callable returning (rows, next cursor)
+    """
+
+    def __init__(self, load):
+        self._load = load
+
+    @cached_property
+    def _page(self):
+        return self._load()
+
+    @property
+    def rows(self):
+        return self._page[0]
+
+    @property
+    def next_cursor(self):
+        return self._page[1]
+
+
+def list_files_across(querysets, sort=DEFAULT_SORT, limit=DEFAULT_PAGE_SIZE, **kwargs):
+    """
+    Return one page of files gathered from several databases
+
+    Takes the same arguments as list_files(), with one queryset per shard.
+    Each shard returns its own first page after the cursor; merging them and
+    keeping the first limit rows gives the global page, and because ids are
+    unique across shards the cursor works the same way as for one database.
+    """
+    if len(querysets) == 1:
+        return list_files(querysets[0], sort=sort, limit=limit, **kwargs)
+
+    field = SORT_FIELDS[sort.lstrip('-')]
+    rows = []
+    more = False
+    for queryset in querysets:
+        shard_rows, shard_cursor = list_files(queryset, sort=sort, limit=limit, **kwargs)
+        rows.extend(shard_rows)
+        more = more or shard_cursor is not None
+
+    rows.sort(key=lambda row: (row[field], row['id']), reverse=sort.startswith('-'))
+
+    next_cursor = None
+    if more or len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][field], rows[-1]['id'])
+
+    return rows, next_cursor
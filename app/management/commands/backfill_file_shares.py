@@ -0,0 +1,62 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from config.routers import shard_aliases
+from app.models import File, FileShare
+from firebase_integration.database import FirebaseDatabaseService
+
+
+def _items(data):
+    """
+    Firebase returns nodes with sequential integer keys as lists
+    """
+    if isinstance(data, dict):
+        return data.items()
+    if isinstance(data, list):
+        return [(str(index), value) for index, value in enumerate(data) if value]
+    return []
+
+
+class Command(BaseCommand):
+    help = "Backfill the local FileShare table from files/<id>/shared_with in Firebase"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Number of shares to insert per query")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        files_data = FirebaseDatabaseService.read("files")
+        # Shares go on the database of their file
+        databases = shard_aliases() or ['default']
+        file_databases = {file_id: db for db in databases
+                          for file_id in File.objects.using(db).values_list('id', flat=True)}
+        users_by_uid = {}
+        pending = {db: [] for db in databases}
+        created = 0
+        skipped = 0
+
+        for file_id, file_data in _items(files_data):
+            if not file_id.isdigit() or int(file_id) not in file_databases or not isinstance(file_data, dict):
+                skipped += 1
+                continue
+
+            for _, uid in _items(file_data.get("shared_with")):
+                if uid not in users_by_uid:
+                    username = FirebaseDatabaseService.get_username_for_uid(uid)
+                    users_by_uid[uid] = User.objects.filter(username=username).values_list('id', flat=True).first()
+
+                if users_by_uid[uid] is None:
+                    skipped += 1
+                    continue
+
+                db = file_databases[int(file_id)]
+                pending[db].append(FileShare(file_id=int(file_id), grantee_id=users_by_uid[uid], grantee_firebase_uid=uid))
+                if len(pending[db]) >= batch_size:
+                    created += len(FileShare.objects.using(db).bulk_create(pending[db], ignore_conflicts=True))
+                    pending[db] = []
+
+        for db, shares in pending.items():
+            if shares:
+                created += len(FileShare.objects.using(db).bulk_create(shares, ignore_conflicts=True))
+
+        self.stdout.write(f"Backfilled {created} share(s); skipped {skipped} file(s) or user(s) unknown locally")
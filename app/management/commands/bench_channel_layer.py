@@ -0,0 +1,102 @@
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from channels.layers import InMemoryChannelLayer
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from app.channel_layer import UnixSocketChannelLayer
+
+
+def start_hub(path, timeout=30):
+    """
+    Start a channel hub process listening on path, and wait for the socket to appear
+    """
+    hub = subprocess.Popen([sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'), 'run_channel_hub',
+                            '--path', path], stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if time.monotonic() > deadline or hub.poll() is not None:
+            hub.terminate()
+            hub.wait()
+            raise CommandError("The channel hub did not start")
+        time.sleep(0.05)
+    return hub
+
+
+async def _throughput(sender, layer, messages):
+    channel = await layer.new_channel()
+    start = time.perf_counter()
+
+    async def produce():
+        for n in range(messages):
+            await sender.send(channel, {'type': 'bench.message', 'n': n})
+
+    producer = asyncio.ensure_future(produce())
+    for _ in range(messages):
+        await layer.receive(channel)
+    await producer
+    return messages / (time.perf_counter() - start)
+
+
+async def _fanout(sender, layer, receivers, rounds):
+    channels = [await layer.new_channel() for _ in range(receivers)]
+    for channel in channels:
+        await layer.group_add('bench', channel)
+
+    latencies = []
+    for n in range(rounds):
+        start = time.perf_counter()
+        await sender.group_send('bench', {'type': 'bench.message', 'n': n})
+        await asyncio.gather(*[layer.receive(channel) for channel in channels])
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    for channel in channels:
+        await layer.group_discard('bench', channel)
+    latencies.sort()
+    return statistics.median(latencies), latencies[int(len(latencies) * 0.99) - 1]
+
+
+class Command(BaseCommand):
+    help = "Compare the Unix socket channel layer with the in-memory layer: messages per second and fan-out latency"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=20000,
+                            help="Messages to send through one channel for the throughput test")
+        parser.add_argument('--receivers', type=int, default=100,
+                            help="Channels in the group for the fan-out test")
+        parser.add_argument('--rounds', type=int, default=200,
+                            help="Group sends to time for the fan-out test")
+
+    def handle(self, *args, **options):
+        socket_dir = tempfile.mkdtemp()
+        path = os.path.join(socket_dir, 'bench.sock')
+        # A real hub process, so messages cross process boundaries as in production
+        try:
+            hub = start_hub(path)
+        except CommandError:
+            os.rmdir(socket_dir)
+            raise
+        try:
+            capacity = max(options['messages'], options['rounds'])
+            memory = InMemoryChannelLayer(capacity=capacity)
+            # Separate layers send and receive, as two workers would, so every message goes through the hub
+            layers = [
+                ('in-memory', memory, memory),
+                ('unix socket', UnixSocketChannelLayer(path=path, capacity=capacity),
+                 UnixSocketChannelLayer(path=path, capacity=capacity)),
+            ]
+            for name, sender, layer in layers:
+                per_second = asyncio.run(_throughput(sender, layer, options['messages']))
+                median, p99 = asyncio.run(_fanout(sender, layer, options['receivers'], options['rounds']))
+                self.stdout.write(f"{name:12} {per_second:10,.0f} msg/s   fan-out to {options['receivers']}: "
+                                  f"p50 {median:.2f} ms, p99 {p99:.2f} ms")
+        finally:
+            hub.terminate()
+            hub.wait()
+            if os.path.exists(path):
+                os.remove(path)
+            os.rmdir(socket_dir)
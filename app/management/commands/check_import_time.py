@@ -0,0 +1,70 @@
+import os
+import subprocess
+import sys
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# What a worker imports before serving its first request
+STARTUP_IMPORTS = 'import config.wsgi, config.urls'
+
+
+def parse_importtime(output):
+    """
+    Parse the report written by python -X importtime
+
+    Returns:
+        tuple: (total microseconds, list of (cumulative microseconds, module) for every import)
+    """
+    total = 0
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        try:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            cumulative = int(cumulative)
+        except ValueError:
+            # The header line
+            continue
+        module = name.strip()
+        # Nested imports are indented under the module that imported them
+        if name[1:2] != ' ':
+            total += cumulative
+        imports.append((cumulative, module))
+    return total, imports
+
+
+class Command(BaseCommand):
+    help = "Measure how long a cold worker spends importing modules, and fail if it is over budget"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--budget-ms', type=int, default=None,
+                            help="Fail above this many milliseconds (default: IMPORT_TIME_BUDGET_MS)")
+        parser.add_argument('--top', type=int, default=15,
+                            help="Number of the slowest imports to list")
+        parser.add_argument('--runs', type=int, default=3,
+                            help="Number of cold interpreters to time; the fastest run counts")
+
+    def handle(self, *args, **options):
+        budget_ms = options['budget_ms'] or getattr(settings, 'IMPORT_TIME_BUDGET_MS', None)
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'config.settings'))
+
+        best = None
+        for _ in range(max(options['runs'], 1)):
+            result = subprocess.run([sys.executable, '-X', 'importtime', '-c', STARTUP_IMPORTS],
+                                    cwd=settings.BASE_DIR, env=env, capture_output=True, text=True)
+            if result.returncode:
+                raise CommandError(f"Importing the project failed:\n{result.stderr[-2000:]}")
+            run = parse_importtime(result.stderr)
+            if best is None or run[0] < best[0]:
+                best = run
+
+        total, imports = best
+        for cumulative, module in sorted(imports, reverse=True)[:options['top']]:
+            self.stdout.write(f"{cumulative / 1000:9.1f} ms  {module}")
+
+        total_ms = total / 1000
+        if budget_ms and total_ms > budget_ms:
+            raise CommandError(f"Startup imports took {total_ms:.0f} ms, over the budget of {budget_ms} ms")
+        budget = f" (budget {budget_ms} ms)" if budget_ms else ""
+        self.stdout.write(self.style.SUCCESS(f"Startup imports took {total_ms:.0f} ms{budget}"))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from app.offload import clean_staging
+
+
+class Command(BaseCommand):
+    help = "Remove expired decrypted copies from the download staging directory"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=int, default=None,
+                            help="Remove copies older than this many seconds (default: DOWNLOAD_STAGING_TTL)")
+
+    def handle(self, *args, **options):
+        removed = clean_staging(options['max_age'])
+        self.stdout.write(self.style.SUCCESS(f"Removed {removed} staged file(s)"))
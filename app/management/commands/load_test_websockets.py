@@ -0,0 +1,361 @@
+import asyncio
+import json
+import os
+import secrets
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from importlib import import_module
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from app import sharding
+from app.comments import add_comment
+from app.routing import websocket_urlpatterns
+from .bench_channel_layer import start_hub
+
+
+def _rss_bytes(pid):
+    # Resident set size from /proc; None where there is no /proc
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class InProcessClient:
+    """
+    A socket on the consumers in this process, with the user put straight in the scope
+    """
+
+    application = URLRouter(websocket_urlpatterns)
+
+    def __init__(self, path, user, on_frame, cookie=None):
+        self.communicator = WebsocketCommunicator(self.application, path)
+        self.communicator.scope['user'] = user
+        self.on_frame = on_frame
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect()
+        if connected:
+            self.reader = asyncio.ensure_future(self._read())
+        return connected
+
+    async def _read(self):
+        while True:
+            message = await self.communicator.receive_output(timeout=24 * 3600)
+            if message['type'] != 'websocket.send':
+                return
+            self.on_frame(message['text'])
+
+    async def send_json(self, data):
+        await self.communicator.send_json_to(data)
+
+    async def close(self):
+        self.reader.cancel()
+        await self.communicator.disconnect()
+
+
+class DaphneClient:
+    """
+    A socket to a Daphne server, signed in with a session cookie
+    """
+
+    def __init__(self, path, user, on_frame, cookie=None, host='127.0.0.1', port=None):
+        from autobahn.asyncio.websocket import WebSocketClientFactory, WebSocketClientProtocol
+
+        client = self
+
+        class Protocol(WebSocketClientProtocol):
+            def onOpen(self):
+                client.opened.set_result(True)
+
+            def onMessage(self, payload, isBinary):
+                on_frame(payload.decode())
+
+            def onClose(self, wasClean, code, reason):
+                if not client.opened.done():
+                    client.opened.set_result(False)
+
+        self.host, self.port = host, port
+        self.factory = WebSocketClientFactory(f'ws://{host}:{port}{path}',
+                                              headers={'Cookie': cookie} if cookie else None)
+        self.factory.protocol = Protocol
+
+    async def connect(self):
+        self.opened = asyncio.get_running_loop().create_future()
+        try:
+            _, self.protocol = await asyncio.get_running_loop().create_connection(self.factory, self.host, self.port)
+        except OSError:
+            return False
+        return await self.opened
+
+    async def send_json(self, data):
+        self.protocol.sendMessage(json.dumps(data).encode())
+
+    async def close(self):
+        self.protocol.sendClose()
+
+
+class LoadTest:
+    """
+    Opens a notifications socket and a secure-file socket per user, then
+    shares files and comments on them, timing every delivery it expects
+    """
+
+    def __init__(self, users, files, recipients, client_class, server_pid, **client_options):
+        self.users = users
+        self.files = files
+        self.recipients = recipients
+        self.client_class = client_class
+        self.server_pid = server_pid
+        self.client_options = client_options
+        self.sent_at = {}
+        self.expected = {}
+        self.received = {}
+        self.latencies = []
+
+    def grantees(self, file_obj):
+        # The next few users after the owner
+        start = self.users.index(file_obj.user)
+        return [self.users[(start + n) % len(self.users)] for n in range(1, self.recipients + 1)]
+
+    def on_frame(self, text):
+        arrived = time.perf_counter()
+        frame = json.loads(text)
+        items = frame.get('notifications', []) if 'type' not in frame else [frame]
+        for item in items:
+            key = (item.get('type'), item.get('file_id'))
+            if key in self.sent_at:
+                self.received[key] = self.received.get(key, 0) + 1
+                self.latencies.append((arrived - self.sent_at[key]) * 1000)
+
+    def expect(self, kind, file_obj, count):
+        self.sent_at[(kind, file_obj.pk)] = time.perf_counter()
+        self.expected[(kind, file_obj.pk)] = count
+
+    async def connect_all(self, concurrency, cookies):
+        self.notification_clients, self.secure_clients = [], []
+        for user in self.users:
+            cookie = cookies.get(user.pk)
+            self.notification_clients.append(self.client_class(
+                f'/ws/notifications/{user.username}/', user, self.on_frame, cookie, **self.client_options))
+            self.secure_clients.append(self.client_class(
+                '/ws/secure-file/', user, self.on_frame, cookie, **self.client_options))
+
+        slots = asyncio.Semaphore(concurrency)
+
+        async def connect(client):
+            async with slots:
+                return await client.connect()
+
+        clients = self.notification_clients + self.secure_clients
+        results = await asyncio.gather(*[connect(client) for client in clients])
+        self.clients = [client for client, connected in zip(clients, results) if connected]
+        return len(clients) - len(self.clients)
+
+    async def drive(self, rate):
+        secure_clients = dict(zip((user.pk for user in self.users), self.secure_clients))
+        # Owners watch their files
+        for file_obj in self.files:
+            await secure_clients[file_obj.user_id].send_json({'type': 'subscribe', 'file_id': file_obj.pk})
+        await asyncio.sleep(0.5)
+
+        interval = 1 / rate
+        for file_obj in self.files:
+            started = time.perf_counter()
+            grantees = self.grantees(file_obj)
+
+            # A share: one notification per grantee, and the owner's announcement
+            # reaches each grantee's secure-file socket and the owner's own
+            self.expect('file_shared', file_obj, len(grantees))
+            self.expect('file_shared_notification', file_obj, 2 * len(grantees))
+            await sync_to_async(self.share)(file_obj, grantees)
+            for grantee in grantees:
+                await secure_clients[file_obj.user_id].send_json(
+                    {'type': 'file_shared', 'file_id': file_obj.pk, 'shared_with': grantee.username})
+            await asyncio.sleep(max(0, interval - (time.perf_counter() - started)))
+
+            # A comment by the owner: one notification per grantee
+            started = time.perf_counter()
+            self.expect('comment_added', file_obj, len(grantees))
+            await sync_to_async(add_comment)(file_obj, file_obj.user, 'Load test comment')
+            await asyncio.sleep(max(0, interval - (time.perf_counter() - started)))
+
+    @staticmethod
+    def share(file_obj, grantees):
+        with sharding.atomic_for_user(file_obj.user):
+            for grantee in grantees:
+                file_obj.shares.create(grantee=grantee)
+
+    def missing(self):
+        return sum(max(0, count - self.received.get(key, 0)) for key, count in self.expected.items())
+
+    async def run(self, concurrency, rate, drain_seconds, cookies):
+        rss_before = _rss_bytes(self.server_pid)
+        started = time.perf_counter()
+        failed = await self.connect_all(concurrency, cookies)
+        connect_seconds = time.perf_counter() - started
+        rss_after = _rss_bytes(self.server_pid)
+
+        await self.drive(rate)
+        deadline = time.monotonic() + drain_seconds
+        while self.missing() and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+        for client in self.clients:
+            await client.close()
+
+        return {
+            'connections': len(self.clients),
+            'failed': failed,
+            'connect_seconds': connect_seconds,
+            'bytes_per_connection': (rss_after - rss_before) / max(1, len(self.clients))
+                                    if rss_before is not None and rss_after is not None else None,
+            'expected': sum(self.expected.values()),
+            'dropped': self.missing(),
+            'latencies': self.latencies,
+        }
+
+
+class Command(BaseCommand):
+    help = ("Open thousands of WebSockets to NotificationConsumer and SecureFileConsumer, drive share and "
+            "comment events, and report connect rate, fan-out latency, memory per connection and drops")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=2000,
+                            help="Sockets to open, half notifications and half secure-file, two per user")
+        parser.add_argument('--files', type=int, default=50,
+                            help="Files to share and comment on, one share and one comment event each")
+        parser.add_argument('--recipients', type=int, default=10,
+                            help="Users each file is shared with")
+        parser.add_argument('--rate', type=float, default=20,
+                            help="Events per second")
+        parser.add_argument('--layer', choices=sorted(settings.CHANNEL_LAYER_BACKENDS), default='memory',
+                            help="Channel layer backend (see CHANNEL_LAYER_BACKENDS)")
+        parser.add_argument('--daphne', action='store_true',
+                            help="Connect over TCP to a local Daphne server instead of in-process")
+        parser.add_argument('--concurrency', type=int, default=200,
+                            help="Connections opened at once")
+        parser.add_argument('--drain', type=float, default=10,
+                            help="Seconds to wait for outstanding deliveries before counting them as dropped")
+
+    def handle(self, *args, **options):
+        users_count = options['connections'] // 2
+        if options['recipients'] >= users_count:
+            raise CommandError("--recipients must be less than half of --connections")
+        if options['daphne'] and options['layer'] == 'memory':
+            raise CommandError("Events are sent from this process, so --daphne needs a layer shared "
+                               "between processes: --layer unix or --layer redis")
+
+        socket_dir = tempfile.mkdtemp()
+        hub = daphne = None
+        layer = dict(settings.CHANNEL_LAYER_BACKENDS[options['layer']])
+        env = dict(os.environ, CHANNEL_LAYER=options['layer'])
+        if options['layer'] == 'unix':
+            # A hub of our own, so no running workers see the load
+            path = os.path.join(socket_dir, 'hub.sock')
+            layer['CONFIG'] = dict(layer['CONFIG'], path=path)
+            env['CHANNEL_HUB_SOCKET'] = path
+
+        run = secrets.token_hex(3)
+        users, files, sessions = [], [], []
+        try:
+            if options['layer'] == 'unix':
+                hub = start_hub(layer['CONFIG']['path'])
+            with override_settings(CHANNEL_LAYERS={'default': layer}):
+                self.stdout.write(f"Creating {users_count} users and {options['files']} files...")
+                users = User.objects.bulk_create(User(username=f'wsload{run}_{n}') for n in range(users_count))
+                files = [sharding.create_file(users[n % users_count], file_name=f'wsload_{n}.txt',
+                                              file_path=f'uploads/wsload/wsload_{n}.txt')
+                         for n in range(options['files'])]
+
+                cookies = {}
+                if options['daphne']:
+                    sessions = [self.sign_in(user) for user in users]
+                    cookies = {user.pk: f'{settings.SESSION_COOKIE_NAME}={session.session_key}'
+                               for user, session in zip(users, sessions)}
+                    port = self.free_port()
+                    daphne = subprocess.Popen([sys.executable, '-m', 'daphne', '-b', '127.0.0.1', '-p', str(port),
+                                               'config.asgi:application'], cwd=settings.BASE_DIR, env=env,
+                                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                    self.wait_for_port(port, daphne)
+                    load_test = LoadTest(users, files, options['recipients'], DaphneClient, daphne.pid, port=port)
+                else:
+                    load_test = LoadTest(users, files, options['recipients'], InProcessClient, os.getpid())
+
+                # async_to_sync, so database calls from the consumers run on this thread
+                results = async_to_sync(load_test.run)(options['concurrency'], options['rate'],
+                                                       options['drain'], cookies)
+            self.report(results, options)
+        finally:
+            if daphne is not None:
+                daphne.terminate()
+                daphne.wait()
+            if hub is not None:
+                hub.terminate()
+                hub.wait()
+            for session in sessions:
+                session.delete()
+            for user in users:
+                sharding.delete_files(user, [file_obj.pk for file_obj in files if file_obj.user_id == user.pk])
+            User.objects.filter(pk__in=[user.pk for user in users]).delete()
+            for name in os.listdir(socket_dir):
+                os.remove(os.path.join(socket_dir, name))
+            os.rmdir(socket_dir)
+
+    @staticmethod
+    def sign_in(user):
+        session = import_module(settings.SESSION_ENGINE).SessionStore()
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.create()
+        return session
+
+    @staticmethod
+    def free_port():
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            return s.getsockname()[1]
+
+    @staticmethod
+    def wait_for_port(port, process, timeout=30):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return
+            except OSError:
+                if time.monotonic() > deadline or process.poll() is not None:
+                    raise CommandError("Daphne did not start")
+                time.sleep(0.1)
+
+    def report(self, results, options):
+        mode = 'daphne' if options['daphne'] else 'in-process'
+        connections = results['connections']
+        self.stdout.write(f"{mode}, {options['layer']} layer")
+        self.stdout.write(f"connections  {connections:,} open, {results['failed']:,} failed, "
+                          f"{connections / results['connect_seconds']:,.0f}/s")
+        if results['bytes_per_connection'] is None:
+            self.stdout.write("memory       n/a")
+        else:
+            self.stdout.write(f"memory       {results['bytes_per_connection'] / 1024:,.1f} KiB per connection")
+        if results['latencies']:
+            self.stdout.write(f"fan-out      p50 {_percentile(results['latencies'], 0.5):.1f} ms, "
+                              f"p99 {_percentile(results['latencies'], 0.99):.1f} ms")
+        self.stdout.write(f"deliveries   {results['expected'] - results['dropped']:,} of {results['expected']:,}, "
+                          f"{results['dropped']:,} dropped")
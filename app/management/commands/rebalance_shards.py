@@ -0,0 +1,55 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from app.models import FileLocation
+from app.sharding import hash_shard, is_sharded, move_user, shard_for_user
+from config.routers import shard_aliases
+
+
+class Command(BaseCommand):
+    help = ("Move users' files between database shards. Each user's uploads and comments wait while "
+            "they are moved; SQLite cannot hold them off, so there move users while they are not writing")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help="Username of a single user to move")
+        parser.add_argument('--to', help="Target shard alias for --user")
+        parser.add_argument('--all', action='store_true',
+                            help="Move every user whose files are not on their shard, e.g. after adding shards; "
+                                 "users pinned with --user stay where they are")
+        parser.add_argument('--rehash', action='store_true',
+                            help="With --all, move pinned users back to the shard their id hashes to")
+        parser.add_argument('--dry-run', action='store_true', help="Only report what would move")
+
+    def handle(self, *args, **options):
+        if not is_sharded():
+            raise CommandError("Sharding is disabled; set DB_SHARDS to enable it")
+
+        if options['user']:
+            try:
+                user = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError(f"No user named '{options['user']}'")
+            target = options['to'] or shard_for_user(user.pk)
+            if target not in shard_aliases():
+                raise CommandError(f"Unknown shard '{target}'; choose from {', '.join(shard_aliases())}")
+            self._move(user, target, options['dry_run'])
+            return
+
+        if not options['all']:
+            raise CommandError("Pass --user (optionally with --to) or --all")
+
+        # Only users with a file somewhere other than their shard need to move
+        owners = FileLocation.objects.values('owner_id', 'shard').annotate(files=Count('id'))
+        users = User.objects.in_bulk({row['owner_id'] for row in owners})
+        for user in users.values():
+            target = hash_shard(user.pk) if options['rehash'] else shard_for_user(user.pk)
+            if any(row['owner_id'] == user.pk and row['shard'] != target for row in owners):
+                self._move(user, target, options['dry_run'])
+
+    def _move(self, user, target, dry_run):
+        if dry_run:
+            pending = FileLocation.objects.filter(owner=user).exclude(shard=target).count()
+            self.stdout.write(f"{user.username}: would move {pending} file(s) to {target}")
+            return
+        moved = move_user(user, target)
+        self.stdout.write(self.style.SUCCESS(f"{user.username}: moved {moved} file(s) to {target}"))
@@ -0,0 +1,69 @@
+import os
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db.models import Sum
+from app.models import File, UserStorage
+from config.routers import shard_aliases
+
+
+class Command(BaseCommand):
+    help = "Recompute each user's stored bytes from their files and fix any drift"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Number of users to reconcile per query")
+        parser.add_argument('--backfill-sizes', action='store_true',
+                            help="First record sizes for files uploaded before sizes were tracked, from the size on disk")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        databases = shard_aliases() or ['default']
+
+        if options['backfill_sizes']:
+            for db in databases:
+                self._backfill_sizes(db, batch_size)
+
+        user_ids = list(User.objects.order_by('pk').values_list('pk', flat=True))
+        fixed = 0
+
+        for start in range(0, len(user_ids), batch_size):
+            batch = user_ids[start:start + batch_size]
+
+            # Read the counters before measuring, so an upload or delete in between changes
+            # the counter and the guarded update below leaves that user alone
+            recorded = dict(UserStorage.objects.filter(pk__in=batch).values_list('pk', 'used_bytes'))
+
+            measured = dict.fromkeys(batch, 0)
+            for db in databases:
+                totals = (File.objects.using(db).filter(user_id__in=batch)
+                          .values('user_id').annotate(total=Sum('size_bytes')).order_by())
+                for row in totals:
+                    measured[row['user_id']] += row['total'] or 0
+
+            UserStorage.objects.bulk_create(
+                [UserStorage(user_id=user_id, used_bytes=measured[user_id]) for user_id in batch if user_id not in recorded],
+                ignore_conflicts=True,
+            )
+
+            for user_id, used_bytes in recorded.items():
+                if used_bytes != measured[user_id]:
+                    # Only if no upload or delete changed the counter since it was read; the next run catches the rest
+                    fixed += UserStorage.objects.filter(pk=user_id, used_bytes=used_bytes).update(used_bytes=measured[user_id])
+
+        self.stdout.write(self.style.SUCCESS(f"Reconciled {len(user_ids)} user(s), corrected {fixed}"))
+
+    def _backfill_sizes(self, db, batch_size):
+        pending = File.objects.using(db).filter(size_bytes=0).order_by('pk')
+        updated = []
+        for file_obj in pending.iterator(chunk_size=batch_size):
+            try:
+                # Encrypted files are measured as stored, which is slightly larger than the plaintext
+                file_obj.size_bytes = os.path.getsize(file_obj.file_path.path)
+            except OSError:
+                continue
+            updated.append(file_obj)
+            if len(updated) >= batch_size:
+                File.objects.using(db).bulk_update(updated, ['size_bytes'])
+                updated = []
+        if updated:
+            File.objects.using(db).bulk_update(updated, ['size_bytes'])
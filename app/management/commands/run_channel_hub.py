@@ -0,0 +1,26 @@
+import asyncio
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from app.channel_layer import ChannelHub
+
+
+class Command(BaseCommand):
+    help = "Run the hub the Unix socket channel layer connects the worker processes through"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default=None,
+                            help="Socket to listen on (default: CHANNEL_HUB_SOCKET)")
+
+    def handle(self, *args, **options):
+        path = options['path'] or settings.CHANNEL_HUB_SOCKET
+        # Group and channel limits are the layer's, so workers and hub agree
+        config = dict(settings.CHANNEL_LAYERS['default'].get('CONFIG', {}))
+        config.pop('path', None)
+        config.pop('connect_timeout', None)
+        hub = ChannelHub(path, **config)
+
+        self.stdout.write(f"Channel hub listening on {path}")
+        try:
+            asyncio.run(hub.serve_forever())
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:55
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0002_file_encrypted_alter_file_file_path'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileShare',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('grantee_firebase_uid', models.CharField(blank=True, max_length=128)),
+                ('permission', models.CharField(choices=[('view', 'View'), ('download', 'Download')], default='download', max_length=16)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shares', to='app.file')),
+                ('grantee', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='file_shares', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['grantee', 'created_at'], name='fileshare_grantee_created_idx')],
+                'constraints': [models.UniqueConstraint(fields=('file', 'grantee'), name='unique_file_share')],
+            },
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-19 15:06
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_comments(apps, schema_editor):
+    File = apps.get_model('app', 'File')
+    Comment = apps.get_model('app', 'Comment')
+    db = schema_editor.connection.alias
+    counts = Comment.objects.using(db).values('file_id').annotate(total=Count('id'))
+    for row in counts:
+        File.objects.using(db).filter(pk=row['file_id']).update(comment_count=row['total'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_sharding'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='comment_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['file', 'created_at', 'id'], name='comment_file_created_idx'),
+        ),
+        # Runs on the primary and on every shard that holds files
+        migrations.RunPython(count_comments, migrations.RunPython.noop, hints={'model_name': 'file'}),
+    ]
@@ -0,0 +1,98 @@
+# Generated by Django 5.2.18 on 2026-10-19 15:19
+
+import itertools
+
+import django.db.models.deletion
+from django.db import OperationalError, migrations, models
+
+FTS_TABLE = 'app_searchentry_fts'
+BACKFILL_BATCH_SIZE = 1000
+
+SQLITE_INDEX = [
+    # External content: the text stays in app_searchentry and FTS5 keeps only the index
+    f"""CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(
+        body, content='app_searchentry', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )""",
+    f"""CREATE TRIGGER app_searchentry_ai AFTER INSERT ON app_searchentry BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, body) VALUES (new.id, new.body);
+    END""",
+    f"""CREATE TRIGGER app_searchentry_ad AFTER DELETE ON app_searchentry BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, body) VALUES ('delete', old.id, old.body);
+    END""",
+    f"""CREATE TRIGGER app_searchentry_au AFTER UPDATE OF body ON app_searchentry BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, body) VALUES ('delete', old.id, old.body);
+        INSERT INTO {FTS_TABLE}(rowid, body) VALUES (new.id, new.body);
+    END""",
+]
+
+SQLITE_DROP = [
+    'DROP TRIGGER IF EXISTS app_searchentry_au',
+    'DROP TRIGGER IF EXISTS app_searchentry_ad',
+    'DROP TRIGGER IF EXISTS app_searchentry_ai',
+    f'DROP TABLE IF EXISTS {FTS_TABLE}',
+]
+
+
+def create_text_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        try:
+            for statement in SQLITE_INDEX:
+                schema_editor.execute(statement)
+        except OperationalError as e:
+            # SQLite built without FTS5; app.search falls back to a scan
+            print(f"Full-text index not created: {e}")
+            for statement in SQLITE_DROP:
+                schema_editor.execute(statement)
+    elif vendor == 'postgresql':
+        schema_editor.execute(
+            "CREATE INDEX app_searchentry_body_fts ON app_searchentry USING gin (to_tsvector('simple', body))"
+        )
+
+
+def drop_text_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        for statement in SQLITE_DROP:
+            schema_editor.execute(statement)
+    elif vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS app_searchentry_body_fts')
+
+
+def index_existing(apps, schema_editor):
+    File = apps.get_model('app', 'File')
+    Comment = apps.get_model('app', 'Comment')
+    SearchEntry = apps.get_model('app', 'SearchEntry')
+    db = schema_editor.connection.alias
+
+    entries = itertools.chain(
+        (SearchEntry(file_id=file_id, body=file_name)
+         for file_id, file_name in File.objects.using(db).values_list('id', 'file_name').iterator()),
+        (SearchEntry(file_id=file_id, comment_id=comment_id, body=content)
+         for comment_id, file_id, content in Comment.objects.using(db).values_list('id', 'file_id', 'content').iterator()),
+    )
+    while batch := list(itertools.islice(entries, BACKFILL_BATCH_SIZE)):
+        SearchEntry.objects.using(db).bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_storage_accounting'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('body', models.TextField()),
+                ('comment', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='search_entry', to='app.comment')),
+                ('file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_entries', to='app.file')),
+            ],
+        ),
+        # Run on the primary and on every shard that holds files
+        migrations.RunPython(create_text_index, drop_text_index, hints={'model_name': 'searchentry'}),
+        migrations.RunPython(index_existing, migrations.RunPython.noop, hints={'model_name': 'searchentry'}),
+    ]
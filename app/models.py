@@ -3,11 +3,25 @@ from django.contrib.auth.models import User
 from .utils import get_user_upload_path
 
 class File(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # No database-level constraint: with sharding enabled the users table lives on another database
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False)
     file_name = models.CharField(max_length=255)
     file_path = models.FileField(upload_to=get_user_upload_path)
     encrypted = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Maintained by app.comments.add_comment
+    comment_count = models.PositiveIntegerField(default=0)
+    # SHA-256 and size of the plaintext, recorded at upload
+    content_hash = models.CharField(max_length=64, blank=True)
+    size_bytes = models.BigIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of a user's files by date and by name
+            models.Index(fields=['user', 'created_at', 'id'], name='file_user_created_idx'),
+            models.Index(fields=['user', 'file_name', 'id'], name='file_user_name_idx'),
+            models.Index(fields=['user', 'size_bytes', 'id'], name='file_user_size_idx'),
+        ]
 
     def __str__(self):
         return self.file_name
@@ -18,11 +32,96 @@ class File(models.Model):
         import os
         return os.path.join(settings.MEDIA_ROOT, self.file_path.name)
 
+    def get_etag(self):
+        """Get a strong ETag for the file's contents, which never change after upload"""
+        if self.content_hash:
+            return f'"{self.content_hash}"'
+        # Files uploaded before hashes were recorded
+        return f'"file-{self.pk}-{int(self.created_at.timestamp())}"'
+
 class Comment(models.Model):
     file = models.ForeignKey(File, related_name='comments', on_delete=models.CASCADE)
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False)
     content = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # Keyset pagination of a file's thread, newest first
+            models.Index(fields=['file', 'created_at', 'id'], name='comment_file_created_idx'),
+        ]
+
+    def __str__(self):
+        return f'Comment by {self.user.username} on {self.file.file_name}'
+
+class FileShare(models.Model):
+    PERMISSION_VIEW = 'view'
+    PERMISSION_DOWNLOAD = 'download'
+    PERMISSION_CHOICES = [
+        (PERMISSION_VIEW, 'View'),
+        (PERMISSION_DOWNLOAD, 'Download'),
+    ]
+
+    file = models.ForeignKey(File, related_name='shares', on_delete=models.CASCADE)
+    grantee = models.ForeignKey(User, related_name='file_shares', on_delete=models.CASCADE, db_constraint=False)
+    grantee_firebase_uid = models.CharField(max_length=128, blank=True)
+    permission = models.CharField(max_length=16, choices=PERMISSION_CHOICES, default=PERMISSION_DOWNLOAD)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            # Also the index behind the per-download permission check
+            models.UniqueConstraint(fields=['file', 'grantee'], name='unique_file_share'),
+        ]
+        indexes = [
+            # "Shared with me" listings, newest first
+            models.Index(fields=['grantee', 'created_at'], name='fileshare_grantee_created_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.file.file_name} shared with {self.grantee.username}'
+
+class ShardAssignment(models.Model):
+    """
+    Pins a user to a shard, overriding the hash of their id (see app.sharding)
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='shard_assignment')
+    shard = models.CharField(max_length=64)
+
+    def __str__(self):
+        return f'{self.user.username} -> {self.shard}'
+
+class FileLocation(models.Model):
+    """
+    Records which shard holds each file; its id is the file's global id
+    """
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='file_locations')
+    shard = models.CharField(max_length=64)
+
+    def __str__(self):
+        return f'File {self.pk} on {self.shard}'
+
+class UserStorage(models.Model):
+    """
+    Bytes stored by a user, kept current by app.storage on upload and delete
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='storage')
+    used_bytes = models.BigIntegerField(default=0)
+    # Overrides settings.STORAGE_QUOTA_BYTES for this user when set
+    quota_bytes = models.BigIntegerField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.user.username}: {self.used_bytes} bytes'
+
+class SearchEntry(models.Model):
+    """
+    A file name or comment as indexed for full-text search, stored with its file (see app.search)
+    """
+    file = models.ForeignKey(File, on_delete=models.CASCADE, related_name='search_entries')
+    # Null for the entry holding the file's name
+    comment = models.OneToOneField(Comment, on_delete=models.CASCADE, null=True, blank=True, related_name='search_entry')
+    body = models.TextField()
+
     def __str__(self):
-        return f'Comment by {self.user.username} on {self.file.file_name}'
\ No newline at end of file
+        return self.body[:50]
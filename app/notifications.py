@@ -0,0 +1,181 @@
+"""
+Real-time notifications to a user's open WebSockets
+
+notify() is safe to call from model signal handlers: it waits for the
+transaction to commit and then only hands the notification to the
+dispatcher, so the saving request never waits on the channel layer.
+
+The dispatcher runs on an event loop: the loop NotificationConsumers run
+on, once one has connected in this process (so the in-memory layer, whose
+queues belong to that loop, works), and otherwise a loop of its own on a
+background thread. It coalesces each user's notifications for
+NOTIFICATION_COALESCE_SECONDS, or until NOTIFICATION_MAX_BATCH are waiting,
+and sends them to the user_<id> group as one message.
+
+Every notification is numbered from a per-user counter and kept in a ring
+buffer of the user's last NOTIFICATION_BUFFER_SIZE, both in the cache, so a
+client that reconnects with the last seq it saw gets just what it missed
+(see replay()), from whichever worker it reaches.
+"""
+
+import asyncio
+import threading
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from channels.layers import get_channel_layer
+
+DEFAULT_COALESCE_SECONDS = 0.25
+DEFAULT_MAX_BATCH = 50
+DEFAULT_BUFFER_SIZE = 200
+DEFAULT_BUFFER_TTL = 3600
+
+
+def user_group(user_id):
+    return f'user_{user_id}'
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _seq_key(user_id):
+    return f'notify_seq:{user_id}'
+
+
+def _slot_key(user_id, seq):
+    return f'notify_event:{user_id}:{seq % _setting("NOTIFICATION_BUFFER_SIZE", DEFAULT_BUFFER_SIZE)}'
+
+
+def current_seq(user_id):
+    """
+    The seq of the user's latest notification
+    """
+    key = _seq_key(user_id)
+    seq = cache.get(key)
+    if seq is None:
+        # Start from the clock rather than 0, so a counter that was evicted
+        # never reuses a number a client may already hold as its cursor
+        # (microseconds, which JavaScript numbers hold exactly)
+        cache.add(key, time.time_ns() // 1000, None)
+        seq = cache.get(key)
+    return seq
+
+
+def record(user_id, notification):
+    """
+    Number a notification for a user and keep it in their ring buffer
+
+    Returns:
+        dict: The notification with its seq
+    """
+    try:
+        seq = cache.incr(_seq_key(user_id))
+    except ValueError:
+        current_seq(user_id)
+        seq = cache.incr(_seq_key(user_id))
+    notification = dict(notification, seq=seq)
+    cache.set(_slot_key(user_id, seq), notification, _setting('NOTIFICATION_BUFFER_TTL', DEFAULT_BUFFER_TTL))
+    return notification
+
+
+def replay(user_id, last_seq):
+    """
+    A user's notifications after last_seq, oldest first
+
+    Returns:
+        tuple: (notifications, current seq); notifications is None when the
+        buffer has moved past last_seq and the client has to resync in full
+    """
+    seq = current_seq(user_id)
+    if last_seq > seq or seq - last_seq > _setting('NOTIFICATION_BUFFER_SIZE', DEFAULT_BUFFER_SIZE):
+        return None, seq
+
+    wanted = range(last_seq + 1, seq + 1)
+    found = cache.get_many([_slot_key(user_id, n) for n in wanted])
+    missed = [found.get(_slot_key(user_id, n)) for n in wanted]
+    # A slot that expired, or was overwritten by a newer notification, is a gap
+    if any(notification is None or notification['seq'] != n for notification, n in zip(missed, wanted)):
+        return None, seq
+    return missed, seq
+
+
+class NotificationDispatcher:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop = None
+        self._pending = {}
+        self._sent = 0
+
+    def attach(self, loop):
+        """
+        Dispatch on loop from now on; called by consumers as they connect
+        """
+        with self._lock:
+            if self._loop is not loop:
+                self._loop = loop
+
+    def _event_loop(self):
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='notification-dispatch', daemon=True).start()
+            return self._loop
+
+    def submit(self, user_id, notification):
+        """
+        Queue a notification for a user; returns at once, from any thread
+        """
+        self._event_loop().call_soon_threadsafe(self._add, user_id, notification)
+
+    def _add(self, user_id, notification):
+        # On the dispatch loop, so _pending needs no lock
+        batch = self._pending.get(user_id)
+        if batch is None:
+            batch = self._pending[user_id] = []
+            asyncio.get_running_loop().call_later(
+                _setting('NOTIFICATION_COALESCE_SECONDS', DEFAULT_COALESCE_SECONDS), self._flush, user_id)
+        batch.append(notification)
+        if len(batch) >= _setting('NOTIFICATION_MAX_BATCH', DEFAULT_MAX_BATCH):
+            self._flush(user_id)
+
+    def _flush(self, user_id):
+        batch = self._pending.pop(user_id, None)
+        if batch:
+            asyncio.ensure_future(self._send(user_id, batch))
+
+    async def _send(self, user_id, batch):
+        try:
+            await get_channel_layer().group_send(user_group(user_id), {
+                'type': 'send_notifications',
+                'notifications': batch,
+            })
+            self._sent += len(batch)
+        except Exception as e:
+            print(f"Error sending notifications to user {user_id}: {e}")
+
+
+dispatcher = NotificationDispatcher()
+
+
+def notify(user_ids, notification, using=None):
+    """
+    Send a notification to users' WebSockets once the current transaction commits
+
+    Args:
+        user_ids: Ids of the users to notify
+        notification: dict with type, title and message; a timestamp is added
+        using: Database alias of the transaction the change was made in
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    notification = dict(notification, timestamp=timezone.now().isoformat())
+
+    def submit():
+        for user_id in user_ids:
+            dispatcher.submit(user_id, record(user_id, notification))
+
+    transaction.on_commit(submit, using=using)
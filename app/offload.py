@@ -0,0 +1,143 @@
+"""
+Download offload to the front proxy
+
+With FILE_OFFLOAD set to 'nginx' or 'apache', download_file only authorizes
+the request and answers with an internal redirect header; the proxy then
+sends the bytes itself with sendfile. Encrypted files are decrypted once
+into a private staging directory and served from there until the staged
+copy expires.
+"""
+
+import mimetypes
+import os
+import tempfile
+import threading
+import time
+from urllib.parse import quote
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.encoding import smart_str
+from .utils import decrypt_file
+
+OFFLOAD_MODES = ('nginx', 'apache')
+DEFAULT_STAGING_TTL = 300
+# Readable by the proxy through the group of the 0o750 staging directory
+DEFAULT_STAGING_MODE = 0o640
+
+_cleanup_lock = threading.Lock()
+_last_cleanup = 0
+
+
+def offload_mode():
+    mode = getattr(settings, 'FILE_OFFLOAD', '')
+    return mode if mode in OFFLOAD_MODES else None
+
+
+def staging_root():
+    return str(getattr(settings, 'DOWNLOAD_STAGING_ROOT', os.path.join(settings.BASE_DIR, 'staging')))
+
+
+def staging_ttl():
+    return getattr(settings, 'DOWNLOAD_STAGING_TTL', DEFAULT_STAGING_TTL)
+
+
+def _staged_name(file_obj):
+    # The content hash keeps a re-uploaded file with a reused id from matching an old copy
+    return f"{file_obj.pk}-{file_obj.content_hash or int(file_obj.created_at.timestamp())}"
+
+
+def clean_staging(max_age=None):
+    """
+    Remove staged plaintext older than max_age seconds (DOWNLOAD_STAGING_TTL by default)
+
+    Returns:
+        int: The number of files removed
+    """
+    max_age = staging_ttl() if max_age is None else max_age
+    root = staging_root()
+    removed = 0
+    if not os.path.isdir(root):
+        return removed
+
+    cutoff = time.time() - max_age
+    for entry in os.scandir(root):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                # The proxy keeps serving a file it already opened
+                os.remove(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def _maybe_clean_staging():
+    global _last_cleanup
+    now = time.time()
+    with _cleanup_lock:
+        if now - _last_cleanup < staging_ttl():
+            return
+        _last_cleanup = now
+    clean_staging()
+
+
+def stage_decrypted(file_obj):
+    """
+    Decrypt a file into the staging directory, reusing a fresh staged copy
+
+    Returns:
+        str: Path of the plaintext, or None if decryption failed
+    """
+    root = staging_root()
+    os.makedirs(root, mode=0o750, exist_ok=True)
+    _maybe_clean_staging()
+
+    path = os.path.join(root, _staged_name(file_obj))
+    try:
+        if time.time() - os.stat(path).st_mtime < staging_ttl():
+            # Restart its TTL, so cleanup cannot remove it before the proxy opens it
+            os.utime(path)
+            return path
+    except FileNotFoundError:
+        pass
+
+    # Decrypt beside the final name and rename, so concurrent downloads never see a partial file
+    fd, temp_path = tempfile.mkstemp(dir=root, prefix='.partial-')
+    os.close(fd)
+    if not decrypt_file(file_obj.file_path.path, temp_path):
+        os.remove(temp_path)
+        return None
+    # mkstemp creates the file 0600, and os.replace keeps that
+    os.chmod(temp_path, getattr(settings, 'DOWNLOAD_STAGING_MODE', DEFAULT_STAGING_MODE))
+    os.replace(temp_path, path)
+    return path
+
+
+def offload_response(file_obj):
+    """
+    Build a response asking the proxy to send the file's plaintext
+
+    Returns:
+        HttpResponse, or None if an encrypted file could not be decrypted
+    """
+    mode = offload_mode()
+
+    if file_obj.encrypted:
+        path = stage_decrypted(file_obj)
+        if path is None:
+            return None
+        prefix = getattr(settings, 'FILE_OFFLOAD_STAGING_PREFIX', '/protected/staging/')
+        internal_url = prefix + quote(os.path.basename(path))
+    else:
+        path = file_obj.file_path.path
+        prefix = getattr(settings, 'FILE_OFFLOAD_MEDIA_PREFIX', '/protected/media/')
+        internal_url = prefix + quote(file_obj.file_path.name)
+
+    content_type, _ = mimetypes.guess_type(file_obj.file_name)
+    response = HttpResponse(content_type=content_type or 'application/octet-stream')
+    response['Content-Disposition'] = f'attachment; filename="{smart_str(file_obj.file_name)}"'
+    if mode == 'nginx':
+        response['X-Accel-Redirect'] = internal_url
+    else:
+        response['X-Sendfile'] = path
+    return response
@@ -0,0 +1,37 @@
+from .models import FileShare
+
+# Permission a user holds on a file they own
+PERMISSION_OWNER = 'owner'
+
+
+def get_file_permission(request, file_obj):
+    """
+    Get the requesting user's permission on a file
+
+    Owners hold PERMISSION_OWNER; anyone else holds the permission of their
+    FileShare row, found with a single indexed query. Results are cached on
+    the request, so repeated checks cost nothing.
+
+    Returns:
+        str: PERMISSION_OWNER, a FileShare permission, or None without access
+    """
+    cache = request.__dict__.setdefault('_file_permissions', {})
+
+    if file_obj.pk not in cache:
+        if file_obj.user_id == request.user.pk:
+            cache[file_obj.pk] = PERMISSION_OWNER
+        else:
+            # Through the file, so the query runs on the file's shard
+            cache[file_obj.pk] = file_obj.shares.filter(
+                grantee_id=request.user.pk,
+            ).values_list('permission', flat=True).first()
+
+    return cache[file_obj.pk]
+
+
+def can_view_file(request, file_obj):
+    return get_file_permission(request, file_obj) is not None
+
+
+def can_download_file(request, file_obj):
+    return get_file_permission(request, file_obj) in (PERMISSION_OWNER, FileShare.PERMISSION_DOWNLOAD)
@@ -0,0 +1,199 @@
+"""
+Full-text search over file names and comments
+
+Every file name and comment has a SearchEntry row, stored with its file
+(so on the file's shard) and kept in step by the signal receivers below.
+The database indexes the entries' text:
+
+- SQLite: an FTS5 table over SearchEntry.body, updated by triggers and
+  ranked with bm25;
+- PostgreSQL: a GIN index on to_tsvector('simple', body), ranked with ts_rank;
+- otherwise, or without FTS5, an unranked scan, so search still works.
+
+Every word of the query must match, each as a prefix of a word in the text.
+Results are limited to files the user owns or has been shared, ordered by
+score, and paged with a keyset cursor on (score, file id, entry id).
+"""
+
+import base64
+import json
+import re
+from django.db import connections
+from django.db.models import Exists, OuterRef, Q
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from config.routers import shard_aliases
+from .models import Comment, File, FileShare, SearchEntry
+
+FTS_TABLE = 'app_searchentry_fts'
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+MAX_TERMS = 8
+TERM_RE = re.compile(r'[^\W_]+')
+
+_fts_tables = {}
+
+
+@receiver(post_save, sender=File)
+def index_file_name(sender, instance, created, using, update_fields=None, **kwargs):
+    if created:
+        SearchEntry.objects.using(using).create(file=instance, body=instance.file_name)
+    elif update_fields is None or 'file_name' in update_fields:
+        SearchEntry.objects.using(using).filter(file=instance, comment=None).update(body=instance.file_name)
+
+
+@receiver(post_save, sender=Comment)
+def index_comment(sender, instance, created, using, **kwargs):
+    if created:
+        SearchEntry.objects.using(using).create(file_id=instance.file_id, comment=instance, body=instance.content)
+    else:
+        SearchEntry.objects.using(using).filter(comment=instance).update(body=instance.content)
+
+# Deleting a file or comment deletes its entries through the foreign keys
+
+
+def parse_terms(query):
+    """
+    Split a query into lowercase words, dropping punctuation
+    """
+    return TERM_RE.findall(query.lower())[:MAX_TERMS]
+
+
+def search_page_size(value):
+    """
+    Clamp a requested page size, falling back to the default
+    """
+    try:
+        return min(max(int(value), 1), MAX_PAGE_SIZE)
+    except (TypeError, ValueError):
+        return DEFAULT_PAGE_SIZE
+
+
+def encode_cursor(score, file_id, entry_id):
+    raw = json.dumps([score, file_id, entry_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        score, file_id, entry_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return float(score), int(file_id), int(entry_id)
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+
+def _has_fts_table(db):
+    if db not in _fts_tables:
+        _fts_tables[db] = FTS_TABLE in connections[db].introspection.table_names()
+    return _fts_tables[db]
+
+
+def _ranked_sql(db, terms):
+    """
+    The inner query of a ranked search and its parameters, or None if the
+    database has no text index; lower scores rank first
+    """
+    vendor = connections[db].vendor
+    if vendor == 'sqlite' and _has_fts_table(db):
+        match = ' '.join(f'"{term}"*' for term in terms)
+        return f"""
+            SELECT e.id, e.file_id, e.comment_id, e.body, bm25({FTS_TABLE}) AS score
+            FROM {FTS_TABLE} JOIN app_searchentry e ON e.id = {FTS_TABLE}.rowid
+            WHERE {FTS_TABLE} MATCH %s
+        """, [match]
+    if vendor == 'postgresql':
+        tsquery = ' & '.join(f'{term}:*' for term in terms)
+        return """
+            SELECT e.id, e.file_id, e.comment_id, e.body,
+                   -ts_rank(to_tsvector('simple', e.body), to_tsquery('simple', %s)) AS score
+            FROM app_searchentry e
+            WHERE to_tsvector('simple', e.body) @@ to_tsquery('simple', %s)
+        """, [tsquery, tsquery]
+    return None
+
+
+def _search_ranked(db, sql, params, user, after, limit):
+    query = f"""
+        SELECT hits.id, hits.file_id, hits.comment_id, hits.body, hits.score, f.file_name
+        FROM ({sql}) AS hits JOIN app_file f ON f.id = hits.file_id
+        WHERE (f.user_id = %s OR EXISTS (
+            SELECT 1 FROM app_fileshare s WHERE s.file_id = f.id AND s.grantee_id = %s
+        ))
+    """
+    params = params + [user.pk, user.pk]
+    if after:
+        query += ' AND (hits.score, hits.file_id, hits.id) > (%s, %s, %s)'
+        params += list(after)
+    query += ' ORDER BY hits.score, hits.file_id, hits.id LIMIT %s'
+    params.append(limit)
+
+    with connections[db].cursor() as cursor:
+        cursor.execute(query, params)
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def _search_scan(db, terms, user, after, limit):
+    # No text index: every entry is read, so this is for small or development databases
+    shared = FileShare.objects.using(db).filter(file_id=OuterRef('file_id'), grantee=user)
+    queryset = SearchEntry.objects.using(db).filter(Q(file__user=user) | Exists(shared))
+    for term in terms:
+        queryset = queryset.filter(body__icontains=term)
+    if after:
+        _, file_id, entry_id = after
+        queryset = queryset.filter(Q(file_id__gt=file_id) | Q(file_id=file_id, id__gt=entry_id))
+
+    rows = queryset.order_by('file_id', 'id').values('id', 'file_id', 'comment_id', 'body', 'file__file_name')[:limit]
+    return [dict(row, score=0.0, file_name=row.pop('file__file_name')) for row in rows]
+
+
+def search(user, query, cursor=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    Search the names of, and comments on, the files a user can see
+
+    With sharding enabled each shard is searched for its own first page
+    after the cursor and the pages are merged, as in list_files_across.
+
+    Returns:
+        tuple: (list of dicts with file_id, file_name, comment_id (None for a
+            match on the name), text and score, next cursor or None)
+    """
+    terms = parse_terms(query)
+    if not terms:
+        return [], None
+
+    after = None
+    if cursor:
+        try:
+            after = decode_cursor(cursor)
+        except ValueError:
+            pass
+
+    rows = []
+    for db in shard_aliases() or ['default']:
+        ranked = _ranked_sql(db, terms)
+        if ranked is not None:
+            rows.extend(_search_ranked(db, ranked[0], ranked[1], user, after, limit + 1))
+        else:
+            rows.extend(_search_scan(db, terms, user, after, limit + 1))
+
+    rows.sort(key=lambda row: (row['score'], row['file_id'], row['id']))
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['score'], rows[-1]['file_id'], rows[-1]['id'])
+
+    results = [{
+        'file_id': row['file_id'],
+        'file_name': row['file_name'],
+        'comment_id': row['comment_id'],
+        'text': row['body'],
+        'score': row['score'],
+    } for row in rows]
+    return results, next_cursor
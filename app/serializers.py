@@ -1,12 +1,107 @@
+from django.urls import reverse
 from rest_framework import serializers
-from .models import File, Comment
+from .models import File, Comment, FileShare
+
+
+def requested_fields(request):
+    """
+    The field names asked for with ?fields=a,b, or None for every field
+    """
+    if request is None or not request.query_params.get('fields'):
+        return None
+    return {name.strip() for name in request.query_params['fields'].split(',') if name.strip()}
+
+
+class SparseFieldsetMixin:
+    """
+    Drop the fields not named in ?fields=, and say which model fields are left to load
+
+    Only output is trimmed; a serializer given data to validate keeps every field.
+
+    Meta.load_fields maps serializer fields that do not read a model field of
+    the same name (method fields, for instance) to the model fields they need;
+    Meta.always_load lists model fields every query needs, such as the cursor
+    ordering.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        fields = requested_fields(self.context.get('request'))
+        if fields and 'data' not in kwargs:
+            for name in set(self.fields) - fields:
+                self.fields.pop(name)
+
+    def model_fields(self):
+        """
+        Model fields to pass to QuerySet.only() to render the remaining fields
+        """
+        load_fields = getattr(self.Meta, 'load_fields', {})
+        needed = set(getattr(self.Meta, 'always_load', ()))
+        for name, field in self.fields.items():
+            if not field.write_only:
+                needed.update(load_fields.get(name, (field.source,)))
+        return needed
+
+
+class UsernameField(serializers.Field):
+    """
+    The username of a related user, looked up in context['usernames']
+
+    Users are fetched in one query per page rather than joined, since with
+    sharding enabled they live on another database.
+    """
+
+    def __init__(self, user_field, **kwargs):
+        kwargs['read_only'] = True
+        kwargs['source'] = '*'
+        super().__init__(**kwargs)
+        self.user_field = user_field
+
+    def to_representation(self, instance):
+        return self.context.get('usernames', {}).get(getattr(instance, f'{self.user_field}_id'), '')
+
+
+class FileSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    owner = serializers.PrimaryKeyRelatedField(source='user', read_only=True)
+    owner_username = UsernameField('user')
+    download_url = serializers.SerializerMethodField()
 
-class FileSerializer(serializers.ModelSerializer):
     class Meta:
         model = File
-        fields = ['id', 'name', 'uploaded_at', 'owner', 'shared_with']
+        fields = ['id', 'file_name', 'owner', 'owner_username', 'size_bytes', 'content_hash',
+                  'encrypted', 'comment_count', 'created_at', 'download_url']
+        read_only_fields = fields
+        load_fields = {'owner_username': ('user',), 'download_url': ('id',)}
+        always_load = ('id', 'created_at')
+
+    def get_download_url(self, obj):
+        return reverse('download_file', kwargs={'file_id': obj.pk}) + '?download=true'
+
+
+class CommentSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    username = UsernameField('user')
 
-class CommentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Comment
-        fields = ['id', 'file', 'user', 'content', 'created_at']
\ No newline at end of file
+        fields = ['id', 'file', 'user', 'username', 'content', 'created_at']
+        read_only_fields = ['id', 'file', 'user', 'username', 'created_at']
+        load_fields = {'username': ('user',)}
+        always_load = ('id', 'created_at')
+
+
+class FileShareSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    grantee_username = UsernameField('grantee')
+    # Written when sharing; shares are read back with grantee and grantee_username
+    username = serializers.CharField(write_only=True)
+
+    class Meta:
+        model = FileShare
+        fields = ['id', 'file', 'grantee', 'grantee_username', 'permission', 'created_at', 'username']
+        read_only_fields = ['id', 'file', 'grantee', 'grantee_username', 'permission', 'created_at']
+        load_fields = {'grantee_username': ('grantee',)}
+        always_load = ('id', 'created_at')
+
+
+class FriendSerializer(serializers.Serializer):
+    id = serializers.CharField()
+    username = serializers.CharField()
@@ -0,0 +1,248 @@
+"""
+Optional horizontal sharding of files by owner
+
+With settings.DATABASE_SHARDS empty (the default) every helper here is a
+thin wrapper over the usual default-database queries. With shards
+configured, each user's files live on one shard, chosen by a stable hash
+of the user's id unless a ShardAssignment pins them elsewhere. Comments,
+shares, search entries and comment notifications live on the shard of
+their file. Users, sessions, the Firebase outbox, ShardAssignment and
+FileLocation stay on the primary, and FileLocation hands out globally
+unique file ids and finds a file's shard from its id.
+"""
+
+import zlib
+from contextlib import contextmanager
+from operator import attrgetter
+from django.contrib.auth.models import User
+from django.db import transaction
+from config.routers import shard_aliases
+from firebase_integration.models import CommentNotification
+from .models import File, Comment, FileShare, FileLocation, SearchEntry, ShardAssignment
+
+
+def is_sharded():
+    return bool(shard_aliases())
+
+
+def hash_shard(user_id, aliases=None):
+    """
+    The shard a user's id hashes to; stable across processes and restarts
+    """
+    aliases = aliases or shard_aliases()
+    return aliases[zlib.crc32(str(user_id).encode()) % len(aliases)]
+
+
+def shard_for_user(user_id):
+    """
+    The database holding a user's files
+    """
+    if not is_sharded():
+        return 'default'
+
+    assigned = ShardAssignment.objects.using('default').filter(user_id=user_id).values_list('shard', flat=True).first()
+    if assigned in shard_aliases():
+        return assigned
+    return hash_shard(user_id)
+
+
+def lock_user_shard(user_id):
+    """
+    The database holding a user's files, with the user locked until the
+    current transaction on the primary ends
+
+    move_user holds the same lock, so a write that takes it waits for a move
+    to finish and then goes to the user's new shard. SQLite has no row locks;
+    there a user must not be writing while they are moved.
+    """
+    if is_sharded():
+        list(User.objects.using('default').select_for_update().filter(pk=user_id).values_list('pk', flat=True))
+    return shard_for_user(user_id)
+
+
+def shard_for_file(file_id):
+    return FileLocation.objects.using('default').filter(pk=file_id).values_list('shard', flat=True).first()
+
+
+@contextmanager
+def atomic_for_user(user):
+    """
+    A transaction on the primary and, when sharded, on the user's shard too
+    """
+    with transaction.atomic():
+        if is_sharded():
+            with transaction.atomic(using=lock_user_shard(user.pk)):
+                yield
+        else:
+            yield
+
+
+def create_file(user, **fields):
+    """
+    Create a File on its owner's shard
+    """
+    if not is_sharded():
+        return File.objects.create(user=user, **fields)
+
+    with transaction.atomic():
+        shard = lock_user_shard(user.pk)
+        with transaction.atomic(using=shard):
+            location = FileLocation.objects.using('default').create(owner=user, shard=shard)
+            return File.objects.using(shard).create(pk=location.pk, user=user, **fields)
+
+
+def get_file(file_id, **filters):
+    """
+    Fetch a file by id from whichever shard holds it
+
+    Raises:
+        File.DoesNotExist: If there is no such file
+    """
+    if not is_sharded():
+        return File.objects.get(pk=file_id, **filters)
+
+    shard = shard_for_file(file_id)
+    if shard is None:
+        raise File.DoesNotExist('File matching query does not exist.')
+    return File.objects.using(shard).get(pk=file_id, **filters)
+
+
+def delete_file(file_obj):
+    """
+    Delete a file with its comments and shares, and forget its location
+    """
+    file_id = file_obj.pk
+    file_obj.delete()
+    if is_sharded():
+        FileLocation.objects.using('default').filter(pk=file_id).delete()
+
+
+def delete_files(user, file_ids):
+    """
+    Delete several of a user's files at once, with their comments and shares
+    """
+    owned_files(user).filter(pk__in=file_ids).delete()
+    if is_sharded():
+        FileLocation.objects.using('default').filter(pk__in=file_ids, owner=user).delete()
+
+
+def owned_files(user):
+    """
+    Queryset of the files a user owns
+    """
+    if not is_sharded():
+        return File.objects.filter(user=user)
+    return File.objects.using(shard_for_user(user.pk)).filter(user=user)
+
+
+def shared_file_querysets(user):
+    """
+    Querysets of the files shared with a user, one per database
+
+    Shares live with the file, so files shared with one user are spread over
+    every shard; callers query each and merge (see list_files_across).
+    """
+    if not is_sharded():
+        return [File.objects.filter(shares__grantee=user)]
+    return [File.objects.using(alias).filter(shares__grantee=user) for alias in shard_aliases()]
+
+
+class MergedQuerySet:
+    """
+    Querysets on several databases read as one ordered queryset
+
+    Supports the parts of the QuerySet API that cursor pagination uses:
+    filter(), order_by() and slicing. A slice reads up to its end from every
+    database and merges the rows, as list_files_across does for listings.
+    """
+
+    def __init__(self, querysets, ordering=()):
+        self.querysets = querysets
+        self.ordering = ordering
+
+    def filter(self, *args, **kwargs):
+        return MergedQuerySet([queryset.filter(*args, **kwargs) for queryset in self.querysets], self.ordering)
+
+    def order_by(self, *fields):
+        return MergedQuerySet([queryset.order_by(*fields) for queryset in self.querysets], fields)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            raise TypeError('MergedQuerySet only supports slicing')
+
+        rows = []
+        for queryset in self.querysets:
+            rows.extend(queryset[:index.stop])
+        # Stable sorts, least significant field first
+        for field in reversed(self.ordering):
+            rows.sort(key=attrgetter(field.lstrip('-')), reverse=field.startswith('-'))
+        return rows[index]
+
+
+def _copy_rows(model, rows, target, created_field='created_at', keep_ids=False):
+    """
+    Copy rows to another shard and return a map of their old ids to their new ones
+
+    Only file ids are global; other rows are numbered afresh by the target,
+    which may already use their ids.
+    """
+    old_ids = [row.pk for row in rows]
+    # auto_now_add would stamp the copies with the current time, so restore it afterwards
+    created = [getattr(row, created_field) for row in rows]
+    if not keep_ids:
+        for row in rows:
+            row.pk = None
+    model.objects.using(target).bulk_create(rows)
+    for row, value in zip(rows, created):
+        setattr(row, created_field, value)
+    model.objects.using(target).bulk_update(rows, [created_field])
+    return {old_id: row.pk for old_id, row in zip(old_ids, rows)}
+
+
+def move_user(user, target):
+    """
+    Move all of a user's files, with everything stored alongside them, to a shard
+    and pin the user there
+
+    The user stays locked for the whole move (see lock_user_shard), so their
+    uploads and the comments on their files wait for it and then land on the
+    new shard.
+
+    Returns:
+        int: The number of files moved
+    """
+    if target not in shard_aliases():
+        raise ValueError(f"Unknown shard '{target}'")
+
+    moved = 0
+
+    with transaction.atomic(), transaction.atomic(using=target):
+        lock_user_shard(user.pk)
+        sources = set(FileLocation.objects.filter(owner=user).exclude(shard=target).values_list('shard', flat=True))
+        for source in sources:
+            with transaction.atomic(using=source):
+                files = list(File.objects.using(source).filter(user=user))
+                file_ids = [file_obj.pk for file_obj in files]
+                comments = list(Comment.objects.using(source).filter(file_id__in=file_ids))
+                shares = list(FileShare.objects.using(source).filter(file_id__in=file_ids))
+                notifications = list(CommentNotification.objects.using(source).filter(file_id__in=file_ids))
+                search_entries = list(SearchEntry.objects.using(source).filter(file_id__in=file_ids))
+
+                _copy_rows(File, files, target, keep_ids=True)
+                comment_ids = _copy_rows(Comment, comments, target)
+                _copy_rows(FileShare, shares, target)
+                _copy_rows(CommentNotification, notifications, target, created_field='timestamp')
+                for entry in search_entries:
+                    entry.pk = None
+                    if entry.comment_id is not None:
+                        entry.comment_id = comment_ids[entry.comment_id]
+                SearchEntry.objects.using(target).bulk_create(search_entries)
+
+                FileLocation.objects.filter(pk__in=file_ids).update(shard=target)
+                # Deleting the files cascades to the rest on the source
+                File.objects.using(source).filter(pk__in=file_ids).delete()
+                moved += len(files)
+
+        ShardAssignment.objects.update_or_create(user=user, defaults={'shard': target})
+
+    return moved
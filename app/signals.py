@@ -1,16 +1,37 @@
 from django.dispatch import receiver
 from django.db.models.signals import post_save
-from .models import File, Comment
-from .consumers import NotificationConsumer
+from .models import File, Comment, FileShare
+from .notifications import notify
 
 @receiver(post_save, sender=File)
-def file_shared_notification(sender, instance, created, **kwargs):
+def file_uploaded_notification(sender, instance, created, using, **kwargs):
     if created:
-        message = f"File '{instance.name}' has been shared."
-        NotificationConsumer.send_notification(message)
+        notify([instance.user_id], {
+            'type': 'file_uploaded',
+            'title': 'File uploaded',
+            'message': f"File '{instance.file_name}' has been uploaded.",
+            'file_id': instance.pk,
+        }, using=using)
+
+@receiver(post_save, sender=FileShare)
+def file_shared_notification(sender, instance, created, using, **kwargs):
+    if created:
+        notify([instance.grantee_id], {
+            'type': 'file_shared',
+            'title': 'File shared',
+            'message': f"File '{instance.file.file_name}' has been shared with you.",
+            'file_id': instance.file_id,
+        }, using=using)
 
 @receiver(post_save, sender=Comment)
-def comment_added_notification(sender, instance, created, **kwargs):
+def comment_added_notification(sender, instance, created, using, **kwargs):
     if created:
-        message = f"New comment on file '{instance.file.name}': {instance.content}"
-        NotificationConsumer.send_notification(message)
\ No newline at end of file
+        file_obj = instance.file
+        # Everyone who can see the file, except whoever wrote the comment
+        recipients = {file_obj.user_id, *file_obj.shares.values_list('grantee_id', flat=True)} - {instance.user_id}
+        notify(recipients, {
+            'type': 'comment_added',
+            'title': 'New comment',
+            'message': f"New comment on file '{file_obj.file_name}': {instance.content}",
+            'file_id': file_obj.pk,
+        }, using=using)
@@ -0,0 +1,63 @@
+from django.conf import settings
+from django.db.models import F, Sum
+from django.db.models.functions import Greatest
+from .models import UserStorage
+
+
+def quota_for(storage):
+    """
+    The user's quota in bytes, or None for unlimited
+    """
+    if storage.quota_bytes is not None:
+        return storage.quota_bytes
+    return getattr(settings, 'STORAGE_QUOTA_BYTES', None)
+
+
+def get_storage(user):
+    storage, _ = UserStorage.objects.get_or_create(user=user)
+    return storage
+
+
+def has_room(user, size):
+    """
+    Whether size more bytes would fit in the user's quota right now
+
+    A cheap check before accepting an upload; reserve() is the one that counts.
+    """
+    storage = get_storage(user)
+    quota = quota_for(storage)
+    return quota is None or storage.used_bytes + size <= quota
+
+
+def reserve(user, size):
+    """
+    Add size bytes to the user's usage if they fit in the quota
+
+    The check and the increment are a single UPDATE, so concurrent uploads
+    cannot overshoot the quota between them. Call inside the transaction
+    that creates the File, so a failed upload gives the bytes back.
+
+    Returns:
+        bool: False if the quota would be exceeded
+    """
+    storage = get_storage(user)
+    quota = quota_for(storage)
+
+    rows = UserStorage.objects.filter(pk=storage.pk)
+    if quota is not None:
+        rows = rows.filter(used_bytes__lte=quota - size)
+    return rows.update(used_bytes=F('used_bytes') + size) == 1
+
+
+def release(user, size):
+    """
+    Take size bytes off the user's usage after a delete
+    """
+    UserStorage.objects.filter(pk=user.pk).update(used_bytes=Greatest(F('used_bytes') - size, 0))
+
+
+def measured_usage(files):
+    """
+    Sum the sizes of a File queryset
+    """
+    return files.aggregate(total=Sum('size_bytes'))['total'] or 0
@@ -1,46 +1,1503 @@
-from django.test import TestCase
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from contextlib import ExitStack, contextmanager
+from io import StringIO
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from channels.exceptions import ChannelFull
+from channels.layers import get_channel_layer
 from channels.testing import WebsocketCommunicator
-from .consumers import NotificationConsumer
-from .models import File, Comment
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from channels.layers import get_channel_layer
-from asgiref.testing import ApplicationCommunicator
-import json
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connections, router
+from django.db.models import Sum
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import path
+from django.utils import timezone
+from requests import HTTPError, Response
+
+from config import routers
+from config.routers import PIN_SESSION_KEY
+from firebase_integration import circuit, database, outbox, tokens
+from firebase_integration.circuit import CircuitBreaker, CircuitOpenError
+from firebase_integration.database import FirebaseDatabaseService
+from firebase_integration.mirror import FirebaseMirror
+from firebase_integration.models import CommentNotification, FirebaseOutbox
+from firebase_integration.outbox import merge_updates
+from firebase_integration.tokens import token_manager
+
+from . import offload, sharding, urls as app_urls, views
+from .admission import AdmissionController, AdmissionRejected
+from .bulk import delete_files
+from .caching import bump_version, user_scope
+from .channel_layer import ChannelHub, UnixSocketChannelLayer
+from .comments import add_comment, render_thread_page, thread_page
+from .consumers import NotificationConsumer, SecureFileConsumer
+from .listing import DEFAULT_PAGE_SIZE, list_files
+from .management.commands.check_import_time import parse_importtime
+from .models import Comment, File, FileLocation, FileShare, ShardAssignment, UserStorage
+from .notifications import NotificationDispatcher, notify, record, replay
+from .permissions import get_file_permission
+from .search import search
+from .sharding import get_file, move_user
 
 User = get_user_model()
 
-class NotificationConsumerTests(TestCase):
-    async def asyncSetUp(self):
+
+class FileTestCase(TestCase):
+    """
+    Tests that create files; with DB_SHARDS set they go to their owner's shard
+    """
+    databases = '__all__'
+
+    def create_file(self, user, name, **fields):
+        return sharding.create_file(user, file_name=name, file_path=f'uploads/{user.username}/{name}', **fields)
+
+    def use_media_root(self, **overrides):
+        """
+        Keep this test's files in a temporary MEDIA_ROOT, overriding any other settings given
+        """
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        media = override_settings(MEDIA_ROOT=self.media_root, **overrides)
+        media.enable()
+        self.addCleanup(media.disable)
+
+    def stored_file(self, user, name, content=b'data', **fields):
+        """
+        Create a file along with its content under MEDIA_ROOT
+        """
+        file_obj = self.create_file(user, name, **fields)
+        os.makedirs(os.path.dirname(file_obj.file_path.path), exist_ok=True)
+        with open(file_obj.file_path.path, 'wb') as f:
+            f.write(content)
+        return file_obj
+
+    def upload(self, name, content):
+        return self.client.post('/upload/', {'file': SimpleUploadedFile(name, content)})
+
+    def login(self, user, firebase_uid=None):
+        self.client.force_login(user)
+        if firebase_uid:
+            session = self.client.session
+            session['firebase_uid'] = firebase_uid
+            session.save()
+
+    def file_commits(self, file_obj):
+        """
+        Run the on_commit callbacks of the database file_obj lives on
+        """
+        return self.captureOnCommitCallbacks(using=file_obj._state.db, execute=True)
+
+    @contextmanager
+    def assertNumFileQueries(self, num):
+        """
+        assertNumQueries summed over the primary and every shard
+        """
+        with ExitStack() as stack:
+            captured = [stack.enter_context(CaptureQueriesContext(connections[alias]))
+                        for alias in ['default', *settings.DATABASE_SHARDS]]
+            yield
+        self.assertEqual(sum(len(queries) for queries in captured), num)
+
+
+class NotificationSocketMixin:
+    def notification_socket(self, user, username=None, query=''):
+        """
+        A communicator for the notifications socket of username, signed in as user
+        """
+        username = username or user.username
+        communicator = WebsocketCommunicator(NotificationConsumer.as_asgi(), f'/ws/notifications/{username}/{query}')
+        communicator.scope['url_route'] = {'kwargs': {'username': username}}
+        communicator.scope['user'] = user
+        return communicator
+
+    async def _connect(self, user):
+        communicator = self.notification_socket(user)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        # The first frame only carries the seq to resume from
+        self.assertIn('seq', await communicator.receive_json_from(timeout=2))
+        return communicator
+
+
+class NotificationConsumerTests(NotificationSocketMixin, FileTestCase):
+    def setUp(self):
         self.user = User.objects.create_user(username='testuser', password='testpass')
-        self.channel_layer = get_channel_layer()
-        self.communicator = WebsocketCommunicator(NotificationConsumer.as_asgi(), f"ws/notifications/{self.user.username}/")
-        self.connected, _ = await self.communicator.connect()
+        self.friend = User.objects.create_user(username='frienduser', password='testpass')
+        self.file = self.create_file(self.user, 'testfile.txt')
 
-    async def asyncTearDown(self):
-        await self.communicator.disconnect()
+    def _committed(self, func, *args):
+        with self.file_commits(self.file):
+            return func(*args)
 
     async def test_notification_on_file_share(self):
-        file = File.objects.create(name='testfile.txt', owner=self.user)
-        await self.communicator.send_json_to({
-            'type': 'file.shared',
-            'file_id': file.id,
-            'shared_with': 'frienduser'
-        })
-        response = await self.communicator.receive_json_from()
-        self.assertEqual(response['type'], 'notification')
-        self.assertIn('File shared', response['message'])
+        communicator = await self._connect(self.friend)
+        await sync_to_async(self._committed)(lambda: self.file.shares.create(grantee=self.friend))
+        response = await communicator.receive_json_from(timeout=2)
+        [notification] = response['notifications']
+        self.assertEqual(notification['type'], 'file_shared')
+        self.assertEqual(notification['title'], 'File shared')
+        await communicator.disconnect()
 
     async def test_notification_on_comment(self):
-        comment = Comment.objects.create(content='Nice file!', file_id=1, user=self.user)
-        await self.communicator.send_json_to({
-            'type': 'comment.added',
-            'comment_id': comment.id,
-            'file_id': comment.file_id
-        })
-        response = await self.communicator.receive_json_from()
-        self.assertEqual(response['type'], 'notification')
-        self.assertIn('New comment', response['message'])
+        communicator = await self._connect(self.user)
+        await sync_to_async(self._committed)(
+            lambda: self.file.comments.create(content='Nice file!', user=self.friend))
+        response = await communicator.receive_json_from(timeout=2)
+        [notification] = response['notifications']
+        self.assertEqual(notification['type'], 'comment_added')
+        self.assertIn('Nice file!', notification['message'])
+        await communicator.disconnect()
 
     async def test_disconnect(self):
-        await self.communicator.disconnect()
-        self.assertFalse(self.connected)
\ No newline at end of file
+        communicator = await self._connect(self.user)
+        await communicator.disconnect()
+        self.assertFalse(get_channel_layer().groups.get(f'user_{self.user.pk}'))
+
+
+class FirebaseOutboxTests(FileTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='outboxuser', password='testpass')
+
+    def test_merge_updates_splits_ancestor_paths(self):
+        merged = merge_updates([
+            {'files/1': {'file_name': 'a'}, 'users/u/files/1': True},
+            {'files/1': {'file_name': 'b'}},
+            {'files/1/shared_with': ['v']},
+        ])
+        self.assertEqual(merged, [
+            {'files/1': {'file_name': 'b'}, 'users/u/files/1': True},
+            {'files/1/shared_with': ['v']},
+        ])
+
+    def test_process_outbox_batches_updates(self):
+        outbox.enqueue_update({'files/1': {'file_name': 'a'}})
+        outbox.enqueue_update({'files/2': {'file_name': 'b'}})
+
+        with mock.patch.object(outbox, 'firebase_db') as firebase_db:
+            self.assertEqual(outbox.process_outbox(), 2)
+
+        firebase_db.update.assert_called_once_with({'files/1': {'file_name': 'a'}, 'files/2': {'file_name': 'b'}})
+        self.assertFalse(FirebaseOutbox.objects.filter(processed_at__isnull=True).exists())
+
+    def test_process_outbox_retries_with_backoff(self):
+        event = outbox.enqueue_update({'files/1': {'file_name': 'a'}})
+
+        with mock.patch.object(outbox, 'firebase_db') as firebase_db:
+            firebase_db.update.side_effect = ConnectionError('unreachable')
+            self.assertEqual(outbox.process_outbox(), 0)
+
+        event.refresh_from_db()
+        self.assertIsNone(event.processed_at)
+        self.assertEqual(event.attempts, 1)
+        self.assertIn('unreachable', event.last_error)
+        self.assertGreater(event.available_at, timezone.now())
+
+    def test_share_file_view_enqueues_share(self):
+        friend = User.objects.create_user(username='outboxfriend', password='testpass')
+        file_obj = self.create_file(self.user, 'a.txt')
+        self.client.force_login(self.user)
+
+        with mock.patch('firebase_integration.database.firebase_db') as firebase_db:
+            firebase_db.child.return_value.child.return_value.child.return_value.get.return_value.val.return_value = 'friend-uid'
+            response = self.client.post('/share/', {'file_id': file_obj.id, 'friend_username': friend.username})
+
+        self.assertEqual(response.json()['status'], 'success')
+        event = FirebaseOutbox.objects.get()
+        self.assertEqual(event.operation, FirebaseOutbox.OPERATION_SHARE_FILE)
+        self.assertEqual(event.payload, {'file_id': str(file_obj.id), 'shared_user_id': 'friend-uid'})
+
+
+class FirebaseMirrorTests(TestCase):
+    def setUp(self):
+        self.mirror = FirebaseMirror()
+        self.mirror.apply_event('files', 'put', {'path': '/', 'data': {'1': {'file_name': 'a.txt', 'shared_with': ['u2']}}})
+        self.mirror.apply_event('users', 'put', {'path': '/', 'data': {
+            'u1': {'profile': {'username': 'alice'}, 'notifications': {'n1': {'type': 'file_shared'}}},
+        }})
+
+    def test_lookup_applies_put_and_patch(self):
+        self.mirror.apply_event('files', 'patch', {'path': '/1', 'data': {'file_name': 'b.txt'}})
+        self.mirror.apply_event('files', 'put', {'path': '/2', 'data': {'file_name': 'c.txt'}})
+        self.mirror.apply_event('files', 'put', {'path': '/1/shared_with/1', 'data': 'u3'})
+
+        self.assertEqual(self.mirror.lookup('files', '1'), (True, {'file_name': 'b.txt', 'shared_with': ['u2', 'u3']}))
+        self.assertEqual(self.mirror.lookup('files', 2, 'file_name'), (True, 'c.txt'))
+        self.assertEqual(self.mirror.lookup('files', '3'), (True, None))
+
+    def test_lookup_only_serves_mirrored_user_keys(self):
+        self.assertEqual(self.mirror.lookup('users', 'u1', 'profile'), (True, {'username': 'alice'}))
+        self.assertEqual(self.mirror.lookup('users', 'u1', 'notifications'), (False, None))
+        self.assertNotIn('notifications', self.mirror._trees['users']['u1'])
+
+    def test_stale_node_misses(self):
+        self.mirror.max_staleness = 0
+        self.assertEqual(self.mirror.lookup('files', '1'), (False, None))
+        self.assertEqual(self.mirror.lookup('friends', 'u1'), (False, None))
+
+    def test_read_prefers_fresh_mirror(self):
+        with mock.patch.object(database, 'get_mirror', return_value=self.mirror), \
+                mock.patch.object(database, 'firebase_db') as firebase_db:
+            self.assertEqual(database.FirebaseDatabaseService.get_username_for_uid('u1'), 'alice')
+            firebase_db.child.assert_not_called()
+
+            firebase_db.child.return_value.get.return_value.val.return_value = {'u2': True}
+            self.assertEqual(database.FirebaseDatabaseService.read('friends', 'u1'), {'u2': True})
+            firebase_db.child.assert_called_once_with('friends', 'u1')
+
+
+def make_id_token(exp):
+    import base64
+    payload = base64.urlsafe_b64encode(json.dumps({'exp': exp}).encode()).decode().rstrip('=')
+    return f'header.{payload}.signature'
+
+
+class FirebaseTokenManagerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='tokenuser', email='token@example.com', password='testpass')
+
+    def test_verify_caches_until_expiry(self):
+        manager = tokens.FirebaseTokenManager()
+
+        with mock.patch('firebase_admin.auth.verify_id_token', return_value={'uid': 'u1', 'exp': time.time() + 60}) as verify:
+            manager.verify('token-a')
+            manager.verify('token-a')
+        self.assertEqual(verify.call_count, 1)
+
+        with mock.patch('firebase_admin.auth.verify_id_token', return_value={'uid': 'u1', 'exp': time.time() - 1}) as verify:
+            manager.verify('token-b')
+            manager.verify('token-b')
+        self.assertEqual(verify.call_count, 2)
+
+    def test_login_reuses_cached_firebase_session(self):
+        id_token = make_id_token(int(time.time()) + 3600)
+        token_manager.remember(self.user.pk, {'localId': 'u1', 'idToken': id_token, 'refreshToken': 'r1'})
+
+        with mock.patch('app.views.FirebaseAuthService.sign_in') as sign_in:
+            response = self.client.post('/login/', {'username': 'tokenuser', 'password': 'testpass'})
+
+        sign_in.assert_not_called()
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.client.session['firebase_uid'], 'u1')
+        self.assertEqual(self.client.session['firebase_token'], id_token)
+
+    def test_middleware_installs_refreshed_token_and_schedules_refresh(self):
+        self.client.force_login(self.user)
+        expiring = make_id_token(int(time.time()) + 10)
+        token_manager.remember(self.user.pk, {'localId': 'u1', 'idToken': expiring, 'refreshToken': 'r1'})
+
+        with mock.patch.object(token_manager, 'schedule_refresh') as schedule_refresh:
+            self.client.get('/notifications/')
+
+        schedule_refresh.assert_called_once_with(self.user.pk)
+        self.assertEqual(self.client.session['firebase_token'], expiring)
+
+    def test_refresh_stores_new_tokens(self):
+        manager = tokens.FirebaseTokenManager()
+        manager.remember(self.user.pk, {'localId': 'u1', 'idToken': make_id_token(0), 'refreshToken': 'r1'})
+        fresh = make_id_token(int(time.time()) + 3600)
+
+        with mock.patch.object(tokens, 'firebase_auth') as firebase_auth:
+            firebase_auth.refresh.return_value = {'userId': 'u1', 'idToken': fresh, 'refreshToken': 'r2'}
+            manager._refresh(self.user.pk)
+
+        firebase_auth.refresh.assert_called_once_with('r1')
+        session = manager.get_session(self.user.pk)
+        self.assertEqual((session['id_token'], session['refresh_token']), (fresh, 'r2'))
+        self.assertFalse(manager.needs_refresh(session))
+
+
+class FirebaseCircuitBreakerTests(FileTestCase):
+    def test_opens_after_threshold_and_probes_once(self):
+        breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=60)
+        failing = mock.Mock(side_effect=ConnectionError('down'))
+
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                breaker.call(failing)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitOpenError):
+            breaker.call(failing)
+        self.assertEqual(failing.call_count, 2)
+
+        with mock.patch('firebase_integration.circuit.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+            self.assertTrue(breaker.allow())
+            self.assertFalse(breaker.allow())
+            breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_client_errors_do_not_trip_breaker(self):
+        breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=60)
+        response = Response()
+        response.status_code = 400
+
+        with self.assertRaises(HTTPError):
+            breaker.call(mock.Mock(side_effect=HTTPError(response=response)))
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_exhausted_budget_fails_fast(self):
+        token = circuit.start_budget(0)
+        try:
+            with self.assertRaises(circuit.LatencyBudgetExceeded):
+                circuit.call_timeout()
+        finally:
+            circuit.end_budget(token)
+        self.assertIsNone(circuit.remaining_budget())
+
+    def test_index_degrades_to_local_files_when_circuit_open(self):
+        user = User.objects.create_user(username='circuituser', password='testpass')
+        self.create_file(user, 'local.txt')
+        self.login(user, firebase_uid='u1')
+
+        with mock.patch('app.views.FirebaseDatabaseService.is_available', return_value=False), \
+                mock.patch('app.views.FirebaseDatabaseService.get_user_files') as get_user_files:
+            response = self.client.get('/', HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+        get_user_files.assert_not_called()
+        self.assertEqual([f['file_name'] for f in response.json()['owned_files']], ['local.txt'])
+
+
+class FileShareTests(FileTestCase):
+    def setUp(self):
+        self.use_media_root()
+        self.owner = User.objects.create_user(username='shareowner', password='testpass')
+        self.friend = User.objects.create_user(username='sharefriend', password='testpass')
+        self.stranger = User.objects.create_user(username='sharestranger', password='testpass')
+        self.file = self.stored_file(self.owner, 'plan.txt', b'plan')
+
+    def download(self, user):
+        self.client.force_login(user)
+        return self.client.get(f'/download/{self.file.id}/?download=true')
+
+    def test_download_requires_share(self):
+        self.assertEqual(self.download(self.stranger).json()['status'], 'error')
+
+        self.file.shares.create(grantee=self.friend)
+        response = self.download(self.friend)
+        self.assertEqual(b''.join(response.streaming_content), b'plan')
+
+    def test_view_permission_cannot_download(self):
+        self.file.shares.create(grantee=self.friend, permission=FileShare.PERMISSION_VIEW)
+        self.assertIn('permission', self.download(self.friend).json()['message'])
+
+    def test_permission_is_cached_per_request(self):
+        self.file.shares.create(grantee=self.friend)
+        request = RequestFactory().get('/')
+        request.user = self.friend
+
+        with self.assertNumQueries(1, using=self.file._state.db):
+            self.assertEqual(get_file_permission(request, self.file), FileShare.PERMISSION_DOWNLOAD)
+            self.assertEqual(get_file_permission(request, self.file), FileShare.PERMISSION_DOWNLOAD)
+
+    def test_backfill_from_firebase(self):
+        firebase_files = {str(self.file.id): {'owner_id': 'u-owner', 'shared_with': ['u-friend', 'u-unknown']}, '999': {}}
+        usernames = {'u-friend': 'sharefriend', 'u-unknown': 'Unknown User'}
+
+        with mock.patch('app.management.commands.backfill_file_shares.FirebaseDatabaseService') as service:
+            service.read.return_value = firebase_files
+            service.get_username_for_uid.side_effect = usernames.get
+            call_command('backfill_file_shares', stdout=mock.Mock())
+
+        share = self.file.shares.get()
+        self.assertEqual((share.file, share.grantee, share.grantee_firebase_uid), (self.file, self.friend, 'u-friend'))
+
+
+class DashboardListingTests(FileTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='listinguser', password='testpass')
+        for name in ['c.txt', 'a.txt', 'e.txt', 'b.txt', 'd.txt']:
+            self.create_file(self.user, name)
+        # Identical timestamps must still paginate without skipping or repeating rows
+        owned = sharding.owned_files(self.user)
+        owned.filter(file_name__in=['a.txt', 'e.txt', 'b.txt']).update(created_at=owned.get(file_name='c.txt').created_at)
+
+    def collect(self, **params):
+        names, cursor = [], None
+        while True:
+            rows, cursor = list_files(sharding.owned_files(self.user), cursor=cursor, limit=2, **params)
+            names += [row['file_name'] for row in rows]
+            if not cursor:
+                return names
+
+    def test_keyset_pages_cover_every_file_once(self):
+        expected = list(sharding.owned_files(self.user).order_by('-created_at', '-id').values_list('file_name', flat=True))
+        self.assertEqual(self.collect(), expected)
+        self.assertEqual(self.collect(sort='name'), ['a.txt', 'b.txt', 'c.txt', 'd.txt', 'e.txt'])
+        self.assertEqual(self.collect(sort='-name', name='.TXT'), ['e.txt', 'd.txt', 'c.txt', 'b.txt', 'a.txt'])
+
+    def test_index_json_is_served_from_sql(self):
+        self.client.force_login(self.user)
+
+        with mock.patch('app.views.FirebaseDatabaseService.get_user_files') as get_user_files:
+            response = self.client.get('/?sort=name&limit=3', HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            data = response.json()
+            next_page = self.client.get(f'/?sort=name&limit=3&owned_cursor={data["owned_next_cursor"]}', HTTP_X_REQUESTED_WITH='XMLHttpRequest').json()
+
+        get_user_files.assert_not_called()
+        self.assertEqual([f['file_name'] for f in data['owned_files']], ['a.txt', 'b.txt', 'c.txt'])
+        self.assertEqual([f['file_name'] for f in next_page['owned_files']], ['d.txt', 'e.txt'])
+        self.assertIsNone(next_page['owned_next_cursor'])
+        file_obj = sharding.owned_files(self.user).get(file_name='a.txt')
+        self.assertEqual(data['owned_files'][0]['timestamp'], int(file_obj.created_at.timestamp() * 1000))
+
+    def test_file_names_are_not_paginated(self):
+        for index in range(DEFAULT_PAGE_SIZE):
+            self.create_file(self.user, f'z{index:02}.txt')
+        self.client.force_login(self.user)
+
+        files = self.client.get('/files/names/').json()['files']
+        self.assertEqual(len(files), DEFAULT_PAGE_SIZE + 5)
+        self.assertEqual([f['file_name'] for f in files[:2]], ['a.txt', 'b.txt'])
+
+    def test_invalid_cursor_starts_from_first_page(self):
+        rows, _ = list_files(sharding.owned_files(self.user), sort='name', cursor='not-a-cursor', limit=1)
+        self.assertEqual(rows[0]['file_name'], 'a.txt')
+
+    def test_cursor_with_wrong_types_starts_from_first_page(self):
+        self.client.force_login(self.user)
+        for raw in (b'[1, null]', b'[5, 1]', b'["a.txt", "1"]'):
+            cursor = base64.urlsafe_b64encode(raw).decode()
+            response = self.client.get(f'/?sort=name&owned_cursor={cursor}', HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            self.assertEqual(response.json()['owned_files'][0]['file_name'], 'a.txt')
+            self.assertEqual(self.client.get(f'/?owned_cursor={cursor}').status_code, 200)
+
+
+class ReadReplicaRoutingTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='replicauser', password='testpass')
+        self.client.force_login(self.user)
+
+    def routed_aliases(self, path):
+        """
+        Request a page and return the aliases the router picked for File reads
+        """
+        chosen = []
+
+        def choose(aliases):
+            chosen.append(aliases[0])
+            # The test database has no replica, so serve the simulated one from the primary
+            return 'default'
+
+        with override_settings(DATABASE_REPLICAS=['replica_1']), mock.patch.object(routers.random, 'choice', side_effect=choose):
+            response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        return chosen
+
+    @unittest.skipIf(settings.DATABASE_SHARDS, "Sharded files are read from their shard, not a replica")
+    def test_read_only_views_use_replica(self):
+        self.assertEqual(set(self.routed_aliases('/')), {'replica_1'})
+
+    def test_other_views_use_primary(self):
+        self.assertEqual(self.routed_aliases('/upload/'), [])
+
+    def test_session_pinned_to_primary_after_write(self):
+        session = self.client.session
+        session[PIN_SESSION_KEY] = time.time() + 60
+        session.save()
+        self.assertEqual(self.routed_aliases('/'), [])
+
+    def test_writes_and_other_models_use_primary(self):
+        replica_token = routers._replica_reads.set(True)
+        wrote_token = routers._wrote.set(False)
+        try:
+            with override_settings(DATABASE_REPLICAS=['replica_1']):
+                self.assertEqual(router.db_for_read(File), 'replica_1')
+                self.assertEqual(router.db_for_read(User), 'default')
+                self.assertEqual(router.db_for_write(File), 'default')
+                # Reads after a write in the same request see the primary
+                self.assertEqual(router.db_for_read(File), 'default')
+        finally:
+            routers._wrote.reset(wrote_token)
+            routers._replica_reads.reset(replica_token)
+
+
+class CommentThreadTests(FileTestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user(username='threadowner', password='testpass')
+        self.friend = User.objects.create_user(username='threadfriend', password='testpass')
+        self.file = self.create_file(self.owner, 'notes.txt')
+
+    def test_add_comment_updates_count(self):
+        with self.file_commits(self.file):
+            add_comment(self.file, self.owner, 'First')
+            add_comment(self.file, self.friend, 'Second')
+        self.file.refresh_from_db()
+        self.assertEqual(self.file.comment_count, 2)
+
+    def test_thread_pages_newest_first_without_n_plus_one(self):
+        for index in range(5):
+            add_comment(self.file, self.friend if index % 2 else self.owner, f'Comment {index}')
+
+        seen = []
+        cursor = None
+        while True:
+            with self.assertNumFileQueries(2):
+                rows, cursor = thread_page(self.file, cursor=cursor, limit=2)
+            seen.extend((row['username'], row['content']) for row in rows)
+            if not cursor:
+                break
+
+        self.assertEqual([content for _, content in seen], [f'Comment {index}' for index in range(4, -1, -1)])
+        self.assertEqual(seen[0], ('threadowner', 'Comment 4'))
+
+    def test_bad_cursor_starts_thread_from_newest(self):
+        add_comment(self.file, self.owner, 'Only')
+        self.client.force_login(self.owner)
+        for cursor in ('not-a-cursor', base64.urlsafe_b64encode(b'[1, null]').decode()):
+            rows, _ = thread_page(self.file, cursor=cursor)
+            self.assertEqual([row['content'] for row in rows], ['Only'])
+            response = self.client.get(f'/download/{self.file.pk}/', {'comments_cursor': cursor})
+            self.assertContains(response, 'Only')
+
+    def test_cached_page_is_invalidated_by_new_comment(self):
+        self.client.force_login(self.owner)
+        with self.file_commits(self.file):
+            self.client.post(f'/comment/{self.file.pk}/', {'comment': 'Hello'})
+
+        html, _ = render_thread_page(self.file)
+        self.assertIn('Hello', html)
+        with self.assertNumQueries(0):
+            self.assertEqual(render_thread_page(self.file)[0], html)
+
+        with self.file_commits(self.file):
+            self.client.post(f'/comment/{self.file.pk}/', {'comment': '<b>Again</b>'})
+
+        response = self.client.get(f'/download/{self.file.pk}/')
+        self.assertContains(response, '&lt;b&gt;Again&lt;/b&gt;')
+        self.assertContains(response, 'Comments (2)')
+
+
+class FragmentCacheTests(FileTestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user(username='fragowner', password='testpass')
+        self.friend = User.objects.create_user(username='fragfriend', password='testpass')
+
+    def dashboard(self, user):
+        self.client.force_login(user)
+        return self.client.get('/').content.decode()
+
+    def test_dashboard_is_cached_until_version_bump(self):
+        self.create_file(self.owner, 'first.txt')
+        self.assertIn('first.txt', self.dashboard(self.owner))
+
+        # Written behind the views' back, so only the cached fragment is shown
+        self.create_file(self.owner, 'second.txt')
+        self.assertNotIn('second.txt', self.dashboard(self.owner))
+
+        bump_version(user_scope(self.owner.pk))
+        self.assertIn('second.txt', self.dashboard(self.owner))
+
+    def test_share_invalidates_grantee_dashboard(self):
+        file_obj = self.create_file(self.owner, 'plan.txt')
+        self.assertNotIn('plan.txt', self.dashboard(self.friend))
+
+        self.client.force_login(self.owner)
+        with mock.patch('firebase_integration.database.firebase_db') as firebase_db, self.captureOnCommitCallbacks(execute=True):
+            firebase_db.child.return_value.child.return_value.child.return_value.get.return_value.val.return_value = 'u-friend'
+            response = self.client.post('/share/', {'file_id': file_obj.pk, 'friend_username': 'fragfriend'})
+        self.assertEqual(response.json()['status'], 'success')
+
+        self.assertIn('plan.txt', self.dashboard(self.friend))
+
+    def test_friends_list_is_cached_until_friendship_changes(self):
+        self.login(self.owner, firebase_uid='u-owner')
+
+        with mock.patch('app.views.FirebaseDatabaseService') as service:
+            service.is_available.return_value = True
+            service.get_friends.return_value = [{'id': 'u-friend', 'username': 'fragfriend'}]
+            service.get_friend_requests.return_value = {'incoming': [], 'outgoing': []}
+            service.remove_friend.return_value = (True, 'Friend removed')
+
+            self.assertContains(self.client.get('/friends/'), 'fragfriend')
+            self.client.get('/friends/')
+            self.assertEqual(service.get_friends.call_count, 1)
+
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post('/friends/', {'remove_friend': '1', 'friend_id': 'u-friend'})
+            service.get_friends.return_value = []
+            self.assertContains(self.client.get('/friends/'), 'No friends added yet.')
+            self.assertEqual(service.get_friends.call_count, 2)
+
+
+class ConditionalRequestTests(FileTestCase):
+    def setUp(self):
+        cache.clear()
+        self.use_media_root()
+        self.user = User.objects.create_user(username='etaguser', password='testpass')
+        self.client.force_login(self.user)
+
+    def upload_checked(self, content=b'hello etag'):
+        self.upload('etag.txt', content)
+        file_obj = sharding.owned_files(self.user).get()
+        self.assertEqual(file_obj.content_hash, hashlib.sha256(content).hexdigest())
+        return file_obj
+
+    def test_download_revalidates_with_strong_etag(self):
+        file_obj = self.upload_checked()
+        response = self.client.get(f'/download/{file_obj.pk}/?download=true')
+        self.assertEqual(b''.join(response.streaming_content), b'hello etag')
+        self.assertEqual(response['ETag'], f'"{file_obj.content_hash}"')
+
+        response = self.client.get(f'/download/{file_obj.pk}/?download=true', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get(f'/download/{file_obj.pk}/?download=true', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_listing_has_weak_etag_until_files_change(self):
+        first = self.client.get('/', HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        etag = first['ETag']
+        self.assertTrue(etag.startswith('W/'))
+
+        repeat = self.client.get('/', HTTP_X_REQUESTED_WITH='XMLHttpRequest', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(repeat.status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.upload_checked()
+        changed = self.client.get('/', HTTP_X_REQUESTED_WITH='XMLHttpRequest', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(changed.status_code, 200)
+        self.assertEqual(len(changed.json()['owned_files']), 1)
+
+
+class DownloadOffloadTests(FileTestCase):
+    def setUp(self):
+        self.staging_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.staging_root)
+        self.use_media_root(DOWNLOAD_STAGING_ROOT=self.staging_root, FILE_OFFLOAD='nginx')
+        self.user = User.objects.create_user(username='offloaduser', password='testpass')
+        self.client.force_login(self.user)
+
+    def test_plain_file_is_redirected_to_proxy(self):
+        file_obj = self.stored_file(self.user, 'plain.txt', b'plain')
+
+        response = self.client.get(f'/download/{file_obj.pk}/?download=true')
+        self.assertEqual(response['X-Accel-Redirect'], '/protected/media/uploads/offloaduser/plain.txt')
+        self.assertEqual(response.content, b'')
+        self.assertIn('ETag', response)
+
+        stranger = User.objects.create_user(username='offloadstranger', password='testpass')
+        self.client.force_login(stranger)
+        response = self.client.get(f'/download/{file_obj.pk}/?download=true')
+        self.assertNotIn('X-Accel-Redirect', response)
+
+    def test_encrypted_file_is_decrypted_once_into_staging(self):
+        self.upload('secret.txt', b'secret')
+        file_obj = sharding.owned_files(self.user).get()
+        self.assertTrue(file_obj.encrypted)
+
+        with mock.patch.object(offload, 'decrypt_file', wraps=offload.decrypt_file) as decrypt:
+            first = self.client.get(f'/download/{file_obj.pk}/?download=true')
+            with override_settings(FILE_OFFLOAD='apache'):
+                second = self.client.get(f'/download/{file_obj.pk}/?download=true')
+        self.assertEqual(decrypt.call_count, 1)
+
+        staged = second['X-Sendfile']
+        self.assertEqual(os.path.dirname(staged), self.staging_root)
+        self.assertEqual(first['X-Accel-Redirect'], '/protected/staging/' + os.path.basename(staged))
+        with open(staged, 'rb') as f:
+            self.assertEqual(f.read(), b'secret')
+
+        self.assertEqual(offload.clean_staging(max_age=-1), 1)
+        self.assertFalse(os.path.exists(staged))
+
+    def test_staged_copy_is_group_readable(self):
+        self.upload('secret.txt', b'secret')
+        staged = offload.stage_decrypted(sharding.owned_files(self.user).get())
+        self.assertEqual(os.stat(staged).st_mode & 0o777, 0o640)
+
+    def test_reused_staged_copy_outlives_cleanup(self):
+        self.upload('secret.txt', b'secret')
+        file_obj = sharding.owned_files(self.user).get()
+        staged = offload.stage_decrypted(file_obj)
+
+        # Nearly expired when a download reuses it
+        old = time.time() - offload.staging_ttl() + 1
+        os.utime(staged, (old, old))
+        self.assertEqual(offload.stage_decrypted(file_obj), staged)
+        self.assertEqual(offload.clean_staging(max_age=offload.staging_ttl() - 10), 0)
+        self.assertTrue(os.path.exists(staged))
+
+
+class AsyncTransferTests(FileTestCase):
+    def setUp(self):
+        # What config.urls serves with ASYNC_TRANSFERS on; earlier patterns win
+        urlconf = type('AsyncTransferURLs', (), {'urlpatterns': [
+            path('upload/', views.upload_file_async, name='upload_file'),
+            path('download/<int:file_id>/', views.download_file_async, name='download_file'),
+        ] + app_urls.urlpatterns})
+        self.use_media_root(ROOT_URLCONF=urlconf)
+        self.user = User.objects.create_user(username='asyncuser', password='testpass')
+        self.async_client.force_login(self.user)
+
+    async def body(self, response):
+        return b''.join([chunk async for chunk in response.streaming_content])
+
+    async def test_upload_is_encrypted_and_download_streams_plaintext(self):
+        response = await self.async_client.post('/upload/', {'file': SimpleUploadedFile('async.txt', b'async bytes')})
+        self.assertEqual(response.status_code, 302)
+        file_obj = await sync_to_async(lambda: sharding.owned_files(self.user).get())()
+        self.assertTrue(file_obj.encrypted)
+        self.assertEqual(file_obj.size_bytes, 11)
+        self.assertEqual(file_obj.content_hash, hashlib.sha256(b'async bytes').hexdigest())
+
+        with mock.patch.object(views, 'decrypt_file', wraps=views.decrypt_file) as decrypt:
+            response = await self.async_client.get(f'/download/{file_obj.pk}/?download=true')
+            self.assertEqual(await self.body(response), b'async bytes')
+        self.assertEqual(response['Content-Length'], '11')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="async.txt"')
+        # The decrypted copy is deleted once the response is closed
+        self.assertFalse(os.path.exists(decrypt.call_args.args[1]))
+
+        response = await self.async_client.get(f'/download/{file_obj.pk}/?download=true', headers={'If-None-Match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    async def test_plain_download_holds_admission_slot_until_sent(self):
+        file_obj = await sync_to_async(self.stored_file)(self.user, 'plain.txt', b'plain' * 30000)
+
+        controller = AdmissionController()
+        with mock.patch('app.admission.admission_controller', controller):
+            response = await self.async_client.get(f'/download/{file_obj.pk}/?download=true')
+            self.assertEqual(response['Content-Type'], 'text/plain')
+            self.assertEqual(controller.metrics()['inflight'], 1)
+            self.assertEqual(await self.body(response), b'plain' * 30000)
+            self.assertEqual(controller.metrics()['inflight'], 0)
+
+    async def test_details_page_and_permissions(self):
+        file_obj = await sync_to_async(self.create_file)(self.user, 'page.txt')
+        response = await self.async_client.get(f'/download/{file_obj.pk}/')
+        self.assertContains(response, 'page.txt')
+
+        stranger = await User.objects.acreate_user(username='asyncstranger', password='testpass')
+        await self.async_client.aforce_login(stranger)
+        response = await self.async_client.get(f'/download/{file_obj.pk}/?download=true')
+        self.assertEqual(response.json()['status'], 'error')
+
+
+class AdmissionControlTests(TestCase):
+    def test_per_user_concurrency_limit(self):
+        controller = AdmissionController(max_inflight=10, max_per_user=1)
+        controller.admit('alice')
+        with self.assertRaises(AdmissionRejected) as rejected:
+            controller.admit('alice')
+        self.assertEqual(rejected.exception.reason, 'user_concurrency')
+        controller.admit('bob')
+
+        controller.release('alice')
+        controller.admit('alice')
+
+    def test_waits_briefly_for_a_global_slot(self):
+        controller = AdmissionController(max_inflight=1, queue_timeout=0)
+        controller.admit('alice')
+        with self.assertRaises(AdmissionRejected) as rejected:
+            controller.admit('bob')
+        self.assertEqual(rejected.exception.reason, 'saturated')
+
+        controller._queue_timeout = 5
+        threading.Timer(0.05, controller.release, args=('alice',)).start()
+        controller.admit('bob')
+        self.assertEqual(controller.metrics()['inflight'], 1)
+        self.assertEqual(controller.metrics()['rejected'], {'saturated': 1})
+
+    def test_byte_budget_sets_retry_after(self):
+        controller = AdmissionController(user_bytes_per_second=100, user_burst_bytes=100)
+        controller.admit('alice', request_bytes=1000)
+        controller.release('alice')
+        with self.assertRaises(AdmissionRejected) as rejected:
+            controller.admit('alice')
+        self.assertEqual(rejected.exception.reason, 'user_bytes')
+        self.assertEqual(rejected.exception.retry_after, 9)
+
+    def test_middleware_rejects_with_429(self):
+        user = User.objects.create_user(username='busyuser', password='testpass')
+        self.client.force_login(user)
+        controller = AdmissionController(max_per_user=1)
+        controller.admit(user.pk)
+
+        with mock.patch('app.admission.admission_controller', controller):
+            response = self.client.post('/upload/')
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response['Retry-After'], '1')
+            # Only byte-heavy requests are limited
+            self.assertEqual(self.client.get('/upload/').status_code, 200)
+
+    def test_metrics_are_staff_only(self):
+        user = User.objects.create_user(username='metricsuser', password='testpass')
+        self.client.force_login(user)
+        self.assertEqual(self.client.get('/admission/metrics/').status_code, 403)
+
+        user.is_staff = True
+        user.save()
+        self.assertIn('queue_depth', self.client.get('/admission/metrics/').json())
+
+
+@override_settings(NOTIFICATION_COALESCE_SECONDS=0.05, NOTIFICATION_MAX_BATCH=3)
+class NotificationDispatchTests(NotificationSocketMixin, FileTestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username='notifyowner', password='testpass')
+        self.friend = User.objects.create_user(username='notifyfriend', password='testpass')
+
+    def test_bursts_are_coalesced_per_user(self):
+        dispatcher = NotificationDispatcher()
+        layer = mock.Mock(group_send=mock.AsyncMock())
+        with mock.patch('app.notifications.get_channel_layer', return_value=layer):
+            for n in range(4):
+                dispatcher.submit(1, {'n': n})
+            dispatcher.submit(2, {'n': 0})
+            time.sleep(0.3)
+
+        sent = sorted((call.args[0], [item['n'] for item in call.args[1]['notifications']])
+                      for call in layer.group_send.call_args_list)
+        # The first batch for user 1 filled up; the rest waited out the window
+        self.assertEqual(sent, [('user_1', [0, 1, 2]), ('user_1', [3]), ('user_2', [0])])
+
+    def test_signals_notify_after_commit(self):
+        file_obj = self.create_file(self.owner, 'notify.txt')
+        file_obj.shares.create(grantee=self.friend)
+
+        with mock.patch('app.notifications.dispatcher') as dispatcher:
+            with self.file_commits(file_obj):
+                add_comment(file_obj, self.friend, 'Looks good')
+                dispatcher.submit.assert_not_called()
+        dispatcher.submit.assert_called_once()
+        user_id, notification = dispatcher.submit.call_args.args
+        self.assertEqual(user_id, self.owner.pk)
+        self.assertEqual(notification['type'], 'comment_added')
+        self.assertIn('Looks good', notification['message'])
+
+    async def test_consumer_receives_coalesced_notifications(self):
+        communicator = await self._connect(self.owner)
+
+        def notify_twice():
+            with self.captureOnCommitCallbacks(execute=True):
+                notify([self.owner.pk], {'type': 'file_uploaded', 'message': 'a'})
+                notify([self.owner.pk], {'type': 'file_uploaded', 'message': 'b'})
+
+        await sync_to_async(notify_twice)()
+        response = await communicator.receive_json_from(timeout=2)
+        self.assertEqual([item['message'] for item in response['notifications']], ['a', 'b'])
+        await communicator.disconnect()
+
+
+@override_settings(NOTIFICATION_BUFFER_SIZE=5)
+class NotificationReplayTests(NotificationSocketMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='replayuser', password='testpass')
+
+    def _record(self, count):
+        return [record(self.user.pk, {'type': 'file_uploaded', 'message': str(n)})['seq'] for n in range(count)]
+
+    def test_replay_returns_only_the_gap(self):
+        seqs = self._record(4)
+        self.assertEqual(seqs, list(range(seqs[0], seqs[0] + 4)))
+
+        missed, seq = replay(self.user.pk, seqs[1])
+        self.assertEqual([notification['message'] for notification in missed], ['2', '3'])
+        self.assertEqual(seq, seqs[-1])
+        self.assertEqual(replay(self.user.pk, seq), ([], seq))
+
+    def test_resync_once_the_buffer_has_moved_past_the_cursor(self):
+        seqs = self._record(7)
+        # Slots for the first seqs now hold newer notifications
+        self.assertIsNone(replay(self.user.pk, seqs[0])[0])
+        self.assertEqual(len(replay(self.user.pk, seqs[1])[0]), 5)
+        # A cursor from a counter that was lost
+        self.assertIsNone(replay(self.user.pk, seqs[-1] + 100)[0])
+
+    async def test_only_the_signed_in_user_can_listen(self):
+        other = await User.objects.acreate(username='replayother')
+        for user in (AnonymousUser(), other):
+            communicator = self.notification_socket(user, username='replayuser', query='?last_seq=0')
+            connected, _ = await communicator.connect()
+            self.assertFalse(connected)
+
+    async def test_failed_connect_is_logged_and_closes_cleanly(self):
+        communicator = self.notification_socket(self.user)
+        with self.assertLogs('app.consumers', 'ERROR'), \
+                mock.patch('app.consumers.TokenBucket', side_effect=RuntimeError('boom')):
+            connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+        # Nothing was joined, so leaving has nothing to clean up
+        await communicator.disconnect()
+
+    async def test_reconnect_receives_missed_notifications_once(self):
+        seqs = await sync_to_async(self._record)(3)
+        communicator = self.notification_socket(self.user, query=f'?last_seq={seqs[0]}')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        frame = await communicator.receive_json_from(timeout=2)
+        self.assertEqual(frame['seq'], seqs[-1])
+        self.assertEqual([notification['seq'] for notification in frame['notifications']], seqs[1:])
+
+        # The last replayed notification was still on its way from the dispatcher
+        consumer_event = {'type': 'send_notifications',
+                          'notifications': [{'seq': seqs[-1], 'message': '2'}, {'seq': seqs[-1] + 1, 'message': '3'}]}
+        await get_channel_layer().group_send(f'user_{self.user.pk}', consumer_event)
+        frame = await communicator.receive_json_from(timeout=2)
+        self.assertEqual([notification['message'] for notification in frame['notifications']], ['3'])
+        await communicator.disconnect()
+
+
+@override_settings(WS_FLUSH_SECONDS=0.05, WS_MAX_BATCH=100, WS_INBOUND_RATE=0.01, WS_INBOUND_BURST=200)
+class WebSocketBatchingTests(NotificationSocketMixin, TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='batchuser', password='testpass')
+
+    async def test_repeated_activity_is_collapsed_into_few_frames(self):
+        communicator = await self._connect(self.user)
+        for n in range(150):
+            await communicator.send_json_to({'type': 'file_activity', 'file_id': n % 3, 'activity': 'viewing'})
+
+        activity = []
+        while len(activity) < 3 or sum(item['count'] for item in activity) < 150:
+            frame = await communicator.receive_json_from(timeout=2)
+            activity.extend(frame['activity'])
+        self.assertTrue(await communicator.receive_nothing(timeout=0.2))
+
+        counts = {}
+        for item in activity:
+            counts[item['file_id']] = counts.get(item['file_id'], 0) + item['count']
+        self.assertEqual(counts, {0: 50, 1: 50, 2: 50})
+        # One frame per file per flush window at most, not one per message
+        self.assertLessEqual(len(activity), 9)
+        await communicator.disconnect()
+
+    async def test_inbound_messages_over_the_rate_are_dropped_and_counted(self):
+        with override_settings(WS_INBOUND_BURST=5):
+            communicator = await self._connect(self.user)
+        for n in range(8):
+            await communicator.send_json_to({'type': 'file_activity', 'file_id': 1, 'activity': 'editing'})
+
+        frames = [await communicator.receive_json_from(timeout=2)]
+        if 'activity' not in frames[0] or 'errors' not in frames[0]:
+            frames.append(await communicator.receive_json_from(timeout=2))
+        merged = {key: items for frame in frames for key, items in frame.items()}
+        # The burst of 5 (and the sliver refilled meanwhile) got through; the rest are reported once
+        [activity], [error] = merged['activity'], merged['errors']
+        self.assertIn(activity['count'], (5, 6))
+        self.assertEqual(error, {'type': 'rate_limited', 'count': 8 - activity['count']})
+        await communicator.disconnect()
+
+
+class SecureFileRoutingTests(FileTestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username='routeowner', password='testpass')
+        self.friend = User.objects.create_user(username='routefriend', password='testpass')
+        self.bystanders = User.objects.bulk_create(User(username=f'bystander{n}') for n in range(25))
+        self.file = self.create_file(self.owner, 'route.txt')
+        self.file.shares.create(grantee=self.friend)
+
+    async def _connect(self, user):
+        communicator = WebsocketCommunicator(SecureFileConsumer.as_asgi(), '/ws/secure-file/')
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        return communicator, connected
+
+    async def test_anonymous_connections_are_rejected(self):
+        _, connected = await self._connect(AnonymousUser())
+        self.assertFalse(connected)
+
+    async def test_shares_reach_recipients_not_every_connection(self):
+        owner, _ = await self._connect(self.owner)
+        friend, _ = await self._connect(self.friend)
+        bystanders = [(await self._connect(user))[0] for user in self.bystanders]
+        await owner.send_json_to({'type': 'subscribe', 'file_id': self.file.pk})
+        for communicator in bystanders:
+            # Refused: they cannot see the file
+            await communicator.send_json_to({'type': 'subscribe', 'file_id': self.file.pk})
+        await bystanders[0].send_json_to({'type': 'file_shared', 'file_id': self.file.pk, 'shared_with': 'routefriend'})
+        self.assertTrue(await owner.receive_nothing(timeout=0.1))
+
+        layer = get_channel_layer()
+        with mock.patch.object(layer, 'send', wraps=layer.send) as send:
+            await owner.send_json_to({'type': 'file_shared', 'file_id': self.file.pk, 'shared_with': 'routefriend'})
+            for communicator in (owner, friend):
+                response = await communicator.receive_json_from(timeout=2)
+                self.assertEqual(response['shared_by'], 'routeowner')
+                self.assertEqual(response['shared_with'], 'routefriend')
+        # One send per recipient, with 27 sockets open
+        self.assertEqual(send.call_count, 2)
+        for communicator in bystanders:
+            self.assertTrue(await communicator.receive_nothing(timeout=0.01))
+
+        for communicator in [owner, friend, *bystanders]:
+            await communicator.disconnect()
+
+
+class WebSocketLoadTestCommandTests(TransactionTestCase):
+    databases = '__all__'
+
+    def test_in_process_run_delivers_every_event_and_cleans_up(self):
+        out = StringIO()
+        call_command('load_test_websockets', connections=20, files=2, recipients=3, rate=100, drain=5, stdout=out)
+
+        report = out.getvalue()
+        self.assertIn('20 open, 0 failed', report)
+        # Per file: 3 share notifications, 6 secure-file deliveries and 3 comment notifications
+        self.assertIn('24 of 24, 0 dropped', report)
+        self.assertFalse(User.objects.filter(username__startswith='wsload').exists())
+        self.assertFalse(any(File.objects.using(db).exists() for db in settings.DATABASE_SHARDS or ['default']))
+
+
+class UnixSocketChannelLayerTests(TestCase):
+    def setUp(self):
+        self.socket_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.socket_dir)
+        self.path = os.path.join(self.socket_dir, 'hub.sock')
+
+    async def test_group_send_reaches_every_worker(self):
+        hub = await ChannelHub(self.path).start()
+        first, second = UnixSocketChannelLayer(path=self.path), UnixSocketChannelLayer(path=self.path)
+        try:
+            channels = [await first.new_channel(), await first.new_channel(), await second.new_channel()]
+            for channel in channels:
+                await first.group_add('user_1', channel)
+            await second.group_send('user_1', {'type': 'notify', 'n': 1})
+            received = await asyncio.wait_for(asyncio.gather(
+                first.receive(channels[0]), first.receive(channels[1]), second.receive(channels[2])), 5)
+            self.assertEqual(received, [{'type': 'notify', 'n': 1}] * 3)
+
+            await first.send(channels[2], {'type': 'direct'})
+            self.assertEqual(await asyncio.wait_for(second.receive(channels[2]), 5), {'type': 'direct'})
+
+            # A worker that goes away leaves its groups
+            await first.close()
+            await asyncio.sleep(0.1)
+            self.assertEqual(list(hub.store.groups['user_1']), [channels[2]])
+        finally:
+            await second.close()
+            await hub.close()
+
+    async def test_general_channels_queue_at_the_hub(self):
+        hub = await ChannelHub(self.path, capacity=2).start()
+        layer = UnixSocketChannelLayer(path=self.path)
+        try:
+            waiting = asyncio.ensure_future(layer.receive('jobs'))
+            await asyncio.sleep(0.05)
+            waiting.cancel()
+            # A cancelled receive does not take a later message
+            await layer.send('jobs', {'type': 'job', 'n': 1})
+            await layer.send('jobs', {'type': 'job', 'n': 2})
+            with self.assertRaises(ChannelFull):
+                await layer.send('jobs', {'type': 'job', 'n': 3})
+            received = [await asyncio.wait_for(layer.receive('jobs'), 5) for _ in range(2)]
+            self.assertEqual(sorted(message['n'] for message in received), [1, 2])
+        finally:
+            await layer.close()
+            await hub.close()
+
+
+class StartupImportTests(TestCase):
+    def test_firebase_sdks_load_on_first_use(self):
+        code = ("import django, sys; django.setup(); import config.urls; "
+                "print(sorted(m for m in ('pyrebase', 'firebase_admin', 'pkg_resources') if m in sys.modules))")
+        result = subprocess.run([sys.executable, '-c', code], cwd=settings.BASE_DIR, capture_output=True, text=True,
+                                env=dict(os.environ, DJANGO_SETTINGS_MODULE='config.settings'))
+        self.assertEqual(result.stdout.strip().splitlines()[-1], '[]', result.stderr)
+
+    def test_parse_importtime(self):
+        total, imports = parse_importtime(
+            "import time: self [us] | cumulative | imported package\n"
+            "import time:       100 |        100 |   encodings.utf_8\n"
+            "import time:       200 |        300 | encodings\n"
+            "import time:        50 |         50 | config\n"
+        )
+        self.assertEqual(total, 350)
+        self.assertEqual(max(imports), (300, 'encodings'))
+
+
+class StorageQuotaTests(FileTestCase):
+    def setUp(self):
+        self.use_media_root(STORAGE_QUOTA_BYTES=10)
+        self.user = User.objects.create_user(username='quotauser', password='testpass')
+        self.client.force_login(self.user)
+
+    def used_bytes(self):
+        return UserStorage.objects.get(user=self.user).used_bytes
+
+    def test_upload_and_delete_update_usage(self):
+        self.upload('a.txt', b'123456')
+        file_obj = sharding.owned_files(self.user).get()
+        self.assertEqual(file_obj.size_bytes, 6)
+        self.assertEqual(self.used_bytes(), 6)
+
+        self.client.get(f'/delete/{file_obj.pk}/')
+        self.assertEqual(self.used_bytes(), 0)
+
+    def test_upload_over_quota_is_refused(self):
+        self.upload('a.txt', b'123456')
+        response = self.upload('b.txt', b'123456')
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(list(sharding.owned_files(self.user).values_list('file_name', flat=True)), ['a.txt'])
+        self.assertEqual(self.used_bytes(), 6)
+
+        UserStorage.objects.filter(user=self.user).update(quota_bytes=100)
+        self.assertEqual(self.upload('b.txt', b'123456').status_code, 302)
+        self.assertEqual(self.used_bytes(), 12)
+
+    def test_reconcile_fixes_drift(self):
+        self.create_file(self.user, 'a.txt', size_bytes=7)
+        self.create_file(self.user, 'b.txt', size_bytes=5)
+        UserStorage.objects.create(user=self.user, used_bytes=999)
+        other = User.objects.create_user(username='quotaother', password='testpass')
+
+        call_command('reconcile_storage', batch_size=1, stdout=mock.Mock())
+        self.assertEqual(self.used_bytes(), 12)
+        self.assertEqual(UserStorage.objects.get(user=other).used_bytes, 0)
+
+    def test_reconcile_keeps_counter_changed_while_measuring(self):
+        self.create_file(self.user, 'a.txt', size_bytes=7)
+        UserStorage.objects.create(user=self.user, used_bytes=999)
+
+        def upload_lands(*args, **kwargs):
+            UserStorage.objects.filter(user=self.user).update(used_bytes=1005)
+            return Sum(*args, **kwargs)
+
+        with mock.patch('app.management.commands.reconcile_storage.Sum', side_effect=upload_lands):
+            call_command('reconcile_storage', stdout=mock.Mock())
+        self.assertEqual(self.used_bytes(), 1005)
+
+    def test_listing_sorts_by_size(self):
+        for name, size in (('big.txt', 300), ('small.txt', 1), ('mid.txt', 20)):
+            self.create_file(self.user, name, size_bytes=size)
+        rows, cursor = list_files(sharding.owned_files(self.user), sort='-size', limit=2)
+        self.assertEqual([row['file_name'] for row in rows], ['big.txt', 'mid.txt'])
+        rows, _ = list_files(sharding.owned_files(self.user), sort='-size', cursor=cursor, limit=2)
+        self.assertEqual([row['file_name'] for row in rows], ['small.txt'])
+
+
+class SearchTests(FileTestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username='searchowner', password='testpass')
+        self.friend = User.objects.create_user(username='searchfriend', password='testpass')
+        self.stranger = User.objects.create_user(username='searchstranger', password='testpass')
+        self.report = self.create_file(self.owner, 'quarterly_report.pdf')
+        self.budget = self.create_file(self.owner, 'budget.xlsx')
+        self.private = self.create_file(self.stranger, 'report_secret.pdf')
+
+    def file_ids(self, user, query, **kwargs):
+        results, _ = search(user, query, **kwargs)
+        return [result['file_id'] for result in results]
+
+    def test_prefix_match_scoped_to_visible_files(self):
+        self.assertEqual(self.file_ids(self.owner, 'quart'), [self.report.pk])
+        self.assertEqual(self.file_ids(self.owner, 'repo'), [self.report.pk])
+        self.assertEqual(self.file_ids(self.friend, 'repo'), [])
+
+        self.report.shares.create(grantee=self.friend)
+        self.assertEqual(self.file_ids(self.friend, 'REPORT'), [self.report.pk])
+        self.assertEqual(self.file_ids(self.owner, 'report secret'), [])
+
+    def test_comments_are_indexed_and_removed(self):
+        comment = add_comment(self.budget, self.owner, 'Numbers for the marketing offsite')
+        results, _ = search(self.owner, 'market')
+        self.assertEqual([(r['file_id'], r['comment_id']) for r in results], [(self.budget.pk, comment.pk)])
+
+        comment.content = 'Numbers for sales'
+        comment.save()
+        self.assertEqual(self.file_ids(self.owner, 'market'), [])
+        self.assertEqual(self.file_ids(self.owner, 'sales'), [self.budget.pk])
+
+        self.budget.delete()
+        self.assertEqual(self.file_ids(self.owner, 'sales'), [])
+
+    def test_renamed_file_is_reindexed(self):
+        self.report.file_name = 'annual_summary.pdf'
+        self.report.save()
+        self.assertEqual(self.file_ids(self.owner, 'quarterly'), [])
+        self.assertEqual(self.file_ids(self.owner, 'annual'), [self.report.pk])
+
+    def test_ranked_pages_cover_every_match_once(self):
+        for index in range(5):
+            self.create_file(self.owner, f'draft plan {index}.txt')
+        self.create_file(self.owner, 'plan.txt')
+
+        seen = []
+        cursor = None
+        while True:
+            results, cursor = search(self.owner, 'plan', cursor=cursor, limit=2)
+            seen.extend(results)
+            if not cursor:
+                break
+
+        self.assertEqual(len(seen), 6)
+        self.assertEqual(len({result['file_id'] for result in seen}), 6)
+        scores = [result['score'] for result in seen]
+        self.assertEqual(scores, sorted(scores))
+
+    def test_search_view(self):
+        self.client.force_login(self.owner)
+        response = self.client.get('/search/', {'q': 'budg'}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual([result['file_name'] for result in response.json()['results']], ['budget.xlsx'])
+
+        response = self.client.get('/search/', {'q': 'budg'})
+        self.assertContains(response, 'budget.xlsx')
+
+
+class BulkOperationTests(FileTestCase):
+    def setUp(self):
+        self.use_media_root()
+        self.owner = User.objects.create_user(username='bulkowner', password='testpass')
+        self.friend = User.objects.create_user(username='bulkfriend', password='testpass')
+        self.files = [self.stored_file(self.owner, f'{index}.txt', size_bytes=4) for index in range(3)]
+        self.other = self.stored_file(self.friend, 'other.txt', size_bytes=4)
+        self.client.force_login(self.owner)
+
+    def test_bulk_delete_reports_each_file(self):
+        self.files[0].shares.create(grantee=self.friend, grantee_firebase_uid='friend-uid')
+        UserStorage.objects.create(user=self.owner, used_bytes=12)
+        self.login(self.owner, firebase_uid='owner-uid')
+
+        ids = [self.files[0].pk, self.files[1].pk, self.other.pk, self.files[0].pk]
+        response = self.client.post('/bulk/delete/', {'file_ids': ids})
+
+        results = response.json()['results']
+        self.assertEqual([(r['file_id'], r['status']) for r in results],
+                         [(self.files[0].pk, 'success'), (self.files[1].pk, 'success'), (self.other.pk, 'error')])
+        self.assertEqual(list(sharding.owned_files(self.owner)), [self.files[2]])
+        self.assertFalse(os.path.exists(self.files[0].file_path.path))
+        self.assertTrue(os.path.exists(self.other.file_path.path))
+        self.assertEqual(UserStorage.objects.get(user=self.owner).used_bytes, 4)
+
+        payload = FirebaseOutbox.objects.get().payload
+        self.assertIsNone(payload[f'files/{self.files[1].pk}'])
+        self.assertIsNone(payload[f'users/owner-uid/files/{self.files[0].pk}'])
+        self.assertIsNone(payload[f'users/friend-uid/shared_with_me/{self.files[0].pk}'])
+
+    def test_bulk_share_in_one_update(self):
+        ids = [self.files[0].pk, self.files[1].pk, self.other.pk]
+        data = {'file_ids': ids, 'friend_id': self.friend.pk}
+
+        with mock.patch('app.bulk.notify') as bulk_notify:
+            results = self.client.post('/bulk/share/', data).json()['results']
+            self.assertEqual([r['status'] for r in results], ['success', 'success', 'error'])
+            self.assertEqual(bulk_notify.call_count, 2)
+            # Sharing again notifies nobody
+            self.client.post('/bulk/share/', data)
+            self.assertEqual(bulk_notify.call_count, 2)
+
+        self.assertEqual(sum(file_obj.shares.filter(grantee=self.friend).count() for file_obj in self.files), 2)
+        payload = FirebaseOutbox.objects.first().payload
+        uid = str(self.friend.pk)
+        self.assertEqual(payload[f'files/{self.files[0].pk}/shared_with'], [uid])
+        self.assertTrue(payload[f'users/{uid}/shared_with_me/{self.files[1].pk}'])
+        self.assertEqual(sum(1 for path in payload if '/notifications/' in path), 2)
+        self.assertFalse(any('/notifications/' in path for path in FirebaseOutbox.objects.last().payload))
+
+    def test_rejects_bad_ids(self):
+        response = self.client.post('/bulk/delete/', {'file_ids': ['1', 'x']})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(sharding.owned_files(self.owner).count() + sharding.owned_files(self.friend).count(), 4)
+
+
+class ApiTests(FileTestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username='apiowner', password='testpass')
+        self.friend = User.objects.create_user(username='apifriend', password='testpass')
+        self.files = [
+            self.create_file(self.owner, f'{index}.txt')
+            for index in range(3)
+        ]
+        self.client.force_login(self.owner)
+
+    def test_list_pages_with_sparse_fields(self):
+        with self.assertNumQueries(3):
+            data = self.client.get('/api/v1/files/', {'limit': 2, 'fields': 'id,file_name'}).json()
+        self.assertEqual(data['results'], [{'id': f.pk, 'file_name': f.file_name} for f in self.files[:0:-1]])
+
+        data = self.client.get(data['next']).json()
+        self.assertEqual([row['id'] for row in data['results']], [self.files[0].pk])
+        self.assertIsNone(data['next'])
+
+        row = self.client.get('/api/v1/files/', {'fields': 'owner_username,owner'}).json()['results'][0]
+        self.assertEqual(row, {'owner': self.owner.pk, 'owner_username': 'apiowner'})
+
+    def test_shared_files_and_access(self):
+        self.files[0].shares.create(grantee=self.friend)
+        self.client.force_login(self.friend)
+
+        data = self.client.get('/api/v1/files/shared/').json()
+        self.assertEqual([(row['id'], row['owner_username']) for row in data['results']], [(self.files[0].pk, 'apiowner')])
+        self.assertEqual(self.client.get(f'/api/v1/files/{self.files[0].pk}/').status_code, 200)
+        self.assertEqual(self.client.get(f'/api/v1/files/{self.files[1].pk}/').status_code, 404)
+        self.assertEqual(self.client.delete(f'/api/v1/files/{self.files[0].pk}/').status_code, 403)
+        self.assertEqual(self.client.get(f'/api/v1/files/{self.files[0].pk}/shares/').status_code, 403)
+
+    def test_comments(self):
+        url = f'/api/v1/files/{self.files[0].pk}/comments/'
+        response = self.client.post(url, {'content': 'Looks good'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['username'], 'apiowner')
+        self.assertEqual(self.client.post(url, {}).status_code, 400)
+
+        data = self.client.get(url, {'fields': 'content'}).json()
+        self.assertEqual(data['results'], [{'content': 'Looks good'}])
+
+        # ?fields= trims the response, not the input
+        response = self.client.post(f'{url}?fields=id', {'content': 'Again'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(list(response.json()), ['id'])
+        self.assertEqual(self.client.post(f'{url}?fields=id', {}).status_code, 400)
+
+    def test_share_and_delete(self):
+        url = f'/api/v1/files/{self.files[0].pk}/shares/'
+        with mock.patch.object(FirebaseDatabaseService, 'get_uid_for_username', return_value='friend-uid'):
+            response = self.client.post(url, {'username': 'apifriend'})
+            self.assertEqual(self.client.post(f'{url}?fields=id', {'username': 'apifriend'}).status_code, 201)
+            self.assertEqual(self.client.post(f'{url}?fields=id', {}).status_code, 400)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['grantee_username'], 'apifriend')
+        self.assertEqual([row['grantee'] for row in self.client.get(url).json()['results']], [self.friend.pk])
+
+        self.assertEqual(self.client.delete(f'/api/v1/files/{self.files[0].pk}/').status_code, 204)
+        self.assertFalse(sharding.owned_files(self.owner).filter(pk=self.files[0].pk).exists())
+
+
+@unittest.skipUnless(len(settings.DATABASE_SHARDS) >= 2, "Run with DB_SHARDS=2 to test sharding")
+class ShardingTests(FileTestCase):
+    def setUp(self):
+        self.shard_a, self.shard_b = settings.DATABASE_SHARDS[:2]
+        self.owner = User.objects.create_user(username='shardowner', password='testpass')
+        self.friend = User.objects.create_user(username='shardfriend', password='testpass')
+        ShardAssignment.objects.create(user=self.owner, shard=self.shard_a)
+        ShardAssignment.objects.create(user=self.friend, shard=self.shard_b)
+
+    def test_files_live_on_owner_shard(self):
+        file_obj = self.create_file(self.owner, 'a.txt')
+
+        self.assertEqual(file_obj._state.db, self.shard_a)
+        self.assertEqual(FileLocation.objects.get(pk=file_obj.pk).shard, self.shard_a)
+        self.assertFalse(File.objects.using(self.shard_b).exists())
+        self.assertEqual(get_file(file_obj.pk).file_name, 'a.txt')
+
+    def test_ids_are_unique_across_shards(self):
+        ids = [self.create_file(self.owner, 'a.txt').pk, self.create_file(self.friend, 'b.txt').pk]
+        self.assertEqual(len(set(ids)), 2)
+
+    def test_shared_files_are_gathered_from_every_shard(self):
+        owned = self.create_file(self.friend, 'mine.txt')
+        shared = self.create_file(self.owner, 'theirs.txt')
+        shared.shares.create(grantee=self.friend)
+        self.assertEqual(FileShare.objects.using(self.shard_a).count(), 1)
+
+        self.client.force_login(self.friend)
+        data = self.client.get('/', HTTP_X_REQUESTED_WITH='XMLHttpRequest').json()
+        self.assertEqual([row['file_name'] for row in data['owned_files']], ['mine.txt'])
+        self.assertEqual([(row['file_name'], row['owner_username']) for row in data['shared_files']],
+                         [('theirs.txt', 'shardowner')])
+        self.assertEqual(owned._state.db, self.shard_b)
+
+    def test_comments_follow_their_file(self):
+        file_obj = self.create_file(self.owner, 'a.txt')
+        file_obj.shares.create(grantee=self.friend)
+
+        self.client.force_login(self.friend)
+        self.client.post(f'/comment/{file_obj.pk}/', {'comment': 'Looks good'})
+        self.assertEqual(Comment.objects.using(self.shard_a).get().content, 'Looks good')
+        self.assertFalse(Comment.objects.using(self.shard_b).exists())
+
+        response = self.client.get(f'/download/{file_obj.pk}/')
+        self.assertContains(response, 'Looks good')
+
+    def test_move_user_between_shards(self):
+        file_obj = self.create_file(self.owner, 'a.txt')
+        file_obj.shares.create(grantee=self.friend)
+        file_obj.comments.create(user=self.friend, content='Hi')
+
+        self.assertEqual(move_user(self.owner, self.shard_b), 1)
+
+        moved = get_file(file_obj.pk)
+        self.assertEqual(moved._state.db, self.shard_b)
+        self.assertEqual(moved.created_at, file_obj.created_at)
+        self.assertEqual(moved.comments.get().content, 'Hi')
+        self.assertTrue(moved.shares.filter(grantee=self.friend).exists())
+        self.assertFalse(File.objects.using(self.shard_a).exists())
+        self.assertFalse(Comment.objects.using(self.shard_a).exists())
+        self.assertEqual(FileLocation.objects.get(pk=file_obj.pk).shard, self.shard_b)
+        self.assertEqual(ShardAssignment.objects.get(user=self.owner).shard, self.shard_b)
+
+    def test_move_user_into_shard_with_rows(self):
+        # The same ids, 1 and up, are already taken on the target
+        for owner, grantee in ((self.friend, self.owner), (self.owner, self.friend)):
+            file_obj = self.create_file(owner, f'{owner.username}.txt')
+            file_obj.shares.create(grantee=grantee)
+            add_comment(file_obj, grantee, f'From {grantee.username}')
+            CommentNotification.objects.using(file_obj._state.db).create(user=owner, file=file_obj, comment='note')
+
+        move_user(self.owner, self.shard_b)
+
+        moved = get_file(sharding.owned_files(self.owner).get().pk)
+        self.assertEqual(moved._state.db, self.shard_b)
+        self.assertEqual(Comment.objects.using(self.shard_b).count(), 2)
+        self.assertEqual(FileShare.objects.using(self.shard_b).count(), 2)
+        self.assertEqual(CommentNotification.objects.using(self.shard_b).count(), 2)
+        comment = moved.comments.get()
+        self.assertEqual(comment.content, 'From shardfriend')
+        self.assertEqual(comment.search_entry.body, 'From shardfriend')
+        kept = sharding.owned_files(self.friend).get()
+        self.assertEqual(kept.comments.get().search_entry.body, 'From shardowner')
+        self.assertEqual({result['file_id'] for result in search(self.friend, 'From')[0]}, {moved.pk, kept.pk})
+
+    def test_search_spans_shards_and_moves(self):
+        own = self.create_file(self.friend, 'plan_mine.txt')
+        shared = self.create_file(self.owner, 'plan_theirs.txt')
+        shared.shares.create(grantee=self.friend)
+        self.create_file(self.owner, 'plan_private.txt')
+
+        results, _ = search(self.friend, 'plan')
+        self.assertEqual({result['file_id'] for result in results}, {own.pk, shared.pk})
+
+        move_user(self.owner, self.shard_b)
+        results, _ = search(self.friend, 'plan')
+        self.assertEqual({result['file_id'] for result in results}, {own.pk, shared.pk})
+
+    def test_bulk_delete_on_shard(self):
+        mine = self.create_file(self.owner, 'a.txt')
+        theirs = self.create_file(self.friend, 'b.txt')
+
+        results = delete_files(self.owner, [mine.pk, theirs.pk])
+        self.assertEqual([result['status'] for result in results], ['success', 'error'])
+        self.assertFalse(File.objects.using(self.shard_a).exists())
+        self.assertEqual(list(FileLocation.objects.values_list('pk', flat=True)), [theirs.pk])
+
+    def test_api_pages_shared_files_across_shards(self):
+        reader = User.objects.create_user(username='shardreader', password='testpass')
+        names = []
+        for user, name in ((self.owner, 'a.txt'), (self.friend, 'b.txt'), (self.owner, 'c.txt')):
+            self.create_file(user, name).shares.create(grantee=reader)
+            names.append(name)
+
+        self.client.force_login(reader)
+        seen = []
+        url = '/api/v1/files/shared/?limit=2&fields=file_name,owner_username'
+        while url:
+            data = self.client.get(url).json()
+            seen.extend((row['file_name'], row['owner_username']) for row in data['results'])
+            url = data['next']
+
+        self.assertEqual(seen, [('c.txt', 'shardowner'), ('b.txt', 'shardfriend'), ('a.txt', 'shardowner')])
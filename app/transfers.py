@@ -0,0 +1,74 @@
+"""
+Blocking work for the async upload and download views
+
+File reads and writes, hashing and encryption run in a bounded pool of
+TRANSFER_WORKERS threads, so the event loop stays free to serve thousands of
+slow clients while at most that many transfers use a thread at once.
+"""
+
+import asyncio
+import functools
+import hashlib
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+
+DEFAULT_TRANSFER_WORKERS = 16
+CHUNK_SIZE = 64 * 1024
+
+_executor = None
+
+
+def transfer_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'TRANSFER_WORKERS', DEFAULT_TRANSFER_WORKERS),
+            thread_name_prefix='transfer',
+        )
+    return _executor
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Run a blocking call in the transfer pool and wait for it without blocking the event loop
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(transfer_executor(), functools.partial(func, *args, **kwargs))
+
+
+async def stream_file(path, chunk_size=CHUNK_SIZE):
+    """
+    Yield a file's contents chunk by chunk, reading in the transfer pool
+    """
+    f = await run_blocking(open, path, 'rb')
+    try:
+        while chunk := await run_blocking(f.read, chunk_size):
+            yield chunk
+    finally:
+        await run_blocking(f.close)
+
+
+def spool_upload(uploaded_file):
+    """
+    Copy an upload to a temporary file, hashing and measuring it on the way
+
+    Returns:
+        tuple: (temporary path, SHA-256 hex digest, size in bytes)
+    """
+    content_hash = hashlib.sha256()
+    size_bytes = 0
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        for chunk in uploaded_file.chunks():
+            temp_file.write(chunk)
+            content_hash.update(chunk)
+            size_bytes += len(chunk)
+    return temp_file.name, content_hash.hexdigest(), size_bytes
+
+
+def remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
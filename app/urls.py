@@ -1,16 +1,33 @@
-from django.urls import path
-from . import views
+from django.conf import settings
+from django.urls import include, path, re_path
+from rest_framework.routers import SimpleRouter
+from . import api, views
+
+# Under ASGI, transfers can run on the event loop instead of holding a thread each
+upload_view = views.upload_file_async if settings.ASYNC_TRANSFERS else views.upload_file
+download_view = views.download_file_async if settings.ASYNC_TRANSFERS else views.download_file
+
+api_router = SimpleRouter()
+api_router.register('files', api.FileViewSet, basename='api-file')
 
 urlpatterns = [
     path('', views.index, name='index'),  # Add this line for the root URL
     path('notifications/', views.notifications_view, name='notifications'),
-    path('upload/', views.upload_file, name='upload_file'),
+    path('search/', views.search_files, name='search_files'),
+    path('files/names/', views.owned_file_names, name='owned_file_names'),
+    path('upload/', upload_view, name='upload_file'),
     path('register/', views.register, name='register'),
     path('login/', views.user_login, name='login'),
     path('logout/', views.user_logout, name='logout'),  # Add logout URL
     path('friends/', views.manage_friends, name='friends'), 
     path('delete/<int:file_id>/', views.delete_file, name='delete_file'),
-    path('download/<int:file_id>/', views.download_file, name='download_file'),
+    path('download/<int:file_id>/', download_view, name='download_file'),
     path('share/', views.share_file, name='share_file'),
+    path('bulk/delete/', views.bulk_delete_files, name='bulk_delete_files'),
+    path('bulk/share/', views.bulk_share_files, name='bulk_share_files'),
     path('comment/<int:file_id>/', views.comment_on_file, name='comment_on_file'),
-]
\ No newline at end of file
+    path('admission/metrics/', views.admission_metrics, name='admission_metrics'),
+    re_path(r'^api/(?P<version>v1)/', include(api_router.urls + [
+        path('friends/', api.FriendListView.as_view(), name='api-friends'),
+    ])),
+]
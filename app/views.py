@@ -1,15 +1,37 @@
-from django.shortcuts import render, redirect, get_object_or_404
-from django.http import JsonResponse
+from django.shortcuts import render, redirect
+from django.http import JsonResponse, Http404, StreamingHttpResponse
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import User
 from django.views.decorators.csrf import csrf_exempt
 from django.conf import settings
-from .models import File, Comment
+from django.db import transaction
+from asgiref.sync import sync_to_async
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+from django.utils.encoding import smart_str
+from config.routers import read_replica
+from .models import File
+from .permissions import can_view_file, can_download_file
+from .listing import LazyPage, list_files, list_files_across, listing_params
+from .caching import bump_on_commit, friends_scope, get_version, user_scope
+from . import sharding
+from .comments import add_comment, render_thread_page
+from .offload import offload_mode, offload_response
+from .admission import admission_controller, byte_heavy
+from . import bulk
+from . import storage
+from .search import search, search_page_size
+from .transfers import remove_if_exists, run_blocking, spool_upload, stream_file
 from .utils import encrypt_file, decrypt_file
-from firebase_integration.auth import FirebaseAuthService, firebase_db
+from firebase_integration.auth import FirebaseAuthService
 from firebase_integration.database import FirebaseDatabaseService
+from firebase_integration import outbox
+from firebase_integration.tokens import token_manager
+import functools
+import hashlib
 import json
+import mimetypes
 import os
 import tempfile
 import uuid
@@ -29,25 +51,25 @@ def register(request):
         if firebase_user:
             # Create user in Django
             try:
-                user = User.objects.create_user(username=username, email=email, password=password)
-                user.save()
+                firebase_uid = firebase_user['localId']
+                
+                with transaction.atomic():
+                    user = User.objects.create_user(username=username, email=email, password=password)
+                    
+                    # Queue the Firebase profile and username index with the user row
+                    outbox.enqueue_update(
+                        FirebaseDatabaseService.user_profile_paths(firebase_uid, username, email)
+                    )
                 
                 # Auto-login the user
                 login(request, user)
                 
                 # Store Firebase UID in session
-                firebase_uid = firebase_user['localId']
                 request.session['firebase_uid'] = firebase_uid
                 request.session['firebase_token'] = firebase_user['idToken']
                 
-                # Create user profile in Firebase
-                firebase_db.child("users").child(firebase_uid).child("profile").update({
-                    "username": username,
-                    "email": email
-                })
-                
-                # Create username index for efficient lookups
-                firebase_db.child("indexes").child("users_by_username").child(username).set(firebase_uid)
+                # Keep the refresh token so later logins and refreshes skip Firebase sign-in
+                token_manager.remember(user.pk, firebase_user)
                 
                 return redirect('index')
             except Exception as e:
@@ -80,25 +102,39 @@ def user_login(request):
             user = User.objects.get(username=username)
             email = user.email
             
-            # Authenticate with Firebase
-            firebase_user = FirebaseAuthService.sign_in(email, password)
+            # Authenticate with Django first; the password is checked locally
+            user = authenticate(request, username=username, password=password)
             
-            if firebase_user:
-                # Authenticate with Django
-                user = authenticate(request, username=username, password=password)
-                
-                if user is not None:
-                    login(request, user)
-                    
-                    # Store Firebase UID in session
-                    request.session['firebase_uid'] = firebase_user['localId']
-                    request.session['firebase_token'] = firebase_user['idToken']
-                    
-                    return redirect('index')
-                else:
-                    return render(request, 'login.html', {'error': 'Invalid credentials'})
+            if user is None:
+                return render(request, 'login.html', {'error': 'Invalid credentials'})
+            
+            # Reuse the user's Firebase session when we have one; the session
+            # middleware refreshes its ID token in the background
+            firebase_session = token_manager.get_session(user.pk)
+            
+            if firebase_session:
+                firebase_uid = firebase_session['uid']
+                firebase_token = firebase_session['id_token']
             else:
-                return render(request, 'login.html', {'error': 'Firebase authentication failed'})
+                # Authenticate with Firebase
+                firebase_user = FirebaseAuthService.sign_in(email, password)
+                
+                if not firebase_user:
+                    if not FirebaseAuthService.is_available():
+                        return render(request, 'login.html', {'error': 'Sign-in is temporarily unavailable. Please try again in a moment.'})
+                    return render(request, 'login.html', {'error': 'Firebase authentication failed'})
+                
+                token_manager.remember(user.pk, firebase_user)
+                firebase_uid = firebase_user['localId']
+                firebase_token = firebase_user['idToken']
+            
+            login(request, user)
+            
+            # Store Firebase UID in session
+            request.session['firebase_uid'] = firebase_uid
+            request.session['firebase_token'] = firebase_token
+            
+            return redirect('index')
             
         except User.DoesNotExist:
             return render(request, 'login.html', {'error': 'User does not exist'})
@@ -121,95 +157,275 @@ def user_logout(request):
     
     return redirect('login')
 
+QUOTA_EXCEEDED_MESSAGE = 'This upload would exceed your storage quota'
+# Allowance for multipart boundaries and headers when comparing Content-Length with the quota
+MULTIPART_OVERHEAD = 64 * 1024
+
+def _dashboard_row(row, usernames):
+    """
+    Shape a listing row like the file metadata the dashboard templates expect
+    """
+    return {
+        'file_id': str(row['id']),
+        'file_name': row['file_name'],
+        'owner_username': usernames.get(row['user_id'], ''),
+        'size_bytes': row['size_bytes'],
+        'timestamp': row['created_at'],
+    }
+
+def _json_row(row):
+    """
+    A dashboard row for the JSON listing, timestamped in epoch milliseconds like Firebase
+    """
+    return dict(row, timestamp=int(row['timestamp'].timestamp() * 1000))
+
 @login_required
+@read_replica
 def index(request):
     """
     Main dashboard showing user's files
+
+    Served from the local database with keyset pagination; see app.listing
+    for the sort and filter parameters.
+    """
+    params = listing_params(request.GET)
+    
+    def load_owned():
+        rows, cursor = list_files(
+            sharding.owned_files(request.user),
+            cursor=request.GET.get('owned_cursor'),
+            **params
+        )
+        return [_dashboard_row(row, {request.user.pk: request.user.username}) for row in rows], cursor
+    
+    def load_shared():
+        # Files shared with the user may be on any shard
+        rows, cursor = list_files_across(
+            sharding.shared_file_querysets(request.user),
+            cursor=request.GET.get('shared_cursor'),
+            **params
+        )
+        usernames = {}
+        if rows:
+            usernames = dict(User.objects.filter(pk__in={row['user_id'] for row in rows}).values_list('pk', 'username'))
+        return [_dashboard_row(row, usernames) for row in rows], cursor
+    
+    # Queried only if the template fragments are not cached for this version of the user's files
+    owned = LazyPage(load_owned)
+    shared = LazyPage(load_shared)
+    files_version = get_version(user_scope(request.user.pk))
+    
+    # Check if it's an AJAX request (for file sharing from friends page)
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        # The listing only changes when the user's version does, so repeat fetches need no query
+        query_hash = hashlib.sha256(request.GET.urlencode().encode()).hexdigest()[:16]
+        etag = f'W/"{files_version}-{query_hash}"'
+        not_modified = get_conditional_response(request, etag=etag)
+        
+        response = not_modified or JsonResponse({
+            'owned_files': [_json_row(row) for row in owned.rows],
+            'shared_files': [_json_row(row) for row in shared.rows],
+            'owned_next_cursor': owned.next_cursor,
+            'shared_next_cursor': shared.next_cursor,
+        })
+        response['ETag'] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ['X-Requested-With'])
+        return response
+    
+    query = request.GET.copy()
+    query.pop('owned_cursor', None)
+    query.pop('shared_cursor', None)
+    
+    context = {
+        'owned': owned,
+        'shared': shared,
+        'sort': params['sort'],
+        'search': params['name'] or '',
+        'listing_query': query.urlencode(),
+        'fragment_timeout': getattr(settings, 'FRAGMENT_CACHE_TIMEOUT', 600),
+        'files_version': files_version,
+    }
+    
+    return render(request, 'index.html', context)
+
+@login_required
+@read_replica
+def owned_file_names(request):
+    """
+    Every file the user owns, by name, for pickers that list them all at once
+    """
+    files = sharding.owned_files(request.user).order_by('file_name', 'id').values_list('id', 'file_name')
+    return JsonResponse({'files': [{'file_id': str(file_id), 'file_name': file_name} for file_id, file_name in files]})
+
+@login_required
+@read_replica
+def search_files(request):
+    """
+    Full-text search over the names of, and comments on, the files the user can see
+    """
+    query = request.GET.get('q', '').strip()
+    results, next_cursor = search(
+        request.user, query,
+        cursor=request.GET.get('cursor'),
+        limit=search_page_size(request.GET.get('limit'))
+    )
+    
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return JsonResponse({'results': results, 'next_cursor': next_cursor})
+    
+    return render(request, 'search.html', {'query': query, 'results': results, 'next_cursor': next_cursor})
+
+def _has_room_for_upload(request):
+    """
+    Whether the declared size of an upload fits the quota; checked before the body is read
+    """
+    declared_size = int(request.META.get('CONTENT_LENGTH') or 0)
+    return storage.has_room(request.user, max(declared_size - MULTIPART_OVERHEAD, 0))
+
+def _record_upload(request, uploaded_file, content_hash, size_bytes):
+    """
+    Save an upload and its metadata, counting it against the user's quota
+
+    Returns:
+        File, or None if the upload does not fit in the quota
     """
     # Get Firebase UID from session
     firebase_uid = request.session.get('firebase_uid')
     
-    if firebase_uid:
-        # Get user's files from Firebase
-        files_data = FirebaseDatabaseService.get_user_files(firebase_uid)
+    with sharding.atomic_for_user(request.user):
+        # Count the bytes against the quota; rolled back if the upload fails
+        if not storage.reserve(request.user, size_bytes):
+            return None
         
-        # Check if it's an AJAX request (for file sharing from friends page)
-        if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-            return JsonResponse(files_data)
+        # Save file metadata to database first to generate a proper path
+        file_obj = sharding.create_file(
+            user=request.user,
+            file_name=uploaded_file.name,
+            file_path=uploaded_file,  # This will be automatically saved to the correct user folder
+            content_hash=content_hash,
+            size_bytes=size_bytes,
+        )
         
-        context = {
-            'owned_files': files_data['owned_files'],
-            'shared_files': files_data['shared_files']
-        }
+        if firebase_uid:
+            # Queue the Firebase metadata write in the same transaction as the File row
+            outbox.enqueue_update(FirebaseDatabaseService.file_metadata_paths(
+                user_id=firebase_uid,
+                file_id=str(file_obj.id),
+                file_name=file_obj.file_name
+            ))
         
-        return render(request, 'index.html', context)
-    else:
-        # If no Firebase UID, redirect to login
-        return redirect('login')
+        bump_on_commit(user_scope(request.user.pk))
+    
+    return file_obj
+
+def _encrypt_upload(file_obj, temp_path):
+    """
+    Replace the stored copy of an upload with its encryption
+
+    Returns:
+        bool: True if the stored file is now encrypted
+    """
+    # Get the path where Django saved the file
+    original_path = file_obj.get_absolute_path()
+    
+    # Create encrypted file path by appending .enc to the original path
+    encrypted_path = original_path + '.enc'
+    
+    # Encrypt the file
+    if not encrypt_file(temp_path, encrypted_path):
+        return False
+    
+    # Delete the original unencrypted file
+    if os.path.exists(original_path):
+        os.remove(original_path)
+    
+    # Rename encrypted file to the original name
+    os.rename(encrypted_path, original_path)
+    return True
 
 @login_required
+@byte_heavy(lambda request: request.method == 'POST')
 def upload_file(request):
     """
     Upload a file and save metadata to Firebase with encryption
     """
+    if request.method == 'POST':
+        # Refuse uploads that cannot fit in the quota before the body is read
+        if not _has_room_for_upload(request):
+            return render(request, 'upload.html', {'error': QUOTA_EXCEEDED_MESSAGE}, status=413)
+    
     if request.method == 'POST' and request.FILES.get('file'):
         uploaded_file = request.FILES['file']
         
-        # Create a temporary file to store the uploaded file temporarily
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-            temp_path = temp_file.name
-            for chunk in uploaded_file.chunks():
-                temp_file.write(chunk)
+        # Create a temporary file to store the uploaded file temporarily, hashing and measuring it on the way
+        temp_path, content_hash, size_bytes = spool_upload(uploaded_file)
         
         try:
-            # Save file metadata to database first to generate a proper path
-            file_obj = File.objects.create(
-                user=request.user,
-                file_name=uploaded_file.name,
-                file_path=uploaded_file,  # This will be automatically saved to the correct user folder
-            )
-            
-            # Get the path where Django saved the file
-            original_path = file_obj.get_absolute_path()
-            
-            # Create encrypted file path by appending .enc to the original path
-            encrypted_path = original_path + '.enc'
-            
-            # Encrypt the file
-            encryption_success = encrypt_file(temp_path, encrypted_path)
-            
-            if encryption_success:
-                # Delete the original unencrypted file
-                if os.path.exists(original_path):
-                    os.remove(original_path)
-                
-                # Rename encrypted file to the original name
-                os.rename(encrypted_path, original_path)
-                
+            file_obj = _record_upload(request, uploaded_file, content_hash, size_bytes)
+            if file_obj is None:
+                return render(request, 'upload.html', {'error': QUOTA_EXCEEDED_MESSAGE}, status=413)
+            
+            if _encrypt_upload(file_obj, temp_path):
                 # Mark the file as encrypted in the database
                 file_obj.encrypted = True
-                file_obj.save()
-            
-            # Get Firebase UID from session
-            firebase_uid = request.session.get('firebase_uid')
-            
-            if firebase_uid:
-                # Save file metadata to Firebase
-                FirebaseDatabaseService.save_file_metadata(
-                    user_id=firebase_uid,
-                    file_id=str(file_obj.id),
-                    file_name=file_obj.file_name
-                )
+                file_obj.save(update_fields=['encrypted'])
         
         finally:
             # Clean up the temp file
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
+            remove_if_exists(temp_path)
         
         return redirect('index')
     
     return render(request, 'upload.html')
 
+@login_required
+@byte_heavy(lambda request: request.method == 'POST')
+async def upload_file_async(request):
+    """
+    upload_file for ASGI: the body is spooled, hashed and encrypted in the
+    transfer pool and the database is written from a worker thread, so a
+    slow upload holds no thread while its bytes arrive
+    """
+    if request.method != 'POST':
+        return await sync_to_async(render)(request, 'upload.html')
+    
+    if not await sync_to_async(_has_room_for_upload)(request):
+        return await sync_to_async(render)(request, 'upload.html', {'error': QUOTA_EXCEEDED_MESSAGE}, status=413)
+    
+    # Parsing the multipart body reads the spooled request from disk
+    uploaded_file = await run_blocking(lambda: request.FILES.get('file'))
+    if not uploaded_file:
+        return await sync_to_async(render)(request, 'upload.html')
+    
+    temp_path, content_hash, size_bytes = await run_blocking(spool_upload, uploaded_file)
+    
+    try:
+        file_obj = await sync_to_async(_record_upload)(request, uploaded_file, content_hash, size_bytes)
+        if file_obj is None:
+            return await sync_to_async(render)(request, 'upload.html', {'error': QUOTA_EXCEEDED_MESSAGE}, status=413)
+        
+        if await run_blocking(_encrypt_upload, file_obj, temp_path):
+            file_obj.encrypted = True
+            await file_obj.asave(update_fields=['encrypted'])
+    
+    finally:
+        await run_blocking(remove_if_exists, temp_path)
+    
+    return redirect('index')
+
+def _friend_firebase_uid(friend, friend_username=None, friend_id=None):
+    """
+    Find the Firebase UID of a friend being shared with
+
+    Returns:
+        str: The UID, or None if the friend has no Firebase account
+    """
+    # A friend_id sent without a username is already the friend's Firebase UID
+    if not friend_username and friend_id:
+        return friend_id
+    return FirebaseDatabaseService.get_uid_for_username(friend.username)
+
 @login_required
 def share_file(request):
     """
@@ -236,42 +452,29 @@ def share_file(request):
                 return JsonResponse({'status': 'error', 'message': 'No friend specified'})
             
             # Check if the file exists and is owned by the current user
-            file_obj = File.objects.get(id=file_id, user=request.user)
+            file_obj = sharding.get_file(file_id, user=request.user)
             
             # Get Firebase UIDs
             firebase_uid = request.session.get('firebase_uid')
             
-            # Try to find friend's Firebase UID using the username index first (efficient method)
-            # Encode the username for Firebase path safety
-            if friend_username:
-                encoded_username = FirebaseDatabaseService.encode_username(friend_username)
-                friend_firebase_uid = firebase_db.child("indexes").child("users_by_username").child(encoded_username).get().val()
-            else:
-                friend_firebase_uid = friend_id
-            
-            # If not found in index, fall back to scanning all users (legacy method)
-            if not friend_firebase_uid:
-                all_users = firebase_db.child("users").get().val()
-                
-                if all_users:
-                    for user_id, user_data in all_users.items():
-                        if "profile" in user_data and "username" in user_data["profile"]:
-                            if user_data["profile"]["username"] == friend.username:
-                                friend_firebase_uid = user_id
-                                # Create the index for future lookups
-                                firebase_db.child("indexes").child("users_by_username").child(friend.username).set(user_id)
-                                break
+            friend_firebase_uid = _friend_firebase_uid(friend, friend_username, friend_id)
             
             if not friend_firebase_uid:
                 return JsonResponse({'status': 'error', 'message': 'Friend\'s Firebase account not found'})
             
-            # Share file in Firebase - Convert file_id to string for Firebase
-            success = FirebaseDatabaseService.share_file(str(file_id), friend_firebase_uid)
+            with sharding.atomic_for_user(request.user):
+                # Record the share locally for permission checks, on the file's shard
+                file_obj.shares.update_or_create(
+                    grantee=friend,
+                    defaults={'grantee_firebase_uid': friend_firebase_uid}
+                )
+                
+                # Queue the share for Firebase - Convert file_id to string for Firebase
+                outbox.enqueue_share_file(str(file_id), friend_firebase_uid)
+                
+                bump_on_commit(user_scope(request.user.pk), user_scope(friend.pk))
             
-            if success:
-                return JsonResponse({'status': 'success', 'message': f'File shared successfully with {friend.username}'})
-            else:
-                return JsonResponse({'status': 'error', 'message': 'Error sharing file in Firebase'})
+            return JsonResponse({'status': 'success', 'message': f'File shared successfully with {friend.username}'})
             
         except User.DoesNotExist:
             return JsonResponse({'status': 'error', 'message': 'Friend not found'})
@@ -288,7 +491,13 @@ def comment_on_file(request, file_id):
     Add a comment to a file
     """
     try:
-        file_obj = get_object_or_404(File, id=file_id)
+        try:
+            file_obj = sharding.get_file(file_id)
+        except File.DoesNotExist:
+            raise Http404('File not found')
+        
+        if not can_view_file(request, file_obj):
+            return JsonResponse({'status': 'error', 'message': 'You do not have permission to comment on this file'})
         
         if request.method == 'POST':
             content = request.POST.get('comment', '').strip()
@@ -297,11 +506,7 @@ def comment_on_file(request, file_id):
                 return JsonResponse({'status': 'error', 'message': 'Comment cannot be empty'})
             
             # Create the comment
-            comment = Comment.objects.create(
-                file=file_obj,
-                user=request.user,
-                content=content
-            )
+            comment = add_comment(file_obj, request.user, content)
             
             # Redirect back to the download page
             return redirect('download_file', file_id=file_id)
@@ -311,124 +516,104 @@ def comment_on_file(request, file_id):
     except Exception as e:
         return JsonResponse({'status': 'error', 'message': f'Error adding comment: {str(e)}'})
 
+def _conditional_headers(response, file_obj):
+    """
+    Add the validators clients send back in If-None-Match and If-Modified-Since
+    """
+    response['ETag'] = file_obj.get_etag()
+    response['Last-Modified'] = http_date(file_obj.created_at.timestamp())
+    # Downloads need authorization, so shared caches must not keep them
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
 @login_required
+@byte_heavy(lambda request: request.GET.get('download') == 'true')
+@read_replica
 def download_file(request, file_id):
     """
     Download a file from the server with decryption
     """
     try:
         # Get the file object
-        file_obj = File.objects.get(id=file_id)
+        file_obj = sharding.get_file(file_id)
+        
+        # Owners and users the file is shared with may access it
+        if not can_view_file(request, file_obj):
+            return JsonResponse({'status': 'error', 'message': 'You do not have permission to access this file'})
         
         # Check if this is a direct download request
         if request.GET.get('download') == 'true':
-            # Check if user has permission to download the file
-            # (Either owner or shared with the user)
-            if file_obj.user == request.user:
-                # User is the owner
-                file_path = file_obj.file_path.path
+            if not can_download_file(request, file_obj):
+                return JsonResponse({'status': 'error', 'message': 'You do not have permission to download this file'})
+            
+            # Files never change after upload, so a client holding this version needs no bytes
+            not_modified = get_conditional_response(request, etag=file_obj.get_etag(), last_modified=int(file_obj.created_at.timestamp()))
+            if not_modified:
+                return _conditional_headers(not_modified, file_obj)
+            
+            file_path = file_obj.file_path.path
+            
+            # Check if file exists
+            if os.path.exists(file_path):
+                # Let the front proxy send the bytes when it is configured to
+                if offload_mode():
+                    response = offload_response(file_obj)
+                    if response is None:
+                        return JsonResponse({'status': 'error', 'message': 'Error decrypting file'})
+                    return _conditional_headers(response, file_obj)
                 
-                # Check if file exists
-                if os.path.exists(file_path):
-                    # Handle decryption if the file is encrypted
-                    if file_obj.encrypted:
-                        # Create a temporary file for the decrypted content
-                        temp_dir = tempfile.gettempdir()
-                        decrypted_path = os.path.join(temp_dir, f"decrypted_{uuid.uuid4()}_{file_obj.file_name}")
-                        
-                        # Decrypt the file
-                        decryption_success = decrypt_file(file_path, decrypted_path)
-                        
-                        if decryption_success:
-                            # Create file response from the decrypted file
-                            from django.http import FileResponse
-                            from django.utils.encoding import smart_str
-                            
-                            response = FileResponse(open(decrypted_path, 'rb'))
-                            response['Content-Disposition'] = f'attachment; filename="{smart_str(file_obj.file_name)}"'
-                            
-                            # Set up a callback to delete the temp file after the response is sent
-                            # Note: This is a simplified approach; a more robust solution would use middleware
-                            request._decrypted_file_path = decrypted_path
-                            
-                            def close_and_delete_file(response):
-                                response.close()
-                                if hasattr(request, '_decrypted_file_path'):
-                                    if os.path.exists(request._decrypted_file_path):
-                                        os.remove(request._decrypted_file_path)
-                            
-                            response.close = lambda: close_and_delete_file(response)
-                            return response
-                        else:
-                            return JsonResponse({'status': 'error', 'message': 'Error decrypting file'})
-                    else:
-                        # File is not encrypted, return it directly
+                # Handle decryption if the file is encrypted
+                if file_obj.encrypted:
+                    # Create a temporary file for the decrypted content
+                    temp_dir = tempfile.gettempdir()
+                    decrypted_path = os.path.join(temp_dir, f"decrypted_{uuid.uuid4()}_{file_obj.file_name}")
+                    
+                    # Decrypt the file
+                    decryption_success = decrypt_file(file_path, decrypted_path)
+                    
+                    if decryption_success:
+                        # Create file response from the decrypted file
                         from django.http import FileResponse
                         from django.utils.encoding import smart_str
                         
-                        response = FileResponse(open(file_path, 'rb'))
+                        response = FileResponse(open(decrypted_path, 'rb'))
                         response['Content-Disposition'] = f'attachment; filename="{smart_str(file_obj.file_name)}"'
-                        return response
-                else:
-                    return JsonResponse({'status': 'error', 'message': 'File not found on server'})
-            else:
-                # Check if file is shared with the user
-                # This would be a check in Firebase to see if the file is shared with this user
-                firebase_uid = request.session.get('firebase_uid')
-                
-                # For now, we'll allow the download (you should implement proper permission checking)
-                file_path = file_obj.file_path.path
-                
-                # Check if file exists
-                if os.path.exists(file_path):
-                    # Handle decryption if the file is encrypted
-                    if file_obj.encrypted:
-                        # Create a temporary file for the decrypted content
-                        temp_dir = tempfile.gettempdir()
-                        decrypted_path = os.path.join(temp_dir, f"decrypted_{uuid.uuid4()}_{file_obj.file_name}")
                         
-                        # Decrypt the file
-                        decryption_success = decrypt_file(file_path, decrypted_path)
+                        # Set up a callback to delete the temp file after the response is sent
+                        # Note: This is a simplified approach; a more robust solution would use middleware
+                        request._decrypted_file_path = decrypted_path
                         
-                        if decryption_success:
-                            # Create file response from the decrypted file
-                            from django.http import FileResponse
-                            from django.utils.encoding import smart_str
-                            
-                            response = FileResponse(open(decrypted_path, 'rb'))
-                            response['Content-Disposition'] = f'attachment; filename="{smart_str(file_obj.file_name)}"'
-                            
-                            # Set up a callback to delete the temp file after the response is sent
-                            request._decrypted_file_path = decrypted_path
-                            
-                            def close_and_delete_file(response):
-                                response.close()
-                                if hasattr(request, '_decrypted_file_path'):
-                                    if os.path.exists(request._decrypted_file_path):
-                                        os.remove(request._decrypted_file_path)
-                            
-                            response.close = lambda: close_and_delete_file(response)
-                            return response
-                        else:
-                            return JsonResponse({'status': 'error', 'message': 'Error decrypting file'})
-                    else:
-                        # File is not encrypted, return it directly
-                        from django.http import FileResponse
-                        from django.utils.encoding import smart_str
+                        original_close = response.close
                         
-                        response = FileResponse(open(file_path, 'rb'))
-                        response['Content-Disposition'] = f'attachment; filename="{smart_str(file_obj.file_name)}"'
-                        return response
+                        def close_and_delete_file(response):
+                            original_close()
+                            if hasattr(request, '_decrypted_file_path'):
+                                if os.path.exists(request._decrypted_file_path):
+                                    os.remove(request._decrypted_file_path)
+                        
+                        response.close = lambda: close_and_delete_file(response)
+                        return _conditional_headers(response, file_obj)
+                    else:
+                        return JsonResponse({'status': 'error', 'message': 'Error decrypting file'})
                 else:
-                    return JsonResponse({'status': 'error', 'message': 'File not found on server'})
+                    # File is not encrypted, return it directly
+                    from django.http import FileResponse
+                    from django.utils.encoding import smart_str
+                    
+                    response = FileResponse(open(file_path, 'rb'))
+                    response['Content-Disposition'] = f'attachment; filename="{smart_str(file_obj.file_name)}"'
+                    return _conditional_headers(response, file_obj)
+            else:
+                return JsonResponse({'status': 'error', 'message': 'File not found on server'})
         else:
             # This is a request to view the file details with comments
-            # Get comments for this file
-            comments = Comment.objects.filter(file=file_obj).order_by('-created_at')
+            # Get one page of comments for this file, rendered from the cache when unchanged
+            comments_html, comments_cursor = render_thread_page(file_obj, cursor=request.GET.get('comments_cursor'))
             
             context = {
                 'file': file_obj,
-                'comments': comments
+                'comments_html': comments_html,
+                'comments_next_cursor': comments_cursor,
             }
             
             return render(request, 'download.html', context)
@@ -438,6 +623,61 @@ def download_file(request, file_id):
     except Exception as e:
         return JsonResponse({'status': 'error', 'message': f'Error downloading file: {str(e)}'})
 
+@login_required
+@byte_heavy(lambda request: request.GET.get('download') == 'true')
+@read_replica
+async def download_file_async(request, file_id):
+    """
+    download_file for ASGI: the file is read, and decrypted, in the transfer
+    pool and streamed in chunks, so a slow client holds no thread between them
+    """
+    if request.GET.get('download') != 'true':
+        # The details page is all database work
+        return await sync_to_async(download_file)(request, file_id)
+    
+    try:
+        file_obj = await sync_to_async(sharding.get_file)(file_id)
+        
+        if not await sync_to_async(can_view_file)(request, file_obj):
+            return JsonResponse({'status': 'error', 'message': 'You do not have permission to access this file'})
+        if not await sync_to_async(can_download_file)(request, file_obj):
+            return JsonResponse({'status': 'error', 'message': 'You do not have permission to download this file'})
+        
+        not_modified = get_conditional_response(request, etag=file_obj.get_etag(), last_modified=int(file_obj.created_at.timestamp()))
+        if not_modified:
+            return _conditional_headers(not_modified, file_obj)
+        
+        file_path = file_obj.file_path.path
+        if not await run_blocking(os.path.exists, file_path):
+            return JsonResponse({'status': 'error', 'message': 'File not found on server'})
+        
+        if offload_mode():
+            response = await run_blocking(offload_response, file_obj)
+            if response is None:
+                return JsonResponse({'status': 'error', 'message': 'Error decrypting file'})
+            return _conditional_headers(response, file_obj)
+        
+        send_path = file_path
+        if file_obj.encrypted:
+            send_path = os.path.join(tempfile.gettempdir(), f"decrypted_{uuid.uuid4()}_{file_obj.file_name}")
+            if not await run_blocking(decrypt_file, file_path, send_path):
+                await run_blocking(remove_if_exists, send_path)
+                return JsonResponse({'status': 'error', 'message': 'Error decrypting file'})
+        
+        content_type, _ = mimetypes.guess_type(file_obj.file_name)
+        response = StreamingHttpResponse(stream_file(send_path), content_type=content_type or 'application/octet-stream')
+        response['Content-Length'] = str(await run_blocking(os.path.getsize, send_path))
+        response['Content-Disposition'] = f'attachment; filename="{smart_str(file_obj.file_name)}"'
+        if send_path != file_path:
+            # Delete the decrypted copy once the response has been sent
+            response._resource_closers.append(functools.partial(remove_if_exists, send_path))
+        return _conditional_headers(response, file_obj)
+    
+    except File.DoesNotExist:
+        return JsonResponse({'status': 'error', 'message': 'File not found'})
+    except Exception as e:
+        return JsonResponse({'status': 'error', 'message': f'Error downloading file: {str(e)}'})
+
 @login_required
 def delete_file(request, file_id):
     """
@@ -445,10 +685,10 @@ def delete_file(request, file_id):
     """
     try:
         # Get the file object
-        file_obj = File.objects.get(id=file_id)
+        file_obj = sharding.get_file(file_id)
         
         # Check if user is the owner
-        if file_obj.user == request.user:
+        if file_obj.user_id == request.user.pk:
             # Delete file from Firebase first
             firebase_uid = request.session.get('firebase_uid')
             if firebase_uid:
@@ -460,8 +700,11 @@ def delete_file(request, file_id):
             if os.path.exists(file_obj.file_path.path):
                 os.remove(file_obj.file_path.path)
             
-            # Delete the file object from the database
-            file_obj.delete()
+            # Delete the file object from the database, and drop it from everyone's cached dashboard
+            grantee_ids = list(file_obj.shares.values_list('grantee_id', flat=True))
+            sharding.delete_file(file_obj)
+            storage.release(request.user, file_obj.size_bytes)
+            bump_on_commit(*[user_scope(user_id) for user_id in [request.user.pk] + grantee_ids])
             
             return redirect('index')
         else:
@@ -473,6 +716,69 @@ def delete_file(request, file_id):
     except Exception as e:
         return JsonResponse({'status': 'error', 'message': f'Error deleting file: {str(e)}'})
 
+@login_required
+def bulk_delete_files(request):
+    """
+    Delete several files at once
+
+    POST file_ids (repeated) with the ids of the user's files to delete.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'message': 'Invalid request method'})
+    
+    try:
+        file_ids = bulk.parse_file_ids(request.POST.getlist('file_ids'))
+    except ValueError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    
+    try:
+        results = bulk.delete_files(request.user, file_ids, firebase_uid=request.session.get('firebase_uid'))
+    except Exception as e:
+        return JsonResponse({'status': 'error', 'message': f'Error deleting files: {str(e)}'})
+    
+    return JsonResponse({'status': 'success', 'results': results})
+
+@login_required
+def bulk_share_files(request):
+    """
+    Share several files with one friend at once
+
+    POST file_ids (repeated) and friend_username or friend_id, as for share_file.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'message': 'Invalid request method'})
+    
+    friend_username = request.POST.get('friend_username')
+    friend_id = request.POST.get('friend_id')
+    
+    try:
+        file_ids = bulk.parse_file_ids(request.POST.getlist('file_ids'))
+    except ValueError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    
+    try:
+        if friend_username:
+            friend = User.objects.get(username=friend_username)
+        elif friend_id:
+            friend = User.objects.get(id=friend_id)
+        else:
+            return JsonResponse({'status': 'error', 'message': 'No friend specified'})
+        
+        friend_firebase_uid = _friend_firebase_uid(friend, friend_username, friend_id)
+        if not friend_firebase_uid:
+            return JsonResponse({'status': 'error', 'message': 'Friend\'s Firebase account not found'})
+        
+        results = bulk.share_files(
+            request.user, file_ids, friend, friend_firebase_uid,
+            owner_firebase_uid=request.session.get('firebase_uid')
+        )
+    except User.DoesNotExist:
+        return JsonResponse({'status': 'error', 'message': 'Friend not found'})
+    except Exception as e:
+        return JsonResponse({'status': 'error', 'message': f'Error sharing files: {str(e)}'})
+    
+    return JsonResponse({'status': 'success', 'results': results})
+
 @login_required
 def manage_friends(request):
     """
@@ -513,6 +819,7 @@ def manage_friends(request):
             success, message = FirebaseDatabaseService.respond_to_friend_request(firebase_uid, sender_id, accept=True)
             
             if success:
+                bump_on_commit(friends_scope(firebase_uid), friends_scope(sender_id))
                 return JsonResponse({'status': 'success', 'message': message})
             else:
                 return JsonResponse({'status': 'error', 'message': message})
@@ -533,6 +840,7 @@ def manage_friends(request):
             success, message = FirebaseDatabaseService.remove_friend(firebase_uid, friend_id)
             
             if success:
+                bump_on_commit(friends_scope(firebase_uid), friends_scope(friend_id))
                 return JsonResponse({'status': 'success', 'message': message})
             else:
                 return JsonResponse({'status': 'error', 'message': message})
@@ -541,20 +849,33 @@ def manage_friends(request):
     context = {}
     
     if firebase_uid:
-        # Get user's friends
-        friends = FirebaseDatabaseService.get_friends(firebase_uid)
+        # Get user's friends; the template calls this only when its cached list is out of date
+        friends = functools.partial(FirebaseDatabaseService.get_friends, firebase_uid)
         
         # Get friend requests
         friend_requests = FirebaseDatabaseService.get_friend_requests(firebase_uid)
         
         context = {
             'friends': friends,
+            'friends_version': get_version(friends_scope(firebase_uid)),
+            # An unavailable Firebase yields an empty list, which must not be cached
+            'fragment_timeout': getattr(settings, 'FRAGMENT_CACHE_TIMEOUT', 600) if FirebaseDatabaseService.is_available() else 0,
             'incoming_requests': friend_requests['incoming'],
             'outgoing_requests': friend_requests['outgoing']
         }
     
     return render(request, 'friends.html', context)
 
+@login_required
+def admission_metrics(request):
+    """
+    Admission control counters for this process, for staff and monitoring
+    """
+    if not request.user.is_staff:
+        return JsonResponse({'status': 'error', 'message': 'Staff only'}, status=403)
+    
+    return JsonResponse(admission_controller.metrics())
+
 @login_required
 def notifications_view(request):
     """
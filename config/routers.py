@@ -0,0 +1,177 @@
+"""
+Database routing between the primary, read replicas and optional shards.
+
+Reads go to a replica only inside views decorated with read_replica; every
+write, and every read anywhere else, uses the primary. With DATABASE_SHARDS
+set, files and the comments, shares, search entries and notifications that
+belong to them live on their owner's shard instead (see app.sharding).
+"""
+
+import contextvars
+import random
+import time
+from functools import wraps
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+
+_replica_reads = contextvars.ContextVar('replica_reads', default=False)
+_wrote = contextvars.ContextVar('wrote_to_primary', default=False)
+
+PIN_SESSION_KEY = '_db_primary_until'
+# Sessions, users and the like always come from the primary
+REPLICA_APP_LABELS = {'app'}
+# Models whose rows are placed on their owner's shard
+SHARDED_MODELS = {
+    ('app', 'file'),
+    ('app', 'comment'),
+    ('app', 'fileshare'),
+    ('app', 'searchentry'),
+    ('firebase_integration', 'commentnotification'),
+}
+
+
+def read_replica(view_func):
+    """
+    Mark a read-only view as safe to serve from a read replica
+    """
+    if iscoroutinefunction(view_func):
+        @wraps(view_func)
+        async def wrapper(*args, **kwargs):
+            return await view_func(*args, **kwargs)
+    else:
+        @wraps(view_func)
+        def wrapper(*args, **kwargs):
+            return view_func(*args, **kwargs)
+
+    wrapper.read_replica = True
+    return wrapper
+
+
+def replica_aliases():
+    return list(getattr(settings, 'DATABASE_REPLICAS', []))
+
+
+def shard_aliases():
+    return list(getattr(settings, 'DATABASE_SHARDS', []))
+
+
+def is_sharded_model(model):
+    return (model._meta.app_label, model._meta.model_name) in SHARDED_MODELS
+
+
+class ShardRouter:
+    """
+    Keep sharded rows with their file's shard
+
+    Querysets on sharded models must name their shard with using(); the
+    helpers in app.sharding do that. The router covers everything reached
+    through an instance: saves, deletes and related managers such as
+    file.comments follow the file, and files assigned a user follow the
+    user's shard.
+    """
+
+    def _db_for_instance(self, model, instance):
+        if instance is None or not is_sharded_model(model):
+            return None
+        if is_sharded_model(instance) and instance._state.db:
+            return instance._state.db
+        if model._meta.model_name == 'file':
+            from app.sharding import shard_for_user
+            if isinstance(instance, model):
+                return shard_for_user(instance.user_id)
+            if instance._meta.label == settings.AUTH_USER_MODEL:
+                return shard_for_user(instance.pk)
+        return None
+
+    def db_for_read(self, model, **hints):
+        if not shard_aliases():
+            return None
+        return self._db_for_instance(model, hints.get('instance'))
+
+    def db_for_write(self, model, **hints):
+        if not shard_aliases():
+            return None
+        return self._db_for_instance(model, hints.get('instance'))
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Files point at users on the primary; the foreign key has no database constraint
+        if shard_aliases() and (is_sharded_model(obj1) or is_sharded_model(obj2)):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in shard_aliases():
+            return (app_label, model_name) in SHARDED_MODELS
+        return None
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        replicas = replica_aliases()
+        if (replicas and model._meta.app_label in REPLICA_APP_LABELS
+                and _replica_reads.get() and not _wrote.get()):
+            return random.choice(replicas)
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        _wrote.set(True)
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas receive their schema from the primary
+        return db not in replica_aliases()
+
+
+class ReadReplicaMiddleware:
+    """
+    Route reads in read_replica views to a replica, except for sessions
+    that wrote recently and must see their own writes
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+
+        wrote_token = _wrote.set(False)
+        replica_token = _replica_reads.set(False)
+        try:
+            response = self.get_response(request)
+            self._pin_if_wrote(request)
+            return response
+        finally:
+            _replica_reads.reset(replica_token)
+            _wrote.reset(wrote_token)
+
+    async def __acall__(self, request):
+        wrote_token = _wrote.set(False)
+        replica_token = _replica_reads.set(False)
+        try:
+            response = await self.get_response(request)
+            # The session may not have been loaded yet, which needs the database
+            await sync_to_async(self._pin_if_wrote)(request)
+            return response
+        finally:
+            _replica_reads.reset(replica_token)
+            _wrote.reset(wrote_token)
+
+    @staticmethod
+    def _pin_if_wrote(request):
+        if _wrote.get() and hasattr(request, 'session'):
+            request.session[PIN_SESSION_KEY] = time.time() + getattr(settings, 'DATABASE_REPLICA_PIN_SECONDS', 5)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        pinned_until = request.session.get(PIN_SESSION_KEY, 0) if hasattr(request, 'session') else 0
+        if getattr(view_func, 'read_replica', False) and pinned_until < time.time():
+            _replica_reads.set(True)
@@ -40,6 +40,7 @@ INSTALLED_APPS = [
     'app',
     'firebase_integration',
     'channels',  # Add channels for WebSocket support
+    'rest_framework',
 ]
 
 MIDDLEWARE = [
@@ -48,8 +49,13 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'config.routers.ReadReplicaMiddleware',
+    'firebase_integration.middleware.FirebaseSessionMiddleware',
+    'firebase_integration.circuit.LatencyBudgetMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # Last, so it only takes a slot for requests that reach the view
+    'app.admission.AdmissionControlMiddleware',
 ]
 
 ROOT_URLCONF = 'config.urls'
@@ -74,11 +80,83 @@ WSGI_APPLICATION = 'config.wsgi.application'
 ASGI_APPLICATION = 'config.asgi.application'  # Set ASGI application for WebSockets
 
 # Database
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# SQLite by default. For production set DB_ENGINE (e.g. django.db.backends.postgresql)
+# and DB_NAME, DB_USER, DB_PASSWORD, DB_HOST and DB_PORT.
+DB_ENGINE = os.getenv('DB_ENGINE', 'django.db.backends.sqlite3')
+
+if DB_ENGINE == 'django.db.backends.sqlite3':
+    DATABASES = {
+        'default': {
+            'ENGINE': DB_ENGINE,
+            'NAME': os.getenv('DB_NAME', BASE_DIR / 'db.sqlite3'),
+            'OPTIONS': {
+                # Wait for the write lock and take it up front instead of failing with "database is locked"
+                'timeout': 20,
+                'transaction_mode': 'IMMEDIATE',
+                # WAL lets readers run alongside the single writer
+                'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL',
+            },
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': DB_ENGINE,
+            'NAME': os.getenv('DB_NAME', 'secure_file_sharing'),
+            'USER': os.getenv('DB_USER', ''),
+            'PASSWORD': os.getenv('DB_PASSWORD', ''),
+            'HOST': os.getenv('DB_HOST', ''),
+            'PORT': os.getenv('DB_PORT', ''),
+            # Keep connections open between requests
+            'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', '60')),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {},
+        }
     }
+
+    # psycopg's connection pool (needs psycopg[pool]) replaces persistent connections
+    if os.getenv('DB_POOL', 'False') == 'True' and 'postgresql' in DB_ENGINE:
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        DATABASES['default']['OPTIONS']['pool'] = {
+            'min_size': int(os.getenv('DB_POOL_MIN_SIZE', '2')),
+            'max_size': int(os.getenv('DB_POOL_MAX_SIZE', '10')),
+        }
+
+# Read replicas: comma-separated hosts, or file paths for SQLite, using the primary's other settings
+DATABASE_REPLICAS = []
+for index, replica in enumerate(filter(None, os.getenv('DB_REPLICAS', '').split(',')), start=1):
+    alias = f'replica_{index}'
+    DATABASES[alias] = dict(DATABASES['default'], TEST={'MIRROR': 'default'})
+    DATABASES[alias]['NAME' if DB_ENGINE == 'django.db.backends.sqlite3' else 'HOST'] = replica.strip()
+    DATABASE_REPLICAS.append(alias)
+
+# Optional sharding: DB_SHARDS=N spreads File, Comment and FileShare rows over N databases
+# by owner. SQLite shards are files next to the primary; other engines use <DB_NAME>_shard_<n>.
+DATABASE_SHARDS = []
+for index in range(int(os.getenv('DB_SHARDS', '0'))):
+    alias = f'shard_{index}'
+    DATABASES[alias] = dict(DATABASES['default'])
+    if DB_ENGINE == 'django.db.backends.sqlite3':
+        DATABASES[alias]['NAME'] = Path(os.getenv('DB_SHARD_DIR', BASE_DIR)) / f'db_shard_{index}.sqlite3'
+    else:
+        DATABASES[alias]['NAME'] = f"{DATABASES['default']['NAME']}_shard_{index}"
+    DATABASE_SHARDS.append(alias)
+
+# Sharded models go to their owner's shard; views marked with config.routers.read_replica
+# read from DATABASE_REPLICAS; everything else uses the primary
+DATABASE_ROUTERS = ['config.routers.ShardRouter', 'config.routers.PrimaryReplicaRouter']
+# After a request writes, the same session reads from the primary for this many seconds
+DATABASE_REPLICA_PIN_SECONDS = 5
+
+# REST API (app.api): versioned in the URL, /api/v1/, and paged with cursors
+REST_FRAMEWORK = {
+    'DEFAULT_AUTHENTICATION_CLASSES': [
+        'rest_framework.authentication.SessionAuthentication',
+        'rest_framework.authentication.BasicAuthentication',
+    ],
+    'DEFAULT_PERMISSION_CLASSES': ['rest_framework.permissions.IsAuthenticated'],
+    'DEFAULT_VERSIONING_CLASS': 'rest_framework.versioning.URLPathVersioning',
+    'ALLOWED_VERSIONS': ['v1'],
 }
 
 # Password validation
@@ -125,9 +203,104 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # Firebase settings
 FIREBASE_CREDENTIALS = os.path.join(BASE_DIR, 'firebase-credentials.json')
 
-# Channels settings
-CHANNEL_LAYERS = {
-    'default': {
+# Answer Firebase reads from a live in-process mirror kept current by the streaming API
+FIREBASE_MIRROR_ENABLED = os.getenv('FIREBASE_MIRROR_ENABLED', 'False') == 'True'
+FIREBASE_MIRROR_NODES = ['files', 'indexes', 'friends', 'users']
+# Fall back to network reads once a mirrored node has not heard from Firebase for this many seconds
+FIREBASE_MIRROR_MAX_STALENESS = float(os.getenv('FIREBASE_MIRROR_MAX_STALENESS', '60'))
+
+# Refresh Firebase ID tokens in the background once they are this many seconds from expiry
+FIREBASE_TOKEN_REFRESH_MARGIN = 300
+
+# Circuit breakers around Firebase: open after this many consecutive failures, probe again after the reset timeout
+FIREBASE_FAILURE_THRESHOLD = 5
+FIREBASE_RESET_TIMEOUT = 30
+# Network timeout for a single Firebase call, and the total time one HTTP request may spend on Firebase
+FIREBASE_REQUEST_TIMEOUT = 10
+FIREBASE_REQUEST_BUDGET = float(os.getenv('FIREBASE_REQUEST_BUDGET', '3'))
+
+# Channels settings. CHANNEL_LAYER picks the backend: 'memory' for a single process, 'unix'
+# for several worker processes on one host, with `python manage.py run_channel_hub` running
+# next to them (see app.channel_layer), or 'redis' for workers on several hosts
+CHANNEL_HUB_SOCKET = os.getenv('CHANNEL_HUB_SOCKET', '/tmp/filesharing-channels.sock')
+CHANNEL_LAYER_BACKENDS = {
+    'memory': {
         'BACKEND': 'channels.layers.InMemoryChannelLayer',
     },
-}
\ No newline at end of file
+    'unix': {
+        'BACKEND': 'app.channel_layer.UnixSocketChannelLayer',
+        'CONFIG': {
+            'path': CHANNEL_HUB_SOCKET,
+        },
+    },
+    'redis': {
+        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'CONFIG': {
+            'hosts': [os.getenv('CHANNEL_REDIS_URL', 'redis://127.0.0.1:6379/0')],
+        },
+    },
+}
+CHANNEL_LAYERS = {
+    'default': CHANNEL_LAYER_BACKENDS[os.getenv('CHANNEL_LAYER', 'memory')],
+}
+# Real-time notifications to one user are coalesced for this long, or until this many wait (see app.notifications)
+NOTIFICATION_COALESCE_SECONDS = 0.25
+NOTIFICATION_MAX_BATCH = 50
+# Each user's last NOTIFICATION_BUFFER_SIZE notifications are kept (in the cache, for up to
+# NOTIFICATION_BUFFER_TTL seconds) for clients that reconnect to catch up from
+NOTIFICATION_BUFFER_SIZE = 200
+NOTIFICATION_BUFFER_TTL = 3600
+# Each NotificationConsumer sends at most one frame per flush window, or per this many events,
+# and accepts this many messages a second (with this burst) from its client (see app.consumers)
+WS_FLUSH_SECONDS = 0.05
+WS_MAX_BATCH = 100
+WS_INBOUND_RATE = 20
+WS_INBOUND_BURST = 40
+# Cache: per-process memory by default. Set CACHE_REDIS_URL when running more than one
+# process, so cache invalidation (and cached Firebase sessions) reach every worker.
+if os.getenv('CACHE_REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('CACHE_REDIS_URL'),
+        }
+    }
+
+# How long rendered comment threads and dashboard/friends fragments stay cached.
+# Entries are invalidated by version counters, so this only bounds memory use.
+COMMENT_THREAD_CACHE_TIMEOUT = 300
+FRAGMENT_CACHE_TIMEOUT = 600
+
+# Download offload: 'nginx' answers downloads with X-Accel-Redirect, 'apache' with X-Sendfile,
+# and the proxy sends the bytes. Encrypted files are served from decrypted copies staged in
+# DOWNLOAD_STAGING_ROOT for DOWNLOAD_STAGING_TTL seconds. See the README for the proxy setup.
+FILE_OFFLOAD = os.getenv('FILE_OFFLOAD', '')
+FILE_OFFLOAD_MEDIA_PREFIX = '/protected/media/'
+FILE_OFFLOAD_STAGING_PREFIX = '/protected/staging/'
+DOWNLOAD_STAGING_ROOT = os.getenv('DOWNLOAD_STAGING_ROOT', os.path.join(BASE_DIR, 'staging'))
+DOWNLOAD_STAGING_TTL = 300
+# Staged copies are group-readable, for a proxy sharing the Django user's group
+DOWNLOAD_STAGING_MODE = 0o640
+
+# Admission control for uploads and downloads, per process: at most ADMISSION_MAX_INFLIGHT
+# at once (others wait up to ADMISSION_QUEUE_TIMEOUT seconds), ADMISSION_MAX_PER_USER per
+# user, and a per-user token bucket of bytes per second with a burst allowance
+ADMISSION_MAX_INFLIGHT = int(os.getenv('ADMISSION_MAX_INFLIGHT', '8'))
+ADMISSION_MAX_PER_USER = 2
+ADMISSION_QUEUE_TIMEOUT = 2
+ADMISSION_USER_BYTES_PER_SECOND = 20 * 1024 * 1024
+ADMISSION_USER_BURST_BYTES = 200 * 1024 * 1024
+
+# Default per-user storage quota in bytes (None for unlimited); UserStorage.quota_bytes overrides it
+STORAGE_QUOTA_BYTES = int(os.getenv('STORAGE_QUOTA_BYTES')) if os.getenv('STORAGE_QUOTA_BYTES') else None
+
+# Threads removing stored files from disk for bulk deletes (see app.bulk)
+BULK_DELETE_WORKERS = 8
+
+# Serve uploads and downloads with the async views (app.views.*_async); only worth it under ASGI.
+# Their file work runs in a pool of TRANSFER_WORKERS threads (see app.transfers)
+ASYNC_TRANSFERS = os.getenv('ASYNC_TRANSFERS', 'False') == 'True'
+TRANSFER_WORKERS = 16
+
+# Time a cold worker may spend importing the project (python manage.py check_import_time)
+IMPORT_TIME_BUDGET_MS = int(os.getenv('IMPORT_TIME_BUDGET_MS', '1000'))
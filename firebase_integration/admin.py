@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import FileShareNotification, CommentNotification
+from .models import FileShareNotification, CommentNotification, FirebaseOutbox
 
 class FileShareNotificationAdmin(admin.ModelAdmin):
     list_display = ('user', 'file_name', 'timestamp')
@@ -9,5 +9,11 @@ class CommentNotificationAdmin(admin.ModelAdmin):
     list_display = ('user', 'file', 'comment', 'timestamp')
     search_fields = ('user__username', 'file__name', 'comment')
 
+class FirebaseOutboxAdmin(admin.ModelAdmin):
+    list_display = ('id', 'operation', 'attempts', 'available_at', 'processed_at', 'created_at')
+    list_filter = ('operation',)
+    search_fields = ('last_error',)
+
 admin.site.register(FileShareNotification, FileShareNotificationAdmin)
-admin.site.register(CommentNotification, CommentNotificationAdmin)
\ No newline at end of file
+admin.site.register(CommentNotification, CommentNotificationAdmin)
+admin.site.register(FirebaseOutbox, FirebaseOutboxAdmin)
\ No newline at end of file
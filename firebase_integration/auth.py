@@ -1,7 +1,15 @@
-from firebase_admin import auth, initialize_app, credentials, get_app
-import pyrebase
+# Firebase clients, created on first use
+#
+# Importing firebase_admin and pyrebase (and through them grpc, oauth2client and
+# google-cloud-storage) and reading the credentials takes most of a worker's boot
+# time, so none of it happens at import. firebase_auth, firebase_db and
+# firebase_storage are lazy objects that initialize the clients the first time
+# they are used, and are falsy if initialization failed.
 import os
 import json
+import threading
+from django.utils.functional import SimpleLazyObject
+from firebase_integration.circuit import CircuitBreakerAdapter, firebase_auth_breaker, firebase_db_breaker
 
 # Get the directory where auth.py is located
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -10,29 +18,6 @@ project_root = os.path.dirname(current_dir)
 # Path to the credentials file
 creds_path = os.path.join(project_root, 'firebase-credentials.json')
 
-print(f"Looking for Firebase credentials at: {creds_path}")
-
-# Firebase Admin SDK initialization for server-side operations
-try:
-    cred = credentials.Certificate(creds_path)
-    
-    # Load project information from credentials file for client config
-    with open(creds_path, 'r') as f:
-        firebase_creds = json.load(f)
-        project_id = firebase_creds.get('project_id')
-        print(f"Found project_id: {project_id}")
-
-    # Check if the default app already exists, if not, initialize it
-    try:
-        default_app = get_app()
-        print("Using existing Firebase app")
-    except ValueError:
-        default_app = initialize_app(cred)
-        print("Initialized new Firebase app")
-except Exception as e:
-    print(f"Error initializing Firebase Admin SDK: {e}")
-    project_id = None
-
 # Firebase configuration for client-side authentication
 # Using the provided Firebase configuration
 firebase_config = {
@@ -46,34 +31,105 @@ firebase_config = {
     "measurementId": "G-R3YLCMJ97M"
 }
 
-# Print current configuration (for debugging)
-print("Firebase Configuration:")
-print({k: (v if k != 'apiKey' else '***') for k, v in firebase_config.items()})
-
-# Initialize Firebase for client-side operations
-try:
-    firebase = pyrebase.initialize_app(firebase_config)
-    firebase_auth = firebase.auth()
-
-    # Only initialize database if databaseURL is provided
-    if firebase_config["databaseURL"]:
-        firebase_db = firebase.database()
-    else:
-        firebase_db = None
-
-    # Only initialize storage if storageBucket is provided
-    if firebase_config["storageBucket"]:
-        firebase_storage = firebase.storage()
-    else:
-        firebase_storage = None
-except Exception as e:
-    print(f"Error initializing Firebase client SDK: {e}")
-    firebase = None
-    firebase_auth = None
-    firebase_db = None
-    firebase_storage = None
+_init_lock = threading.Lock()
+_admin_app = {}
+_clients = {}
+
+
+def _init_admin_app():
+    from firebase_admin import credentials, get_app, initialize_app
+
+    print(f"Looking for Firebase credentials at: {creds_path}")
+
+    # Firebase Admin SDK initialization for server-side operations
+    try:
+        cred = credentials.Certificate(creds_path)
+
+        # Load project information from credentials file for client config
+        with open(creds_path, 'r') as f:
+            firebase_creds = json.load(f)
+            print(f"Found project_id: {firebase_creds.get('project_id')}")
+
+        # Check if the default app already exists, if not, initialize it
+        try:
+            default_app = get_app()
+            print("Using existing Firebase app")
+        except ValueError:
+            default_app = initialize_app(cred)
+            print("Initialized new Firebase app")
+        return default_app
+    except Exception as e:
+        print(f"Error initializing Firebase Admin SDK: {e}")
+        return None
+
+
+def _init_clients():
+    import pyrebase
+
+    # Print current configuration (for debugging)
+    print("Firebase Configuration:")
+    print({k: (v if k != 'apiKey' else '***') for k, v in firebase_config.items()})
+
+    # Initialize Firebase for client-side operations
+    try:
+        firebase = pyrebase.initialize_app(firebase_config)
+
+        # Send database requests through the circuit breaker and the request's latency budget
+        firebase.requests.mount(firebase_config["databaseURL"], CircuitBreakerAdapter(firebase_db_breaker))
+
+        return {
+            'firebase': firebase,
+            'auth': firebase.auth(),
+            # Only initialize database if databaseURL is provided
+            'db': firebase.database() if firebase_config["databaseURL"] else None,
+        }
+    except Exception as e:
+        print(f"Error initializing Firebase client SDK: {e}")
+        return {'firebase': None, 'auth': None, 'db': None}
+
+
+def get_admin_app():
+    """
+    The firebase_admin app, initialized on first use; None if initialization failed
+    """
+    if 'app' not in _admin_app:
+        with _init_lock:
+            if 'app' not in _admin_app:
+                _admin_app['app'] = _init_admin_app()
+    return _admin_app['app']
+
+
+def get_client(name):
+    """
+    A pyrebase client ('firebase', 'auth', 'db' or 'storage'), initialized on first use
+
+    Returns:
+        The client, or None if the client SDK could not be initialized
+    """
+    if name not in _clients:
+        with _init_lock:
+            if 'firebase' not in _clients:
+                _clients.update(_init_clients())
+            if name == 'storage' and name not in _clients:
+                # Only initialize storage if storageBucket is provided
+                firebase = _clients['firebase']
+                _clients['storage'] = firebase.storage() if firebase and firebase_config["storageBucket"] else None
+    return _clients[name]
+
+
+firebase = SimpleLazyObject(lambda: get_client('firebase'))
+firebase_auth = SimpleLazyObject(lambda: get_client('auth'))
+firebase_db = SimpleLazyObject(lambda: get_client('db'))
+firebase_storage = SimpleLazyObject(lambda: get_client('storage'))
 
 class FirebaseAuthService:
+    @staticmethod
+    def is_available():
+        """
+        False while the auth circuit is open and calls would fail fast
+        """
+        return firebase_auth_breaker.is_available()
+
     @staticmethod
     def sign_up(email, password):
         """
@@ -84,7 +140,7 @@ class FirebaseAuthService:
             return None
             
         try:
-            user = firebase_auth.create_user_with_email_and_password(email, password)
+            user = firebase_auth_breaker.call(firebase_auth.create_user_with_email_and_password, email, password)
             return user
         except Exception as e:
             print(f"Error signing up: {e}")
@@ -100,7 +156,7 @@ class FirebaseAuthService:
             return None
             
         try:
-            user = firebase_auth.sign_in_with_email_and_password(email, password)
+            user = firebase_auth_breaker.call(firebase_auth.sign_in_with_email_and_password, email, password)
             return user
         except Exception as e:
             print(f"Error signing in: {e}")
@@ -116,7 +172,7 @@ class FirebaseAuthService:
             return None
             
         try:
-            user_info = firebase_auth.get_account_info(id_token)
+            user_info = firebase_auth_breaker.call(firebase_auth.get_account_info, id_token)
             return user_info
         except Exception as e:
             print(f"Error getting account info: {e}")
@@ -128,7 +184,9 @@ class FirebaseAuthService:
         Verify a Firebase ID token
         """
         try:
-            decoded_token = auth.verify_id_token(id_token)
+            # Verified tokens are cached until they expire
+            from firebase_integration.tokens import token_manager
+            decoded_token = token_manager.verify(id_token)
             return decoded_token
         except Exception as e:
             print(f"Error verifying token: {e}")
@@ -154,6 +212,8 @@ class FirebaseAuthService:
         Create a custom token for a user - useful for server-side authentication
         """
         try:
+            from firebase_admin import auth
+            get_admin_app()
             custom_token = auth.create_custom_token(uid, additional_claims)
             return custom_token
         except Exception as e:
@@ -0,0 +1,270 @@
+# Circuit breakers and a per-request latency budget for calls to Firebase
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from requests.exceptions import HTTPError, Timeout
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30
+DEFAULT_REQUEST_TIMEOUT = 10
+DEFAULT_REQUEST_BUDGET = 3
+
+# Monotonic deadline for all Firebase calls made while handling the current request
+_deadline = contextvars.ContextVar('firebase_deadline', default=None)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency whose circuit is open"""
+
+
+class LatencyBudgetExceeded(Timeout):
+    """Raised when the current request has no time left for Firebase calls"""
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def start_budget(seconds=None):
+    """
+    Start a latency budget for the Firebase calls made in this context
+
+    Returns:
+        A token to pass to end_budget()
+    """
+    if seconds is None:
+        seconds = _setting('FIREBASE_REQUEST_BUDGET', DEFAULT_REQUEST_BUDGET)
+    return _deadline.set(time.monotonic() + seconds)
+
+
+def end_budget(token):
+    _deadline.reset(token)
+
+
+def remaining_budget():
+    """
+    Seconds left for Firebase calls, or None outside a budgeted request
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def call_timeout():
+    """
+    The network timeout for the next Firebase call
+
+    Raises:
+        LatencyBudgetExceeded: If the request's budget is already spent
+    """
+    timeout = _setting('FIREBASE_REQUEST_TIMEOUT', DEFAULT_REQUEST_TIMEOUT)
+    remaining = remaining_budget()
+    if remaining is None:
+        return timeout
+    if remaining <= 0:
+        raise LatencyBudgetExceeded("Firebase latency budget exhausted for this request")
+    return min(timeout, remaining)
+
+
+def is_dependency_failure(error):
+    """
+    Client errors such as a wrong password or a denied rule mean Firebase is
+    up and answering, so they must not trip the breaker
+    """
+    if isinstance(error, LatencyBudgetExceeded):
+        return False
+    response = getattr(error, 'response', None)
+    if isinstance(error, HTTPError) and response is not None and response.status_code < 500:
+        return False
+    return True
+
+
+class CircuitBreaker:
+    """
+    Fails fast once a dependency keeps failing
+
+    The circuit opens after failure_threshold consecutive failures. While
+    open, calls raise CircuitOpenError without touching the network. After
+    reset_timeout seconds a single probe call is let through (half-open):
+    success closes the circuit, failure opens it again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=None, reset_timeout=None):
+        self.name = name
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._probing = False
+
+    @property
+    def failure_threshold(self):
+        if self._failure_threshold is not None:
+            return self._failure_threshold
+        return _setting('FIREBASE_FAILURE_THRESHOLD', DEFAULT_FAILURE_THRESHOLD)
+
+    @property
+    def reset_timeout(self):
+        if self._reset_timeout is not None:
+            return self._reset_timeout
+        return _setting('FIREBASE_RESET_TIMEOUT', DEFAULT_RESET_TIMEOUT)
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def is_available(self):
+        return self.state != self.OPEN
+
+    def allow(self):
+        """
+        Whether a call may go ahead; in the half-open state only one probe is allowed
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._state = self.HALF_OPEN
+                self._probing = False
+            if self._state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    print(f"Firebase circuit '{self.name}' opened after {self._failures} failure(s)")
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def release(self):
+        """
+        Give back a probe slot without counting the call either way
+        """
+        with self._lock:
+            self._probing = False
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call func through the breaker, within the current latency budget
+
+        Calls that cannot take a timeout themselves run on a helper thread, so
+        the request stops waiting once its budget or the call timeout is spent.
+        """
+        if not self.allow():
+            raise CircuitOpenError(f"Firebase circuit '{self.name}' is open")
+
+        try:
+            timeout = call_timeout()
+        except LatencyBudgetExceeded:
+            self.release()
+            raise
+
+        future = _executor.submit(contextvars.copy_context().run, func, *args, **kwargs)
+        try:
+            result = future.result(timeout=timeout)
+        except FutureTimeoutError:
+            self.record_failure()
+            raise Timeout(f"Firebase call timed out after {timeout:.1f}s")
+        except Exception as e:
+            if is_dependency_failure(e):
+                self.record_failure()
+            else:
+                self.record_success()
+            raise
+
+        self.record_success()
+        return result
+
+
+class CircuitBreakerAdapter(HTTPAdapter):
+    """
+    A requests transport adapter that sends every request through a circuit
+    breaker and bounds it by the current latency budget
+    """
+
+    def __init__(self, breaker, *args, **kwargs):
+        self.breaker = breaker
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, stream=False, timeout=None, **kwargs):
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"Firebase circuit '{self.breaker.name}' is open")
+
+        try:
+            budget_timeout = call_timeout()
+        except LatencyBudgetExceeded:
+            self.breaker.release()
+            raise
+
+        try:
+            response = super().send(request, stream=stream, timeout=timeout or budget_timeout, **kwargs)
+        except Exception:
+            self.breaker.record_failure()
+            raise
+
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+
+class LatencyBudgetMiddleware:
+    """
+    Give each request a fixed budget of time to spend waiting on Firebase
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+
+        token = start_budget()
+        try:
+            return self.get_response(request)
+        finally:
+            end_budget(token)
+
+    async def __acall__(self, request):
+        token = start_budget()
+        try:
+            return await self.get_response(request)
+        finally:
+            end_budget(token)
+
+
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='firebase-call')
+
+firebase_db_breaker = CircuitBreaker('firebase_db')
+firebase_auth_breaker = CircuitBreaker('firebase_auth')
@@ -1,45 +1,94 @@
 # Database operations for Firebase integration
 from firebase_integration.auth import firebase_db
+from firebase_integration.circuit import firebase_db_breaker
+from firebase_integration.mirror import get_mirror
 import json
 import base64
 
 class FirebaseDatabaseService:
+    @staticmethod
+    def is_available():
+        """
+        False while the database circuit is open and calls would fail fast
+        """
+        return firebase_db_breaker.is_available()
+
+    @staticmethod
+    def read(*path):
+        """
+        Read the value at a Firebase path, answering from the live mirror when it is fresh
+        """
+        mirror = get_mirror()
+        if mirror:
+            hit, value = mirror.lookup(*path)
+            if hit:
+                return value
+        return firebase_db.child(*path).get().val()
+
+    @staticmethod
+    def file_metadata_paths(user_id, file_id, file_name, shared_with=None):
+        """
+        Build the multi-path update that stores a file's metadata
+
+        Returns:
+            dict: Firebase paths mapped to the values written there
+        """
+        if shared_with is None:
+            shared_with = []
+
+        data = {
+            "file_id": file_id,
+            "file_name": file_name,
+            "owner_id": user_id,
+            "shared_with": shared_with,
+            "timestamp": {".sv": "timestamp"}  # Server timestamp
+        }
+
+        return {
+            # Save to files collection
+            f"files/{file_id}": data,
+            # Also save to user's files collection
+            f"users/{user_id}/files/{file_id}": True,
+        }
+
+    @staticmethod
+    def user_profile_paths(user_id, username, email):
+        """
+        Build the multi-path update that stores a user's profile and username index
+        """
+        return {
+            f"users/{user_id}/profile/username": username,
+            f"users/{user_id}/profile/email": email,
+            # Username index for efficient lookups
+            f"indexes/users_by_username/{username}": user_id,
+        }
+
     @staticmethod
     def save_file_metadata(user_id, file_id, file_name, shared_with=None):
         """
         Save file metadata to Firebase real-time database
         """
         try:
-            if shared_with is None:
-                shared_with = []
-            
-            data = {
-                "file_id": file_id,
-                "file_name": file_name,
-                "owner_id": user_id,
-                "shared_with": shared_with,
-                "timestamp": {".sv": "timestamp"}  # Server timestamp
-            }
-            
-            # Save to files collection
-            firebase_db.child("files").child(file_id).set(data)
-            
-            # Also save to user's files collection
-            firebase_db.child("users").child(user_id).child("files").child(file_id).set(True)
-            
+            paths = FirebaseDatabaseService.file_metadata_paths(user_id, file_id, file_name, shared_with)
+
+            # Write both locations in a single multi-path update
+            firebase_db.update(paths)
+
             return True
         except Exception as e:
             print(f"Error saving file metadata: {e}")
             return False
     
     @staticmethod
-    def share_file(file_id, shared_user_id):
+    def share_file(file_id, shared_user_id, notification_id=None):
         """
         Share a file with another user
         
         Args:
             file_id (str): The ID of the file to share. Must be a string to work with Firebase
             shared_user_id (str): The Firebase UID of the user to share with
+            notification_id (str): Optional fixed key for the notification, so a retried
+                share does not notify the user twice
             
         Returns:
             bool: True if successful, False otherwise
@@ -75,7 +124,10 @@ class FirebaseDatabaseService:
                 "shared_by": file_data["owner_id"],
                 "timestamp": {".sv": "timestamp"}
             }
-            firebase_db.child("users").child(shared_user_id).child("notifications").push(notification_data)
+            if notification_id:
+                firebase_db.child("users").child(shared_user_id).child("notifications").child(notification_id).set(notification_data)
+            else:
+                firebase_db.child("users").child(shared_user_id).child("notifications").push(notification_data)
             
             return True
         except Exception as e:
@@ -108,7 +160,7 @@ class FirebaseDatabaseService:
         Gets a username from a Firebase UID
         """
         try:
-            user_profile = firebase_db.child("users").child(uid).child("profile").get().val()
+            user_profile = FirebaseDatabaseService.read("users", uid, "profile")
             if user_profile and "username" in user_profile:
                 return user_profile["username"]
             return "Unknown User"
@@ -116,6 +168,33 @@ class FirebaseDatabaseService:
             print(f"Error getting username for UID: {e}")
             return "Unknown User"
     
+    @staticmethod
+    def get_uid_for_username(username):
+        """
+        Gets a Firebase UID from a username, using the username index
+
+        Returns:
+            str: The UID, or None if no Firebase user has the username
+        """
+        uid = firebase_db.child("indexes").child("users_by_username").child(
+            FirebaseDatabaseService.encode_username(username)
+        ).get().val()
+        
+        # If not found in index, fall back to scanning all users (legacy method)
+        if not uid:
+            all_users = firebase_db.child("users").get().val()
+            
+            if all_users:
+                for user_id, user_data in all_users.items():
+                    if "profile" in user_data and "username" in user_data["profile"]:
+                        if user_data["profile"]["username"] == username:
+                            uid = user_id
+                            # Create the index for future lookups
+                            firebase_db.child("indexes").child("users_by_username").child(username).set(user_id)
+                            break
+        
+        return uid
+    
     @staticmethod
     def get_user_files(user_id):
         """
@@ -123,16 +202,15 @@ class FirebaseDatabaseService:
         """
         try:
             # Get files owned by user
-            owned_files_refs = firebase_db.child("users").child(user_id).child("files").get()
+            owned_files_data = FirebaseDatabaseService.read("users", user_id, "files")
             
             # Get files shared with user
-            shared_files_refs = firebase_db.child("users").child(user_id).child("shared_with_me").get()
+            shared_files_data = FirebaseDatabaseService.read("users", user_id, "shared_with_me")
             
             owned_files = []
             shared_files = []
             
-            if owned_files_refs and owned_files_refs.val():
-                owned_files_data = owned_files_refs.val()
+            if owned_files_data:
                 # Handle different return types (dictionary vs list)
                 if isinstance(owned_files_data, dict):
                     owned_files_ids = list(owned_files_data.keys())
@@ -146,14 +224,13 @@ class FirebaseDatabaseService:
                                 owned_files_ids.append(i)
                 
                 for file_id in owned_files_ids:
-                    file_data = firebase_db.child("files").child(file_id).get().val()
+                    file_data = FirebaseDatabaseService.read("files", file_id)
                     if file_data:
                         # Add username to the file data
                         file_data['owner_username'] = FirebaseDatabaseService.get_username_for_uid(file_data['owner_id'])
                         owned_files.append(file_data)
             
-            if shared_files_refs and shared_files_refs.val():
-                shared_files_data = shared_files_refs.val()
+            if shared_files_data:
                 # Handle different return types (dictionary vs list)
                 if isinstance(shared_files_data, dict):
                     shared_files_ids = list(shared_files_data.keys())
@@ -167,7 +244,7 @@ class FirebaseDatabaseService:
                                 shared_files_ids.append(i)
                 
                 for file_id in shared_files_ids:
-                    file_data = firebase_db.child("files").child(file_id).get().val()
+                    file_data = FirebaseDatabaseService.read("files", file_id)
                     if file_data:
                         # Add username to the file data
                         file_data['owner_username'] = FirebaseDatabaseService.get_username_for_uid(file_data['owner_id'])
@@ -243,14 +320,14 @@ class FirebaseDatabaseService:
             encoded_username = FirebaseDatabaseService.encode_username(recipient_username)
             
             # Try the encoded username in the index first
-            username_index = firebase_db.child("indexes").child("users_by_username").child(encoded_username).get().val()
+            username_index = FirebaseDatabaseService.read("indexes", "users_by_username", encoded_username)
             
             if username_index:
                 recipient_id = username_index
                 print(f"Found user {recipient_username} with ID {recipient_id} using encoded index")
             else:
                 # Also try with the non-encoded username (for backward compatibility)
-                username_index = firebase_db.child("indexes").child("users_by_username").child(recipient_username).get().val()
+                username_index = FirebaseDatabaseService.read("indexes", "users_by_username", recipient_username)
                 
                 if username_index:
                     recipient_id = username_index
@@ -342,7 +419,7 @@ class FirebaseDatabaseService:
                         if request_data["status"] == "pending":
                             # Get sender username
                             sender_username = "Unknown"
-                            sender_profile = firebase_db.child("users").child(sender_id).child("profile").get().val()
+                            sender_profile = FirebaseDatabaseService.read("users", sender_id, "profile")
                             if sender_profile and "username" in sender_profile:
                                 sender_username = sender_profile["username"]
                                 
@@ -364,7 +441,7 @@ class FirebaseDatabaseService:
                         if request_data["status"] == "pending":
                             # Get recipient username
                             recipient_username = "Unknown"
-                            recipient_profile = firebase_db.child("users").child(recipient_id).child("profile").get().val()
+                            recipient_profile = FirebaseDatabaseService.read("users", recipient_id, "profile")
                             if recipient_profile and "username" in recipient_profile:
                                 recipient_username = recipient_profile["username"]
                                 
@@ -438,16 +515,15 @@ class FirebaseDatabaseService:
         Get all friends for a user
         """
         try:
-            friends_ref = firebase_db.child("friends").child(user_id).get()
+            friends_data = FirebaseDatabaseService.read("friends", user_id)
             
             friends = []
-            if friends_ref and friends_ref.val():
-                friends_data = friends_ref.val()
+            if friends_data:
                 if friends_data and isinstance(friends_data, dict):
                     for friend_id in friends_data:
                         # Get friend username and other info
                         friend_username = "Unknown"
-                        friend_profile = firebase_db.child("users").child(friend_id).child("profile").get().val()
+                        friend_profile = FirebaseDatabaseService.read("users", friend_id, "profile")
                         if friend_profile and "username" in friend_profile:
                             friend_username = friend_profile["username"]
                             
@@ -0,0 +1,28 @@
+import time
+from django.core.management.base import BaseCommand
+from firebase_integration.outbox import process_outbox
+
+
+class Command(BaseCommand):
+    help = "Drain pending Firebase writes from the outbox"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help="Maximum number of outbox rows to claim per batch")
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help="Seconds to sleep when the outbox is empty")
+        parser.add_argument('--once', action='store_true',
+                            help="Drain the rows that are currently due, then exit")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        while True:
+            processed = process_outbox(batch_size=batch_size)
+            if processed:
+                self.stdout.write(f"Applied {processed} outbox event(s)")
+                continue
+
+            if options['once']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,47 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from firebase_integration.tokens import token_manager
+
+
+class FirebaseSessionMiddleware:
+    """
+    Keep the Firebase UID and ID token in the Django session current
+
+    Installs tokens refreshed in the background by the token manager and
+    schedules a refresh when the current one is close to expiry. Never
+    waits on Firebase.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+
+        self._sync_session(request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        # Loading the user and session reads the database
+        await sync_to_async(self._sync_session)(request)
+        return await self.get_response(request)
+
+    @staticmethod
+    def _sync_session(request):
+        user = getattr(request, 'user', None)
+
+        if user is not None and user.is_authenticated:
+            session = token_manager.get_session(user.pk)
+
+            if session:
+                if request.session.get('firebase_token') != session['id_token']:
+                    request.session['firebase_uid'] = session['uid']
+                    request.session['firebase_token'] = session['id_token']
+
+                if token_manager.needs_refresh(session):
+                    token_manager.schedule_refresh(user.pk)
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:50
+
+import django.utils.timezone
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('firebase_integration', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FirebaseOutbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('operation', models.CharField(choices=[('update', 'Multi-path update'), ('share_file', 'Share file')], max_length=32)),
+                ('payload', models.JSONField()),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['processed_at', 'available_at', 'id'], name='firebase_in_process_76e82d_idx')],
+            },
+        ),
+    ]
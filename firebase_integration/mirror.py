@@ -0,0 +1,219 @@
+# Live in-process mirror of Firebase nodes, kept current with the streaming (SSE) API
+import copy
+import json
+import threading
+import time
+from django.conf import settings
+from firebase_integration.auth import firebase_db
+
+DEFAULT_NODES = ("files", "indexes", "friends", "users")
+# Only these children of users/<uid> are mirrored; notifications and the like are skipped
+DEFAULT_USER_KEYS = ("profile", "files", "shared_with_me")
+DEFAULT_MAX_STALENESS = 60
+MAX_RECONNECT_DELAY = 60
+
+
+class FirebaseMirror:
+    """
+    Keeps a copy of selected Firebase nodes in memory
+
+    One background thread per node holds an SSE connection open. Firebase
+    sends the whole node as a "put" at "/" on every (re)connect, which
+    resyncs the copy, followed by "put"/"patch" events for each change and
+    a keep-alive roughly every 30 seconds. A node is fresh while it has
+    been synced and has heard from Firebase within max_staleness seconds.
+    """
+
+    def __init__(self, nodes=DEFAULT_NODES, user_keys=DEFAULT_USER_KEYS, max_staleness=DEFAULT_MAX_STALENESS):
+        self.nodes = tuple(nodes)
+        self.user_keys = set(user_keys)
+        self.max_staleness = max_staleness
+        self._lock = threading.RLock()
+        self._trees = {}
+        self._last_seen = {}
+        self._clients = {}
+        self._threads = []
+        self._stop = threading.Event()
+
+    def start(self):
+        for node in self.nodes:
+            thread = threading.Thread(target=self._run, args=(node,), name=f"firebase-mirror-{node}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        self._stop.set()
+        for client in list(self._clients.values()):
+            try:
+                client.close()
+            except Exception:
+                pass
+
+    def _connect(self, node):
+        from pyrebase.pyrebase import ClosableSSEClient, KeepAuthSession
+        url = f"{firebase_db.database_url}{node}.json"
+        return ClosableSSEClient(url, session=KeepAuthSession(), build_headers=firebase_db.build_headers)
+
+    def _run(self, node):
+        delay = 1
+        while not self._stop.is_set():
+            try:
+                client = self._connect(node)
+                self._clients[node] = client
+                for message in client:
+                    if self._stop.is_set():
+                        return
+                    # Keep-alives arrive as None and only prove the connection is alive
+                    if message:
+                        self.apply_event(node, message.event, json.loads(message.data))
+                    self._touch(node)
+                    delay = 1
+            except Exception as e:
+                print(f"Firebase mirror for '{node}' disconnected: {e}")
+
+            # Drop the copy until the next connection has resynced it
+            self._invalidate(node)
+            self._stop.wait(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def _touch(self, node):
+        with self._lock:
+            if node in self._trees:
+                self._last_seen[node] = time.monotonic()
+
+    def _invalidate(self, node):
+        with self._lock:
+            self._trees.pop(node, None)
+            self._last_seen.pop(node, None)
+
+    def apply_event(self, node, event, data):
+        """
+        Apply one SSE event to the mirrored copy of a node
+        """
+        if event in ("cancel", "auth_revoked"):
+            raise RuntimeError(f"stream {event}: {data}")
+        if event not in ("put", "patch"):
+            return
+
+        segments = [segment for segment in data["path"].split("/") if segment]
+
+        with self._lock:
+            if event == "put":
+                self._put(node, segments, data["data"])
+            else:
+                for key, value in (data["data"] or {}).items():
+                    self._put(node, segments + [segment for segment in key.split("/") if segment], value)
+            self._last_seen[node] = time.monotonic()
+
+    def _put(self, node, segments, value):
+        if node == "users":
+            if len(segments) >= 2 and segments[1] not in self.user_keys:
+                return
+            value = self._filter_users(segments, value)
+
+        if not segments:
+            self._trees[node] = value if value is not None else {}
+            return
+
+        if node not in self._trees:
+            # Changes before the initial snapshot cannot be applied safely
+            return
+
+        parent = self._trees[node]
+        for segment in segments[:-1]:
+            child = _get_child(parent, segment)
+            if not isinstance(child, (dict, list)):
+                child = {}
+                _set_child(parent, segment, child)
+            parent = child
+        _set_child(parent, segments[-1], value)
+
+    def _filter_users(self, segments, value):
+        if not isinstance(value, dict):
+            return value
+        if not segments:
+            return {uid: self._filter_users([uid], user) for uid, user in value.items()}
+        if len(segments) == 1:
+            return {key: child for key, child in value.items() if key in self.user_keys}
+        return value
+
+    def is_fresh(self, node):
+        with self._lock:
+            last_seen = self._last_seen.get(node)
+        return last_seen is not None and time.monotonic() - last_seen <= self.max_staleness
+
+    def lookup(self, *path):
+        """
+        Look up a value in the mirror
+
+        Returns:
+            tuple: (True, value) when the node is fresh, with value None if the
+                path does not exist, or (False, None) when the caller must read
+                from Firebase instead
+        """
+        segments = [str(segment) for segment in path]
+        node = segments[0]
+        if node not in self.nodes or not self.is_fresh(node):
+            return False, None
+        if node == "users" and len(segments) >= 3 and segments[2] not in self.user_keys:
+            return False, None
+
+        with self._lock:
+            value = self._trees.get(node)
+            for segment in segments[1:]:
+                value = _get_child(value, segment)
+                if value is None:
+                    return True, None
+            # Callers decorate the returned data, so never hand out the mirrored objects
+            return True, copy.deepcopy(value)
+
+
+def _get_child(parent, key):
+    if isinstance(parent, dict):
+        return parent.get(key)
+    if isinstance(parent, list) and key.isdigit() and int(key) < len(parent):
+        return parent[int(key)]
+    return None
+
+
+def _set_child(parent, key, value):
+    if isinstance(parent, list) and key.isdigit():
+        index = int(key)
+        if index < len(parent):
+            parent[index] = value
+        elif value is not None:
+            parent.extend([None] * (index - len(parent)))
+            parent.append(value)
+        return
+
+    if isinstance(parent, dict):
+        if value is None:
+            parent.pop(key, None)
+        else:
+            parent[key] = value
+
+
+_mirror = None
+_mirror_lock = threading.Lock()
+
+
+def get_mirror():
+    """
+    Return the process-wide mirror, starting it on first use
+
+    Returns None unless FIREBASE_MIRROR_ENABLED is set.
+    """
+    global _mirror
+
+    if not getattr(settings, 'FIREBASE_MIRROR_ENABLED', False):
+        return None
+
+    if _mirror is None:
+        with _mirror_lock:
+            if _mirror is None:
+                _mirror = FirebaseMirror(
+                    nodes=getattr(settings, 'FIREBASE_MIRROR_NODES', DEFAULT_NODES),
+                    max_staleness=getattr(settings, 'FIREBASE_MIRROR_MAX_STALENESS', DEFAULT_MAX_STALENESS),
+                ).start()
+    return _mirror
@@ -1,5 +1,7 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
+import uuid
 
 class FileShareNotification(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -12,10 +14,40 @@ class FileShareNotification(models.Model):
         return f"{self.user.username} shared {self.file_name} with {', '.join([user.username for user in self.shared_with.all()])} on {self.timestamp}"
 
 class CommentNotification(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # Stored on its file's shard when sharding is enabled, away from the users table
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False)
     file = models.ForeignKey('app.File', on_delete=models.CASCADE)
     comment = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
-        return f"Comment by {self.user.username} on {self.file.name} at {self.timestamp}"
\ No newline at end of file
+        return f"Comment by {self.user.username} on {self.file.name} at {self.timestamp}"
+
+class FirebaseOutbox(models.Model):
+    """
+    A Firebase write recorded in the same transaction as the local change.
+    The process_firebase_outbox command drains pending rows to Firebase.
+    """
+    OPERATION_UPDATE = 'update'
+    OPERATION_SHARE_FILE = 'share_file'
+    OPERATION_CHOICES = [
+        (OPERATION_UPDATE, 'Multi-path update'),
+        (OPERATION_SHARE_FILE, 'Share file'),
+    ]
+
+    key = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    operation = models.CharField(max_length=32, choices=OPERATION_CHOICES)
+    payload = models.JSONField()
+    attempts = models.PositiveIntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['processed_at', 'available_at', 'id']),
+        ]
+
+    def __str__(self):
+        return f"{self.operation} ({self.key})"
@@ -0,0 +1,194 @@
+# Transactional outbox for Firebase writes
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from firebase_integration.auth import firebase_db
+from firebase_integration.database import FirebaseDatabaseService
+from firebase_integration.models import FirebaseOutbox
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_LEASE_SECONDS = 60
+DEFAULT_BACKOFF_SECONDS = 2
+DEFAULT_MAX_BACKOFF_SECONDS = 3600
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def enqueue_update(paths):
+    """
+    Record a multi-path Firebase update to be applied by the outbox worker
+
+    Call this inside the same transaction as the local change, so the write
+    is committed (or rolled back) together with it.
+
+    Args:
+        paths (dict): Firebase paths mapped to the values to write there.
+            A value of None removes the path.
+    """
+    return FirebaseOutbox.objects.create(
+        operation=FirebaseOutbox.OPERATION_UPDATE,
+        payload=paths,
+    )
+
+
+def enqueue_share_file(file_id, shared_user_id):
+    """
+    Record a file share to be applied by the outbox worker
+    """
+    return FirebaseOutbox.objects.create(
+        operation=FirebaseOutbox.OPERATION_SHARE_FILE,
+        payload={
+            "file_id": str(file_id),
+            "shared_user_id": shared_user_id,
+        },
+    )
+
+
+def _paths_overlap(first, second):
+    """
+    Firebase rejects a multi-path update in which one path is an ancestor of another
+    """
+    return first.startswith(second + "/") or second.startswith(first + "/")
+
+
+def merge_updates(updates):
+    """
+    Merge consecutive multi-path updates into as few requests as possible
+
+    Later updates win when they write the same path. A new request is started
+    whenever a path would be an ancestor or descendant of one already queued.
+
+    Args:
+        updates (list): Multi-path update dicts, oldest first
+
+    Returns:
+        list: Merged multi-path update dicts, in the order they must be applied
+    """
+    merged = []
+    current = {}
+
+    for paths in updates:
+        if any(_paths_overlap(path, queued) for path in paths for queued in current):
+            merged.append(current)
+            current = {}
+        current.update(paths)
+
+    if current:
+        merged.append(current)
+
+    return merged
+
+
+def _claim_batch(batch_size):
+    """
+    Lease a batch of due outbox rows so concurrent workers skip them
+    """
+    now = timezone.now()
+    lease_until = now + timedelta(seconds=_setting('FIREBASE_OUTBOX_LEASE_SECONDS', DEFAULT_LEASE_SECONDS))
+
+    with transaction.atomic():
+        pending = FirebaseOutbox.objects.filter(processed_at__isnull=True, available_at__lte=now).order_by('id')
+        if connection.features.has_select_for_update_skip_locked:
+            pending = pending.select_for_update(skip_locked=True)
+        events = list(pending[:batch_size])
+        FirebaseOutbox.objects.filter(id__in=[event.id for event in events]).update(available_at=lease_until)
+
+    return events
+
+
+def _mark_processed(events):
+    FirebaseOutbox.objects.filter(id__in=[event.id for event in events]).update(
+        processed_at=timezone.now(),
+        last_error='',
+    )
+
+
+def _mark_failed(events, error):
+    """
+    Schedule failed rows for a retry with exponential backoff
+    """
+    base = _setting('FIREBASE_OUTBOX_BACKOFF_SECONDS', DEFAULT_BACKOFF_SECONDS)
+    cap = _setting('FIREBASE_OUTBOX_MAX_BACKOFF_SECONDS', DEFAULT_MAX_BACKOFF_SECONDS)
+    now = timezone.now()
+
+    for event in events:
+        event.attempts += 1
+        event.available_at = now + timedelta(seconds=min(base * 2 ** (event.attempts - 1), cap))
+        event.last_error = str(error)
+        event.save(update_fields=['attempts', 'available_at', 'last_error'])
+
+
+def _apply_share_file(event):
+    # The notification is keyed by the outbox row so a retry overwrites it instead of duplicating it
+    success = FirebaseDatabaseService.share_file(
+        event.payload["file_id"],
+        event.payload["shared_user_id"],
+        notification_id=event.key.hex,
+    )
+    if not success:
+        raise RuntimeError(f"Could not share file {event.payload['file_id']}")
+
+
+def _flush_updates(events):
+    """
+    Apply a run of multi-path update rows using as few Firebase requests as possible
+    """
+    if not events:
+        return 0
+
+    try:
+        for paths in merge_updates([event.payload for event in events]):
+            firebase_db.update(paths)
+    except Exception as e:
+        print(f"Error applying Firebase outbox updates: {e}")
+        _mark_failed(events, e)
+        return 0
+
+    _mark_processed(events)
+    return len(events)
+
+
+def process_outbox(batch_size=None):
+    """
+    Drain one batch of due outbox rows to Firebase
+
+    Rows are applied in the order they were written. Consecutive multi-path
+    updates are merged into a single request; every other operation is
+    applied on its own. Failed rows are retried later with backoff and are
+    never dropped.
+
+    Returns:
+        int: The number of rows applied successfully
+    """
+    if batch_size is None:
+        batch_size = _setting('FIREBASE_OUTBOX_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+
+    processed = 0
+    updates = []
+
+    for event in _claim_batch(batch_size):
+        if event.operation == FirebaseOutbox.OPERATION_UPDATE:
+            updates.append(event)
+            continue
+
+        processed += _flush_updates(updates)
+        updates = []
+
+        try:
+            if event.operation == FirebaseOutbox.OPERATION_SHARE_FILE:
+                _apply_share_file(event)
+            else:
+                raise ValueError(f"Unknown outbox operation: {event.operation}")
+        except Exception as e:
+            print(f"Error applying Firebase outbox event {event.key}: {e}")
+            _mark_failed([event], e)
+            continue
+
+        _mark_processed([event])
+        processed += 1
+
+    processed += _flush_updates(updates)
+    return processed
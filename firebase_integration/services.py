@@ -1,13 +1,4 @@
-from firebase_admin import credentials, messaging, get_app
-
-# Try to get the existing Firebase app instead of initializing a new one
-try:
-    app = get_app()
-except ValueError:
-    # This block should not execute if auth.py has already initialized the app correctly
-    from firebase_admin import initialize_app
-    cred = credentials.Certificate('firebase-credentials.json')
-    app = initialize_app(cred, name='messaging-app')
+from firebase_integration.auth import get_admin_app
 
 def send_notification(title, body, token):
     """
@@ -18,6 +9,9 @@ def send_notification(title, body, token):
         body (str): The body content of the notification.
         token (str): The device token to which the notification will be sent.
     """
+    # Deferred, like the rest of the Firebase SDK, so importing this module stays cheap
+    from firebase_admin import messaging
+
     message = messaging.Message(
         notification=messaging.Notification(
             title=title,
@@ -26,7 +20,7 @@ def send_notification(title, body, token):
         token=token,
     )
 
-    response = messaging.send(message)
+    response = messaging.send(message, app=get_admin_app())
     return response
 
 def notify_file_shared(file_name, user_token):
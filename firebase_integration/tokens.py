@@ -0,0 +1,143 @@
+# Firebase ID-token verification cache and background session refresh
+import base64
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.cache import cache
+from firebase_integration.auth import firebase_auth, get_admin_app
+from firebase_integration.circuit import firebase_auth_breaker
+
+# Firebase ID tokens are valid for an hour
+DEFAULT_TOKEN_LIFETIME = 3600
+DEFAULT_REFRESH_MARGIN = 300
+# Refresh tokens do not expire on their own, so keep sessions for a month of inactivity
+SESSION_CACHE_TIMEOUT = 30 * 24 * 3600
+MAX_VERIFIED_TOKENS = 10000
+
+
+def token_expiry(id_token):
+    """
+    Read the exp claim of an ID token without verifying it
+
+    Only used to schedule refreshes; never trust the result for authorization.
+    """
+    try:
+        payload = id_token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return int(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except Exception:
+        return int(time.time()) + DEFAULT_TOKEN_LIFETIME
+
+
+class FirebaseTokenManager:
+    """
+    Caches verified ID tokens and keeps each user's Firebase session fresh
+
+    Verified claims are kept until the token's exp, so a token is checked
+    against Google's signing certificates once. firebase_admin reuses one
+    HTTP-cached certificate fetcher per app, which keeps the certificates
+    themselves cached between verifications.
+
+    Each user's uid, ID token and refresh token are kept in the Django cache.
+    Tokens close to expiry are refreshed on a small thread pool, so requests
+    never wait on Firebase auth.
+    """
+
+    def __init__(self, refresh_margin=None, max_workers=2):
+        self._refresh_margin = refresh_margin
+        self._verified = {}
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="firebase-token")
+
+    @property
+    def refresh_margin(self):
+        if self._refresh_margin is not None:
+            return self._refresh_margin
+        return getattr(settings, 'FIREBASE_TOKEN_REFRESH_MARGIN', DEFAULT_REFRESH_MARGIN)
+
+    def verify(self, id_token):
+        """
+        Verify a Firebase ID token, reusing the result until the token expires
+
+        Raises:
+            Whatever firebase_admin.auth.verify_id_token raises for a bad token
+        """
+        cache_key = hashlib.sha256(id_token.encode()).hexdigest()
+        now = time.time()
+
+        with self._lock:
+            cached = self._verified.get(cache_key)
+        if cached and cached["exp"] > now:
+            return cached
+
+        from firebase_admin import auth
+        get_admin_app()
+        claims = auth.verify_id_token(id_token)
+
+        with self._lock:
+            if len(self._verified) >= MAX_VERIFIED_TOKENS:
+                self._verified = {key: value for key, value in self._verified.items() if value["exp"] > now}
+                if len(self._verified) >= MAX_VERIFIED_TOKENS:
+                    self._verified.clear()
+            self._verified[cache_key] = claims
+        return claims
+
+    @staticmethod
+    def _cache_key(user_id):
+        return f"firebase_session:{user_id}"
+
+    def remember(self, user_id, firebase_user):
+        """
+        Store the Firebase session returned by sign-in, sign-up or refresh
+
+        Args:
+            user_id: The Django user's primary key
+            firebase_user (dict): pyrebase's response, with localId or userId,
+                idToken and refreshToken
+        """
+        session = {
+            "uid": firebase_user.get("localId") or firebase_user.get("userId"),
+            "id_token": firebase_user["idToken"],
+            "refresh_token": firebase_user["refreshToken"],
+            "expires_at": token_expiry(firebase_user["idToken"]),
+        }
+        cache.set(self._cache_key(user_id), session, SESSION_CACHE_TIMEOUT)
+        return session
+
+    def get_session(self, user_id):
+        return cache.get(self._cache_key(user_id))
+
+    def forget(self, user_id):
+        cache.delete(self._cache_key(user_id))
+
+    def needs_refresh(self, session):
+        return session["expires_at"] - time.time() <= self.refresh_margin
+
+    def schedule_refresh(self, user_id):
+        """
+        Refresh a user's ID token in the background, at most once at a time
+        """
+        with self._lock:
+            if user_id in self._refreshing:
+                return False
+            self._refreshing.add(user_id)
+        self._executor.submit(self._refresh, user_id)
+        return True
+
+    def _refresh(self, user_id):
+        try:
+            session = self.get_session(user_id)
+            if session and firebase_auth:
+                self.remember(user_id, firebase_auth_breaker.call(firebase_auth.refresh, session["refresh_token"]))
+        except Exception as e:
+            print(f"Error refreshing Firebase token: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(user_id)
+
+
+token_manager = FirebaseTokenManager()
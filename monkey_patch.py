@@ -21,15 +21,15 @@ class ImpImporter:
 # Add the missing ImpImporter to pkgutil module
 pkgutil.ImpImporter = ImpImporter
 
-# Make sure pkg_resources works properly with our monkey patch
-try:
-    import pkg_resources
+# pkg_resources registers its finders when it is first imported, and with the
+# shim in place that now works; only a copy imported before this patch needs
+# them registered again. Importing it here would slow every startup.
+pkg_resources = sys.modules.get('pkg_resources')
+if pkg_resources is not None:
     # Re-register finders that might have failed during initial import
     if hasattr(pkg_resources, 'register_finder') and hasattr(pkg_resources, 'find_on_path'):
         pkg_resources.register_finder(pkgutil.ImpImporter, pkg_resources.find_on_path)
         pkg_resources.register_finder(zipimport.zipimporter, pkg_resources.find_eggs_in_zip)
         pkg_resources.register_finder(importlib.machinery.FileFinder, pkg_resources.find_on_path)
-except ImportError:
-    pass
 
 print("Applied Python 3.13 compatibility monkey patches")
\ No newline at end of file